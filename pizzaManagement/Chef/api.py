@@ -0,0 +1,132 @@
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+from pizzaManagement.database import retry_on_lock
+
+from Owner.api import ApiError, bulk_write, detail_response, page_response, parse_json_body, search_response
+from Owner.bulk_edit import RecipeConflict, apply_topping_changes
+from Owner.deletion import delete_pizzas
+from Owner.models import Pizza, Topping
+from Owner.search import search_pizzas, search_toppings
+from Owner.serializers import serialize_pizza, serialize_topping
+from Owner.topping_index import parse_topping_filter, pizza_queryset, topping_index
+from .decorators import chef_required
+from .forms import PizzaForm
+
+
+# Function: pizza_collection
+# Parameters: request (HttpRequest)
+# Description: API endpoint listing pizzas and their toppings as JSON, one keyset paginated page at a time.
+#              ?with=, ?any= and ?without= topping ids restrict the list like the dashboard filter.
+#              Requires Chef authentication to access.
+# Returns: JsonResponse
+@chef_required
+@require_GET
+def pizza_collection(request):
+    pizzas = Pizza.objects.with_toppings()
+    # Optional topping filter: ?with= / ?any= / ?without= topping ids
+    all_of, any_of, none_of = parse_topping_filter(request.GET)
+    if all_of or any_of or none_of:
+        pizzas = pizza_queryset(topping_index.match(all_of, any_of, none_of), pizzas)
+    return page_response(request, pizzas, serialize_pizza)
+
+
+# Function: pizza_search
+# Parameters: request (HttpRequest)
+# Description: API endpoint searching pizzas by name or by the names of their toppings, best matches first.
+# Returns: JsonResponse
+@chef_required
+@require_GET
+def pizza_search(request):
+    return search_response(request, search_pizzas, serialize_pizza)
+
+
+# Function: topping_search
+# Parameters: request (HttpRequest)
+# Description: API endpoint searching toppings by name, for picking the toppings of a pizza.
+# Returns: JsonResponse
+@chef_required
+@require_GET
+def topping_search(request):
+    return search_response(request, search_toppings, serialize_topping)
+
+
+# Function: pizza_detail
+# Parameters: request (HttpRequest), pizza_id (int)
+# Description: API endpoint returning a single pizza and its toppings as JSON.
+# Returns: JsonResponse
+@chef_required
+@require_GET
+def pizza_detail(request, pizza_id):
+    return detail_response(Pizza.objects.with_toppings(), pizza_id, serialize_pizza)
+
+
+# Function: pizza_bulk
+# Parameters: request (HttpRequest)
+# Description: API endpoint creating, updating and deleting many pizzas in one transaction.
+#              Items use the PizzaForm fields: {"name": "...", "toppings": [topping ids]}.
+# Returns: JsonResponse
+@chef_required
+@require_POST
+def pizza_bulk(request):
+    return bulk_write(request, Pizza.objects.with_toppings(), PizzaForm, serialize_pizza, delete=delete_pizzas)
+
+
+# Function: _id_list
+# Parameters: payload (dict), key (str)
+# Description: Returns the list of ids stored under key in a request payload.
+# Returns: list of int, raises ApiError if the value is not a list of integers.
+def _id_list(payload, key):
+    ids = payload.get(key, [])
+    if not isinstance(ids, list) or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in ids):
+        raise ApiError("'%s' must be a list of ids." % key)
+    return ids
+
+
+# Function: _selected_pizzas
+# Parameters: payload (dict) - carries either "pizzas": [ids] or "filter": {"with": [], "any": [], "without": []}
+# Description: Resolves the pizza selection of a bulk topping change, a filter is matched with the topping index
+#              like the dashboard filter.
+# Returns: list of pizza ids, raises ApiError if the selection is missing or invalid.
+def _selected_pizzas(payload):
+    if ('pizzas' in payload) == ('filter' in payload):
+        raise ApiError("Select the pizzas with either 'pizzas' or 'filter'.")
+    if 'pizzas' in payload:
+        return _id_list(payload, 'pizzas')
+    selection = payload['filter']
+    if not isinstance(selection, dict):
+        raise ApiError("'filter' must be a JSON object.")
+    all_of, any_of, none_of = (_id_list(selection, key) for key in ('with', 'any', 'without'))
+    if not (all_of or any_of or none_of):
+        raise ApiError("'filter' must contain at least one topping.")
+    return topping_index.match(all_of, any_of, none_of).ids()
+
+
+# Function: pizza_toppings_bulk
+# Parameters: request (HttpRequest) - POST request with a JSON body of the form
+#       {"pizzas": [ids] or "filter": {"with": [], "any": [], "without": []}, "add": [ids], "remove": [ids]}
+# Description: API endpoint adding and removing toppings on many pizzas in one transaction, e.g. adding
+#              a new topping to every pizza with pepperoni. Nothing is written if a pizza would be left
+#              without toppings or with the same toppings as another pizza (409). Returns the number of
+#              pizzas selected and changed, and of toppings added and removed.
+# Returns: JsonResponse
+@chef_required
+@require_POST
+def pizza_toppings_bulk(request):
+    try:
+        payload = parse_json_body(request)
+        pizza_ids = _selected_pizzas(payload)
+        add, remove = _id_list(payload, 'add'), _id_list(payload, 'remove')
+        if not (add or remove):
+            raise ApiError("'add' or 'remove' must contain at least one topping.")
+        if set(add) & set(remove):
+            raise ApiError("A topping cannot be both added and removed.")
+        missing = set(add + remove) - set(Topping.objects.filter(pk__in=add + remove).values_list('pk', flat=True))
+        if missing:
+            raise ApiError("Some toppings do not exist.", errors={'toppings': sorted(missing)})
+        summary = retry_on_lock(apply_topping_changes)(pizza_ids, add, remove)
+    except ApiError as error:
+        return error.response()
+    except RecipeConflict as conflict:
+        return ApiError(str(conflict), status=409,
+                        errors={'empty': conflict.empty, 'duplicates': conflict.duplicates}).response()
+    return JsonResponse(summary)
@@ -1,17 +1,40 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
 from django.http import HttpResponseForbidden
+from Owner.roles import CHEF, has_role
+
+
+# Function: _is_chef
+# Parameters: request (HttpRequest)
+# Description: Checks if the user of the request is authenticated and has the chef role.
+# Returns: bool
+def _is_chef(request):
+    return has_role(request, CHEF)
 
 
 # Function: chef_required
 # Parameters:
-#   - view_func: The view function to be wrapped
+#   - view_func: The view function to be wrapped (sync or async)
 # Description: Decorator function that checks if the user is authenticated and is a chef.
 #              If the user is authenticated and is a chef, the wrapped view function is called.
 #              Otherwise, returns an HTTP 403 Forbidden response.
+#              Async views get an async wrapper, so they stay coroutines under ASGI.
 # Returns: The wrapped view function.
 def chef_required(view_func):
+    if asyncio.iscoroutinefunction(view_func):
+        async def async_wrapped_view(request, *args, **kwargs):
+            # Loading the lazy request.user may read the session and user tables, so check it off the event loop
+            if await sync_to_async(_is_chef)(request):
+                # Call the view function
+                return await view_func(request, *args, **kwargs)
+            # Return HTTP 403 Forbidden response if not authenticated or not a chef
+            return HttpResponseForbidden("You don't have permission to access this page.")
+        return async_wrapped_view
+
     def wrapped_view(request, *args, **kwargs):
         # Check if the user is authenticated and is a chef
-        if request.user.is_authenticated and request.user.username == 'Chef':
+        if _is_chef(request):
             # Call the view function
             return view_func(request, *args, **kwargs)
         else:
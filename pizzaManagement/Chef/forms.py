@@ -1,37 +1,130 @@
 from django import forms
-from Owner.models import Pizza
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from Owner.forms import UniqueNameModelForm
+from Owner.models import Pizza, Topping, recipe_fingerprint
+
+
+# Function: _topping_ids
+# Parameters: values - raw toppings of a bulk item
+# Description: Reads the topping ids of a raw item, skipping values that are not ids (the form rejects them).
+# Returns: list of int
+def _topping_ids(values):
+    ids = []
+    for value in values if isinstance(values, (list, tuple)) else []:
+        try:
+            ids.append(Topping._meta.pk.to_python(value))
+        except ValidationError:
+            continue
+    return [pk for pk in ids if pk is not None]
+
+
+# Class: ToppingChoiceField
+# Description: Topping picker of PizzaForm. In a bulk request the toppings of the whole batch are loaded
+#              once into known, and each item is validated against them instead of with its own query.
+class ToppingChoiceField(forms.ModelMultipleChoiceField):
+    # Toppings by id, loaded for a bulk request
+    known = None
+
+    def clean(self, value):
+        if self.known is None:
+            return super().clean(value)
+        value = self.prepare_value(value)
+        if self.required and not value:
+            raise ValidationError(self.error_messages['required'], code='required')
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['invalid_list'], code='invalid_list')
+        toppings = {}
+        for pk in value:
+            try:
+                topping = self.known.get(Topping._meta.pk.to_python(pk))
+            except ValidationError:
+                raise ValidationError(self.error_messages['invalid_pk_value'], code='invalid_pk_value',
+                                      params={'pk': pk})
+            if topping is None:
+                raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                      params={'value': pk})
+            toppings[topping.pk] = topping
+        self.run_validators(value)
+        return list(toppings.values())
 
 
 # Class: PizzaForm
 # Description: Form class for creating and updating Pizza objects.
 # Parameters:
-#   - forms.ModelForm: The base class for the form, provided by Django.
-class PizzaForm(forms.ModelForm):
+#   - UniqueNameModelForm: Shared base form providing name cleaning and race-free saves.
+class PizzaForm(UniqueNameModelForm):
+    duplicate_name_message = "A pizza with this name already exists."
+    # Error shown when two items of one bulk request have the same toppings
+    duplicate_recipe_message = "Another pizza in this request has exactly these toppings."
+
     # Metaclass to define metadata for the form
     class Meta:
         # Use the Pizza model
         model = Pizza
         # Specify the fields to include in the form (name, toppings)
         fields = ['name', 'toppings']
+        field_classes = {
+            'toppings': ToppingChoiceField
+        }
         widgets = {
             'toppings': forms.CheckboxSelectMultiple # Use checkboxes for selecting toppings
         }
 
-    # Function: clean_name
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.bulk is not None:
+            self.fields['toppings'].known = self.bulk.toppings
+
+    # Function: bulk_context
+    # Parameters: cls, items (list of dict) - raw create and update items of a bulk request
+    # Description: Adds the toppings of every item, and the pizzas already having the recipe of an item, each
+    #              loaded with one query for the whole batch.
+    # Returns: BulkContext
+    @classmethod
+    def bulk_context(cls, items):
+        context = super().bulk_context(items)
+        topping_ids = [_topping_ids(item.get('toppings')) for item in items]
+        context.toppings = Topping.objects.in_bulk({pk for ids in topping_ids for pk in ids})
+        fingerprints = {recipe_fingerprint(ids) for ids in topping_ids} - {''}
+        context.recipes = {fingerprint: [] for fingerprint in fingerprints}
+        for fingerprint, pk, name in (Pizza.objects.filter(recipe_fingerprint__in=fingerprints)
+                                      .values_list('recipe_fingerprint', 'pk', 'name')):
+            context.recipes[fingerprint].append((pk, name))
+        return context
+
+    # Function: clean
     # Parameters: self
-    # Description: Custom form validation method to ensure uniqueness of pizza names.
-    # Returns: The cleaned pizza name if it's unique; otherwise, raises a ValidationError.
-    def clean_name(self):
-        # Get the cleaned pizza name from form data
-        name = self.cleaned_data.get('name')
-        if name:
-            # Strip leading and trailing whitespaces from the name field
-            name = name.strip()
-        # Get the instance of the form (if any)
-        instance = getattr(self, 'instance', None)
-        # Check if an instance exists and if a pizza with the same name already exists (excluding the current instance)
-        if instance and Pizza.objects.exclude(pk=instance.pk).filter(name__iexact=name).exists():
-            # Raise a ValidationError if a pizza with the same name already exists
-            raise forms.ValidationError("A pizza with this name already exists.")
-        # Return the cleaned pizza name if it's unique
-        return name
+    # Description: Rejects a topping set another pizza already has, found with one lookup on the indexed
+    #              recipe fingerprint (or in the recipes loaded for a bulk request), and stores the
+    #              fingerprint on the instance (bulk_create and bulk_update keep it).
+    # Returns: The cleaned data.
+    def clean(self):
+        cleaned_data = super().clean()
+        toppings = cleaned_data.get('toppings')
+        if toppings is None:
+            return cleaned_data
+        topping_ids = [topping.pk for topping in toppings]
+        fingerprint = recipe_fingerprint(topping_ids)
+        if self.bulk is not None and fingerprint in self.bulk.recipes:
+            same = [name for pk, name in self.bulk.recipes[fingerprint] if pk != self.instance.pk]
+            existing = same[0] if same else None
+        else:
+            # Look for another pizza with the same toppings (the pizza being updated does not count)
+            same = Pizza.objects.same_recipe(topping_ids)
+            if self.instance.pk is not None:
+                same = same.exclude(pk=self.instance.pk)
+            existing = same.values_list('name', flat=True).first()
+        if existing is not None:
+            raise forms.ValidationError("%s already has exactly these toppings." % existing, code='duplicate_recipe')
+        self.instance.recipe_fingerprint = fingerprint
+        return cleaned_data
+
+    # Function: batch_keys
+    # Parameters: self - a validated form
+    # Description: Adds the recipe to the values that must be unique within a bulk request.
+    # Returns: list of (field, key, message) tuples
+    def batch_keys(self):
+        keys = super().batch_keys()
+        if self.cleaned_data.get('toppings'):
+            keys.append((NON_FIELD_ERRORS, ('recipe', self.instance.recipe_fingerprint), self.duplicate_recipe_message))
+        return keys
@@ -1,9 +1,12 @@
-from django.test import TestCase
-from Owner.models import Pizza, Topping
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from Owner.models import MenuVersion, Pizza, Topping, recipe_fingerprint
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
+from Owner.roles import CHEF
 from .forms import PizzaForm
 
 
@@ -24,6 +27,7 @@ class ChefDashboardIntegrationTest(TestCase):
         cls.chef_username = 'Chef'
         cls.chef_password = 'SupremeSlicesChef'
         cls.chef = User.objects.create_user(username=cls.chef_username, password=cls.chef_password)
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
 
     # Test if the Chef Dashboard view returns a 200 OK status code
     def test_chef_dashboard_view(self):
@@ -99,6 +103,21 @@ class ChefDashboardIntegrationTest(TestCase):
         updated_pizza = Pizza.objects.get(id=self.margherita.id)
         self.assertNotEqual(updated_pizza.name, '')  # Check if pizza name is not changed
 
+    # Test that the dashboard and the update page report a recipe another pizza already has
+    def test_duplicate_recipe_rejected(self):
+        self.client.login(username=self.chef_username, password=self.chef_password)
+        self.margherita.toppings.set([self.pepperoni])
+
+        response = self.client.post(reverse('chef_dashboard'), {'name': 'Pepperoni', 'toppings': [self.pepperoni.id]})
+        self.assertContains(response, 'Margherita already has exactly these toppings.')
+        self.assertFalse(Pizza.objects.filter(name='Pepperoni').exists())
+
+        funghi = Pizza.objects.create(name='Funghi')
+        response = self.client.post(reverse('update_pizza', args=[funghi.id]),
+                                    {'name': 'Funghi', 'toppings': [self.pepperoni.id]})
+        self.assertContains(response, 'Margherita already has exactly these toppings.')
+        self.assertFalse(funghi.toppings.exists())
+
     # Test deleting an existing pizza through the Chef Dashboard
     def test_delete_pizza(self):
         # Log in as the Chef user
@@ -168,6 +187,276 @@ class ChefDashboardIntegrationTest(TestCase):
         self.assertContains(response, 'Delete')  # Check if the delete button is present
 
 
+# ------------------------------------- MENU QUERY TESTING ------------------------------------ #
+# Chef Dashboard query budget tests (one page large enough to hold the whole test menu)
+@override_settings(MENU_PAGE_SIZE=100)
+class ChefDashboardQueryBudgetTest(TestCase):
+    # Number of queries a dashboard page load is allowed to make:
+    # session, user version, menu version, pizzas, prefetched pizza toppings
+    # (the user and roles are served from the cache, toppings are picked through the search API)
+    QUERY_BUDGET = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        # Create a handful of toppings shared by all pizzas
+        cls.toppings = [Topping.objects.create(name='Topping %d' % i) for i in range(5)]
+
+        # Create a Chef user
+        cls.chef_username = 'Chef'
+        cls.chef_password = 'SupremeSlicesChef'
+        chef = User.objects.create_user(username=cls.chef_username, password=cls.chef_password)
+        chef.groups.add(Group.objects.get(name=CHEF))
+
+    # Helper that creates the given number of pizzas, each with every topping
+    def create_pizzas(self, count):
+        for i in range(Pizza.objects.count(), Pizza.objects.count() + count):
+            pizza = Pizza.objects.create(name='Pizza %d' % i)
+            pizza.toppings.set(self.toppings)
+
+    # Test that the dashboard query count does not grow with the size of the menu
+    def test_dashboard_query_budget_is_constant(self):
+        self.client.login(username=self.chef_username, password=self.chef_password)
+        # The first request caches the user and its roles
+        self.client.get(reverse('chef_dashboard'))
+
+        # Small menu
+        self.create_pizzas(2)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('chef_dashboard'))
+        self.assertEqual(response.status_code, 200)
+
+        # Much larger menu, same budget
+        self.create_pizzas(50)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('chef_dashboard'))
+        # One card per pizza: the pickers list no toppings
+        self.assertContains(response, 'Topping 4', count=52)
+
+    # Test that the pickers only render the selected toppings, loaded with one query
+    def test_pickers_render_selected_toppings(self):
+        self.client.login(username=self.chef_username, password=self.chef_password)
+        unused = Topping.objects.create(name='Unused Topping')
+        response = self.client.get(reverse('chef_dashboard'))
+        self.assertNotContains(response, 'Unused Topping')
+        self.assertContains(response, reverse('api_chef_toppings_search'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chef_dashboard'), {'without': [unused.id, 9999]})
+        self.assertEqual(len([query for query in queries if 'FROM "Owner_topping"' in query['sql']]), 1)
+        self.assertContains(response, '<input type="hidden" name="without" value="%d">' % unused.id, html=True)
+        self.assertContains(response, 'Unused Topping', count=2)
+        # The update page starts with the toppings of the pizza
+        pizza = Pizza.objects.create(name='Plain')
+        pizza.toppings.set(self.toppings[:1])
+        response = self.client.get(reverse('update_pizza', args=[pizza.id]))
+        self.assertContains(response, '<input type="hidden" name="toppings" value="%d">' % self.toppings[0].id,
+                            html=True)
+        self.assertNotContains(response, 'Unused Topping')
+
+    # Test that the shared read path prefetches toppings
+    def test_with_toppings_prefetches(self):
+        self.create_pizzas(3)
+        pizzas = list(Pizza.objects.with_toppings())
+        # Accessing toppings must not hit the database again
+        with self.assertNumQueries(0):
+            for pizza in pizzas:
+                self.assertEqual(len(pizza.toppings.all()), len(self.toppings))
+
+
+# ------------------------------------- API TESTING ------------------------------------------- #
+class PizzaApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.mushrooms = Topping.objects.create(name='Mushrooms')
+        cls.margherita = Pizza.objects.create(name='Margherita')
+        cls.margherita.toppings.set([cls.pepperoni])
+
+        # Create a Chef user
+        cls.chef = User.objects.create_user(username='Chef', password='SupremeSlicesChef')
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
+
+    def setUp(self):
+        self.client.force_login(self.chef)
+
+    # Helper posting a bulk payload as JSON
+    def bulk(self, payload):
+        return self.client.post(reverse('api_pizzas_bulk'), payload, content_type='application/json')
+
+    # Test the topping filter of the list endpoint
+    def test_list_topping_filter(self):
+        hawaiian = Pizza.objects.create(name='Hawaiian')
+        hawaiian.toppings.set([self.pepperoni, self.mushrooms])
+        response = self.client.get(reverse('api_pizzas'), {'with': self.pepperoni.id, 'without': self.mushrooms.id})
+        self.assertEqual([pizza['name'] for pizza in response.json()['results']], ['Margherita'])
+        response = self.client.get(reverse('api_pizzas'), {'any': [self.mushrooms.id, 999]})
+        self.assertEqual([pizza['name'] for pizza in response.json()['results']], ['Hawaiian'])
+
+    # Test searching pizzas by topping and toppings for the picker
+    def test_search(self):
+        response = self.client.get(reverse('api_pizzas_search'), {'q': 'pepperoni'})
+        self.assertEqual([pizza['name'] for pizza in response.json()['results']], ['Margherita'])
+        response = self.client.get(reverse('api_chef_toppings_search'), {'q': 'mush'})
+        self.assertEqual(response.json(), {'results': [{'id': self.mushrooms.id, 'name': 'Mushrooms'}]})
+
+    # Test that the list endpoint includes toppings
+    def test_list(self):
+        response = self.client.get(reverse('api_pizzas'))
+        self.assertEqual(response.json()['results'], [{
+            'id': self.margherita.id,
+            'name': 'Margherita',
+            'toppings': [{'id': self.pepperoni.id, 'name': 'Pepperoni'}],
+        }])
+
+    # Test creating many pizzas with their toppings in one request, validated with a constant number of queries
+    def test_bulk_create(self):
+        toppings = [self.mushrooms.id] + [topping.id for topping in Topping.objects.bulk_create(
+            [Topping(name='Topping %d' % i) for i in range(8)])]
+        # 200 different recipes, all with mushrooms
+        recipes = [[toppings[0]] + [pk for bit, pk in enumerate(toppings[1:]) if i >> bit & 1] for i in range(200)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk({'create': [{'name': 'Pizza %d' % i, 'toppings': recipe}
+                                             for i, recipe in enumerate(recipes)]})
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 30)
+        self.assertEqual(len(response.json()['created']), 200)
+        self.assertEqual(Pizza.objects.count(), 201)
+        self.assertEqual(Pizza.toppings.through.objects.filter(topping=self.mushrooms).count(), 200)
+        self.assertEqual(Pizza.objects.get(name='Pizza 3').recipe_fingerprint, recipe_fingerprint(recipes[3]))
+
+    # Test that two items of one request cannot have the same recipe, nor an item the recipe of another pizza
+    def test_bulk_rejects_duplicate_recipes(self):
+        both = [self.pepperoni.id, self.mushrooms.id]
+        response = self.bulk({'create': [{'name': 'One', 'toppings': both}, {'name': 'Two', 'toppings': both[::-1]},
+                                         {'name': 'Three', 'toppings': [self.pepperoni.id]}]})
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']['create']
+        self.assertEqual(errors['1'], {'__all__': ["Another pizza in this request has exactly these toppings."]})
+        self.assertEqual(errors['2'], {'__all__': ["Margherita already has exactly these toppings."]})
+        self.assertNotIn('0', errors)
+        # An update may keep its own recipe
+        response = self.bulk({'update': [{'id': self.margherita.id, 'name': 'MARGHERITA',
+                                          'toppings': [self.pepperoni.id]}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Pizza.objects.count(), 1)
+
+    # Test updating and deleting pizzas
+    def test_bulk_update_and_delete(self):
+        hawaiian = Pizza.objects.create(name='Hawaiian')
+        pizzas = Pizza.objects.bulk_create([Pizza(name='Pizza %d' % i) for i in range(20)])
+        toppings = Topping.objects.bulk_create([Topping(name='Topping %d' % i) for i in range(10)])
+        version = MenuVersion.current()[0]
+        # Set-based writes: the number of queries does not grow with the number of items
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk({
+                'update': [{'id': self.margherita.id, 'name': 'Margherita', 'toppings': [self.mushrooms.id]}] + [
+                    {'id': pizza.id, 'name': 'Renamed %d' % i, 'toppings': [self.pepperoni.id, topping.id]}
+                    for i, (pizza, topping) in enumerate(zip(pizzas, toppings))],
+                'delete': [hawaiian.id] + [pizza.id for pizza in pizzas[10:]],
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), settings.REQUEST_QUERY_BUDGET)
+        self.assertEqual(list(self.margherita.toppings.all()), [self.mushrooms])
+        self.assertFalse(Pizza.objects.filter(pk=hawaiian.id).exists())
+        self.assertEqual(Pizza.objects.count(), 11)
+        self.assertEqual(Pizza.objects.get(name='Renamed 3').recipe_fingerprint,
+                         recipe_fingerprint([self.pepperoni.id, toppings[3].id]))
+        # One menu change for the whole request
+        self.assertEqual(MenuVersion.current()[0], version + 1)
+
+    # Test that bad ids are rejected, and that an object cannot be updated and deleted at once
+    def test_bulk_rejects_ids(self):
+        response = self.bulk({'delete': [[1], {'a': 1}, False], 'update': [{'id': [1], 'name': 'Calzone'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']['delete']), {'0', '1', '2'})
+        self.assertEqual(response.json()['errors']['update'], {'0': {'id': ['Must be an integer id.']}})
+        update = {'id': self.margherita.id, 'name': 'Calzone', 'toppings': [self.mushrooms.id]}
+        response = self.bulk({'update': [update], 'delete': [self.margherita.id]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors']['update'], {'0': {'id': ['Not found.']}})
+        self.assertTrue(Pizza.objects.filter(pk=self.margherita.id).exists())
+
+    # Test that PizzaForm validation applies to every item
+    def test_bulk_create_validates_items(self):
+        response = self.bulk({'create': [{'name': 'No Toppings', 'toppings': []},
+                                         {'name': 'Bad Topping', 'toppings': [9999]}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']['create']), {'0', '1'})
+        self.assertEqual(Pizza.objects.count(), 1)
+
+    # Test adding and removing toppings on the pizzas matching a filter, then on pizzas picked by id
+    def test_bulk_toppings(self):
+        olives = Topping.objects.create(name='Olives')
+        hawaiian = Pizza.objects.create(name='Hawaiian')
+        hawaiian.toppings.set([self.mushrooms])
+        url = reverse('api_pizzas_toppings_bulk')
+        response = self.client.post(url, {'filter': {'with': [self.pepperoni.id]}, 'add': [olives.id]},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'pizzas': 1, 'changed': 1, 'added': 1, 'removed': 0})
+        self.assertEqual(set(self.margherita.toppings.all()), {self.pepperoni, olives})
+        response = self.client.post(url, {'pizzas': [self.margherita.id, hawaiian.id], 'add': [olives.id],
+                                          'remove': [self.mushrooms.id]}, content_type='application/json')
+        self.assertEqual(response.json(), {'pizzas': 2, 'changed': 1, 'added': 1, 'removed': 1})
+        self.assertEqual(list(hawaiian.toppings.all()), [olives])
+        # The topping index and recipe fingerprints follow the change
+        response = self.client.get(reverse('api_pizzas'), {'with': olives.id, 'without': self.pepperoni.id})
+        self.assertEqual([pizza['name'] for pizza in response.json()['results']], ['Hawaiian'])
+        self.assertEqual(Pizza.objects.same_recipe([olives.id]).get(), hawaiian)
+
+    # Test that a change leaving pizzas empty or identical is rejected as a whole
+    def test_bulk_toppings_conflict(self):
+        hawaiian = Pizza.objects.create(name='Hawaiian')
+        hawaiian.toppings.set([self.pepperoni, self.mushrooms])
+        url = reverse('api_pizzas_toppings_bulk')
+        response = self.client.post(url, {'pizzas': [self.margherita.id], 'add': [self.mushrooms.id]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['errors']['duplicates'], [['Hawaiian', 'Margherita']])
+        response = self.client.post(url, {'pizzas': [self.margherita.id], 'remove': [self.pepperoni.id]},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['errors']['empty'], ['Margherita'])
+        self.assertEqual(list(self.margherita.toppings.all()), [self.pepperoni])
+        # Unknown toppings and missing selections are rejected before anything is written
+        response = self.client.post(url, {'pizzas': [hawaiian.id], 'add': [9999]}, content_type='application/json')
+        self.assertEqual(response.json()['errors'], {'toppings': [9999]})
+        response = self.client.post(url, {'add': [self.pepperoni.id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+# ------------------------------------- FRAGMENT RESPONSE TESTING ----------------------------- #
+class PizzaFragmentTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cheese = Topping.objects.create(name='Cheese')
+        cls.margherita = Pizza.objects.create(name='Margherita')
+        cls.margherita.toppings.set([cls.cheese])
+        cls.chef = User.objects.create_user(username='Chef', password='SupremeSlicesChef')
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
+
+    def setUp(self):
+        self.client.force_login(self.chef)
+        # The dashboard's fetch() calls send X-Requested-With, as jQuery does
+        self.headers = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+    # Test that creating a pizza answers with its card only, and a rejected one with a JSON error
+    def test_create(self):
+        ham = Topping.objects.create(name='Ham')
+        response = self.client.post(reverse('create_pizza'), {'name': 'Ham Pizza', 'toppings': [ham.id]},
+                                    **self.headers)
+        pizza = Pizza.objects.get(name='Ham Pizza')
+        self.assertContains(response, 'data-menu-id="%d"' % pizza.pk, status_code=201)
+        self.assertNotContains(response, 'Margherita', status_code=201)
+        response = self.client.post(reverse('create_pizza'), {'name': 'Cheese Pizza', 'toppings': [self.cheese.id]},
+                                    **self.headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "Margherita already has exactly these toppings.")
+
+    # Test that deleting a pizza answers with a JSON status
+    def test_delete(self):
+        response = self.client.post(reverse('delete_pizza', args=[self.margherita.id]), **self.headers)
+        self.assertEqual(response.json(), {'deleted': self.margherita.id})
+        self.assertFalse(Pizza.objects.exists())
+
+
 # ------------------------------------- PIZZA FORM TESTING ------------------------------------ #
 class PizzaFormTest(TestCase):
     @classmethod
@@ -201,7 +490,9 @@ class PizzaFormTest(TestCase):
         Pizza.objects.create(name='Margherita')
         form_data = {'name': 'Margherita', 'toppings': [self.pepperoni.id]}  # Trying to create a duplicate pizza
         form = PizzaForm(data=form_data)
-        self.assertFalse(form.is_valid())
+        # The database rejects the duplicate on save
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save_unique())
         self.assertTrue('name' in form.errors)
 
     # Test for name with leading and trailing whitespaces
@@ -227,6 +518,29 @@ class PizzaFormTest(TestCase):
         # Verify that the form is valid because this is not a duplicate pizza
         self.assertTrue(form.is_valid())
 
+    # Test that a recipe another pizza already has is rejected, in any order
+    def test_duplicate_recipe(self):
+        pizza = Pizza.objects.create(name='Funghi Pepperoni')
+        pizza.toppings.set([self.mushrooms, self.pepperoni])
+        form = PizzaForm(data={'name': 'Other Name', 'toppings': [self.pepperoni.id, self.mushrooms.id]})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.non_field_errors(), ["Funghi Pepperoni already has exactly these toppings."])
+        # Updating the pizza itself with its own toppings is fine
+        form = PizzaForm(data={'name': 'Funghi', 'toppings': [self.pepperoni.id, self.mushrooms.id]}, instance=pizza)
+        self.assertTrue(form.is_valid())
+
+    # Test that the stored fingerprint follows topping changes
+    def test_fingerprint_maintained(self):
+        pizza = Pizza.objects.create(name='Funghi')
+        self.assertEqual(pizza.recipe_fingerprint, '')
+        pizza.toppings.add(self.mushrooms)
+        self.assertEqual(list(Pizza.objects.same_recipe([self.mushrooms.id])), [pizza])
+        self.mushrooms.pizza_set.add(Pizza.objects.create(name='Mushroom Special'))
+        self.assertEqual(Pizza.objects.same_recipe([self.mushrooms.id]).count(), 2)
+        # Deleting the topping empties both recipes
+        self.mushrooms.delete()
+        self.assertEqual(set(Pizza.objects.values_list('recipe_fingerprint', flat=True)), {''})
+
 
 # ------------------------------------- AUTHENTICATION TESTING ------------------------------- #
 # Tests for Chef Login
@@ -237,6 +551,7 @@ class LoginTestCase(TestCase):
         cls.owner_username = 'Chef'
         cls.owner_password = 'SupremeSlicesChef'
         cls.owner = User.objects.create_user(username=cls.owner_username, password=cls.owner_password)
+        cls.owner.groups.add(Group.objects.get(name=CHEF))
 
     def test_valid_owner_login(self):
         # Attempt to log in as Chef with correct credentials
@@ -1,9 +1,16 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('dashboard/', views.chef_dashboard, name='chef_dashboard'),
     path('create/', views.create_pizza, name='create_pizza'),
     path('delete/<int:pizza_id>/', views.delete_pizza, name='delete_pizza'),
     path('update_pizza/<int:pizza_id>/', views.update_pizza, name='update_pizza'),
+    # JSON API
+    path('api/pizzas/', api.pizza_collection, name='api_pizzas'),
+    path('api/pizzas/bulk/', api.pizza_bulk, name='api_pizzas_bulk'),
+    path('api/pizzas/toppings/', api.pizza_toppings_bulk, name='api_pizzas_toppings_bulk'),
+    path('api/pizzas/search/', api.pizza_search, name='api_pizzas_search'),
+    path('api/toppings/search/', api.topping_search, name='api_chef_toppings_search'),
+    path('api/pizzas/<int:pizza_id>/', api.pizza_detail, name='api_pizza_detail'),
 ]
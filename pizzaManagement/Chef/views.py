@@ -1,57 +1,105 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.shortcuts import render, redirect
+from Owner.decorators import menu_conditional, read_menu_version
+from Owner.fragment_cache import render_pizza_cards
 from Owner.models import Topping, Pizza
+from Owner.pagination import KeysetPage, apaginate_by_name
+from Owner.search import search_pizzas
+from Owner.topping_index import parse_topping_filter, pizza_queryset, topping_index
+from Owner.shortcuts import adelete, aget_object_or_404, fragment_error, fragment_response, wants_fragment
 from .forms import PizzaForm
-from django.contrib.auth.decorators import login_required
 from .decorators import chef_required
 
 
+# Function: recipe_error
+# Parameters: form (PizzaForm) - a bound form that failed validation
+# Description: Gets the message of the duplicate recipe check (see PizzaForm.clean), if it failed.
+# Returns: str or None
+def recipe_error(form):
+    return ' '.join(form.non_field_errors()) or None
+
+
+# Function: selected_toppings
+# Parameters: toppings (dict) - Topping objects by id, ids (list of int) - toppings selected in one picker
+# Description: Gets the existing toppings of a picker selection, for rendering it (see topping_picker.html).
+# Returns: list of Topping
+def selected_toppings(toppings, ids):
+    return [toppings[pk] for pk in dict.fromkeys(ids) if pk in toppings]
+
+
 # Function: chef_dashboard
 # Parameters: request (HttpRequest)
-# Description: Renders the chef dashboard page with a form to create new pizzas, a list of existing pizzas,
-#              and a list of all toppings ordered alphabetically by name. Handles form submission to create new pizzas.
+# Description: Renders the chef dashboard page with a form to create new pizzas and a list of existing pizzas.
+#              Handles form submission to create new pizzas. Toppings are picked through the topping search API
+#              (topping_picker.html), only the toppings selected in the filter are loaded.
 #              Requires Chef authentication to access.
 # Returns: HttpResponse
 @chef_required
-@login_required
-def chef_dashboard(request):
+@menu_conditional
+async def chef_dashboard(request):
     # Initialize error_message as None
     error_message = None
     # Check if request method is POST
     if request.method == 'POST':
         # Create a form instance with the POST data
         form = PizzaForm(request.POST)
-        # Check if form is valid
-        if form.is_valid():
-            # Extract the name of the pizza from the form data
-            name = form.cleaned_data['name']
-            # If duplicate, set error message
-            if Pizza.objects.filter(name__iexact=name).exists():
-                error_message = "A pizza with this name already exists!"
-            # Else, save form and redirect to chef dashboard
-            else:
-                form.save()
+        # Check if form is valid (validation queries the database, so run it off the event loop)
+        if await sync_to_async(form.is_valid)():
+            # Save form and redirect to chef dashboard (a single insert, duplicates are rejected by the database)
+            if await sync_to_async(form.save_unique)():
                 return redirect('chef_dashboard')
+            # If duplicate, set error message
+            error_message = "A pizza with this name already exists!"
+        else:
+            # Report a recipe another pizza already has
+            error_message = recipe_error(form)
     # If not a POST request, initialize an empty form
     else:
         form = PizzaForm()
 
-    # Grab all currently populated pizzas from model
-    pizzas = Pizza.objects.all()
-    # Order toppings by name alphabetically
-    toppings = Topping.objects.order_by('name')
+    # Topping filter (?with= / ?any= / ?without= topping ids), answered by the in-process topping index
+    all_of, any_of, none_of = parse_topping_filter(request.GET)
+    match = None
+    if all_of or any_of or none_of:
+        match = await sync_to_async(topping_index.match)(all_of, any_of, none_of)
+    # Keep the filter when following the pagination links
+    page_params = urlencode([(key, value) for key in ('with', 'any', 'without') for value in request.GET.getlist(key)])
+
+    # Grab the searched pizzas, or the requested page of pizzas, and their (cached) cards
+    query = request.GET.get('q', '').strip()
+    if query:
+        # The topping filter restricts the search itself, before its limit
+        results = await sync_to_async(search_pizzas)(query, pizza_ids=None if match is None else match.ids())
+        page = KeysetPage(results)
+    else:
+        pizzas = Pizza.objects.all() if match is None else pizza_queryset(match)
+        page = await apaginate_by_name(pizzas, request.GET.get('after'), request.GET.get('before'))
+    # Cached cards are read (and missing ones rendered) off the event loop
+    pizza_cards = await sync_to_async(render_pizza_cards)(page.object_list, read_menu_version(request))
+    # Toppings selected in the filter pickers, one query whatever the number of toppings on the menu
+    selected = await sync_to_async(Topping.objects.in_bulk)(all_of + any_of + none_of)
 
-    # Render the request to chef_dashboard with all context {pizzas, form, toppings, any errors}
-    return render(request, 'chef_dashboard.html', {'pizzas': pizzas, 'form': form, 'all_toppings': toppings,
-                                                   'error_message': error_message})
+    # Render the request to chef_dashboard with all context {pizzas, form, selected toppings, any errors}
+    return render(request, 'chef_dashboard.html', {'pizzas': page.object_list, 'page': page,
+                                                   'pizza_cards': pizza_cards,
+                                                   'form': form, 'query': query,
+                                                   'filter_with': selected_toppings(selected, all_of),
+                                                   'filter_any': selected_toppings(selected, any_of),
+                                                   'filter_without': selected_toppings(selected, none_of),
+                                                   'page_params': page_params, 'error_message': error_message})
 
 
 # Function: create_pizza
 # Parameters: request (HttpRequest)
 # Description: Handles the creation of a new pizza. Validates form input, checks for duplicate pizza names,
 #              and saves the new pizza if it does not already exist.
+#              Requests from the dashboard script get the new pizza's card (201) or a JSON error instead.
 # Returns: HttpResponse
 @chef_required
-def create_pizza(request):
+async def create_pizza(request):
     # Initialize error message to None
     error_message = None
     # Check if HTTP request method is POST
@@ -59,43 +107,48 @@ def create_pizza(request):
         # Create PizzaForm instance with POST data
         form = PizzaForm(request.POST)
         # Check if form is valid
-        if form.is_valid():
-            # Get cleaned name from form
-            name = form.clean_name()
-            # Check if pizza name already exists
-            if Pizza.objects.filter(name__iexact=name).exists():
-                # Set error message if pizza name already exists
-                error_message = "A pizza with this name already exists!"
-            else:
-                # Save form data and redirect to chef dashboard
-                form.save()
+        if await sync_to_async(form.is_valid)():
+            # Save form data and redirect to chef dashboard (or answer with the new card)
+            pizza = await sync_to_async(form.save_unique)()
+            if pizza and wants_fragment(request):
+                cards = await sync_to_async(render_pizza_cards)([pizza])
+                return fragment_response(cards[0], status=201)
+            if pizza:
                 return redirect('chef_dashboard')
-        else:
-            # Set error message if form is invalid
+            # Set error message if pizza name already exists
             error_message = "A pizza with this name already exists!"
+        else:
+            # Set error message if form is invalid (a recipe another pizza already has, or a duplicate name)
+            error_message = recipe_error(form) or "A pizza with this name already exists!"
+        if wants_fragment(request):
+            return fragment_error(error_message, form)
     else:
         # If not a POST request, initialize an empty form
         form = PizzaForm()
 
-    # Retrieve all pizzas and toppings ordered alphabetically
-    pizzas = Pizza.objects.all()
-    toppings = Topping.objects.order_by('name')
+    # Retrieve the first page of pizzas (and their cached cards)
+    page = await apaginate_by_name(Pizza.objects.all())
+    pizza_cards = await sync_to_async(render_pizza_cards)(page.object_list)
 
-    # Render chef dashboard with form, pizzas, toppings, and error message
-    return render(request, 'chef_dashboard.html', {'pizzas': pizzas, 'form': form, 'all_toppings': toppings,
-                                                   'error_message': error_message})
+    # Render chef dashboard with form, pizzas, and error message
+    return render(request, 'chef_dashboard.html', {'pizzas': page.object_list, 'page': page,
+                                                   'pizza_cards': pizza_cards,
+                                                   'form': form, 'error_message': error_message})
 
 
 # Function: delete_pizza
 # Parameters: request (HttpRequest), pizza_id (int)
 # Description: Deletes a pizza with the given pizza_id.
+#              Requests from the dashboard script get a JSON status instead of the redirect.
 # Returns: HttpResponse
 @chef_required
-def delete_pizza(request, pizza_id):
+async def delete_pizza(request, pizza_id):
     # Get the pizza object with the given pizza_id or return a 404 error if not found
-    pizza = get_object_or_404(Pizza, pk=pizza_id)
+    pizza = await aget_object_or_404(Pizza.objects.all(), pk=pizza_id)
     # Delete the pizza object
-    pizza.delete()
+    await adelete(pizza)
+    if wants_fragment(request):
+        return JsonResponse({'deleted': pizza_id})
     # Redirect to the chef dashboard
     return redirect('chef_dashboard')
 
@@ -105,33 +158,36 @@ def delete_pizza(request, pizza_id):
 # Description: Allows the Chef to update an existing pizza with the given pizza_id.
 # Returns: HttpResponse
 @chef_required
-def update_pizza(request, pizza_id):
+async def update_pizza(request, pizza_id):
     # Get the pizza object with the given pizza_id or return a 404 error if not found
-    pizza = get_object_or_404(Pizza, pk=pizza_id)
-    # Get all toppings ordered by name alphabetically
-    available_toppings = Topping.objects.order_by('name')
-    # Get the toppings selected for the pizza
-    selected_toppings = pizza.toppings.all()
+    pizza = await aget_object_or_404(Pizza.objects.with_toppings(), pk=pizza_id)
+    # The toppings of the pizza (already prefetched) start the picker's selection, others are searched for
+    toppings = list(pizza.toppings.all())
+    # Initialize error message to None
+    error_message = None
 
     # Check if HTTP request method is POST
     if request.method == 'POST':
         # Create a PizzaForm instance with POST data and the pizza instance
         form = PizzaForm(request.POST, instance=pizza)
         # Check if form is valid
-        if form.is_valid():
+        if await sync_to_async(form.is_valid)():
             # Save the form and redirect to the chef dashboard
-            form.save()
-            return redirect('chef_dashboard')
+            if await sync_to_async(form.save_unique)():
+                return redirect('chef_dashboard')
+        else:
+            # Report a recipe another pizza already has
+            error_message = recipe_error(form)
     else:
         # If not a POST request, create a form with the pizza instance
         form = PizzaForm(instance=pizza)
 
-    # Prepare context with pizza object, form, available toppings, and selected toppings
+    # Prepare context with pizza object, form, and selected toppings
     context = {
         'pizza': pizza,
         'form': form,
-        'available_toppings': available_toppings,
-        'selected_toppings': selected_toppings,
+        'selected_toppings': toppings,
+        'error_message': error_message,
     }
     # Render the update_pizza.html template with the context
     return render(request, 'update_pizza.html', context)
@@ -0,0 +1,393 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+from pizzaManagement.database import retry_on_lock
+
+from . import fragment_cache
+from .bulk_edit import merge_toppings
+from .decorators import owner_required
+from .deletion import delete_toppings, deletion_impact
+from .forms import ToppingForm
+from .models import Pizza, Topping
+from .pagination import paginate_by_name
+from .search import DEFAULT_LIMIT, search_toppings
+from .serializers import serialize_topping
+from .signals import collect_menu_changes, notify_menu_changed
+from .topping_index import filter_in
+
+# Default maximum number of items a single bulk request may touch
+DEFAULT_BULK_LIMIT = 500
+
+
+# Class: ApiError
+# Description: Raised while handling an API request to abort it with a JSON error response.
+class ApiError(Exception):
+    def __init__(self, message, status=400, errors=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.errors = errors
+
+    # Function: response
+    # Parameters: self
+    # Description: Builds the JSON error response for this error.
+    # Returns: JsonResponse
+    def response(self):
+        payload = {'error': self.message}
+        if self.errors:
+            payload['errors'] = self.errors
+        return JsonResponse(payload, status=self.status)
+
+
+# Function: parse_json_body
+# Parameters: request (HttpRequest)
+# Description: Decodes the JSON object sent in the request body.
+# Returns: dict, raises ApiError if the body is not a JSON object.
+def parse_json_body(request):
+    try:
+        payload = json.loads(request.body or b'{}')
+    except (ValueError, UnicodeDecodeError):
+        raise ApiError("Request body must be valid JSON.")
+    if not isinstance(payload, dict):
+        raise ApiError("Request body must be a JSON object.")
+    return payload
+
+
+# Function: page_response
+# Parameters:
+#   - request (HttpRequest): may carry ?after= / ?before= cursors
+#   - queryset: Topping or Pizza queryset to list
+#   - serialize: function converting one row into a dict
+# Description: Lists one keyset paginated page of the queryset as JSON.
+# Returns: JsonResponse
+def page_response(request, queryset, serialize):
+    page = paginate_by_name(queryset, request.GET.get('after'), request.GET.get('before'))
+    return JsonResponse({
+        'results': [serialize(obj) for obj in page],
+        'next': page.next_cursor,
+        'previous': page.prev_cursor,
+    })
+
+
+# Function: search_response
+# Parameters:
+#   - request (HttpRequest): carries the search as ?q= and optionally ?limit=
+#   - search: search_toppings or search_pizzas
+#   - serialize: function converting one row into a dict
+# Description: Runs a full-text search and returns the ranked results as JSON.
+# Returns: JsonResponse
+def search_response(request, search, serialize):
+    results = search(request.GET.get('q', ''), request.GET.get('limit', DEFAULT_LIMIT))
+    return JsonResponse({'results': [serialize(obj) for obj in results]})
+
+
+# Function: detail_response
+# Parameters:
+#   - queryset: Topping or Pizza queryset to look the object up in
+#   - pk (int): primary key of the object
+#   - serialize: function converting the object into a dict
+# Description: Returns a single object as JSON, or a JSON 404 if it does not exist.
+# Returns: JsonResponse
+def detail_response(queryset, pk, serialize):
+    obj = queryset.filter(pk=pk).first()
+    if obj is None:
+        return ApiError("Not found.", status=404).response()
+    return JsonResponse(serialize(obj))
+
+
+# Function: _form_errors
+# Parameters: form (Form) - a bound form that failed validation
+# Description: Converts the form errors into plain lists of messages per field.
+# Returns: dict
+def _form_errors(form):
+    return {field: list(messages) for field, messages in form.errors.items()}
+
+
+# Function: _item_list
+# Parameters: payload (dict), key (str)
+# Description: Returns the list stored under key in a bulk payload.
+# Returns: list, raises ApiError if the value is not a list.
+def _item_list(payload, key):
+    items = payload.get(key, [])
+    if not isinstance(items, list):
+        raise ApiError("'%s' must be a list." % key)
+    return items
+
+
+# Function: _bulk_create
+# Parameters:
+#   - model: Topping or Pizza
+#   - forms: validated create forms
+# Description: Inserts all new objects with one bulk_create, then inserts the rows of their
+#              many-to-many relations (e.g. Pizza.toppings) with one bulk_create per relation.
+# Returns: list of the primary keys of the created objects
+def _bulk_create(model, forms):
+    instances = model.objects.bulk_create([form.save(commit=False) for form in forms])
+    for field in model._meta.many_to_many:
+        # Skip relations the form does not edit
+        if field.name not in forms[0].cleaned_data:
+            continue
+        through = field.remote_field.through
+        source = field.m2m_field_name() + '_id'
+        target = field.m2m_reverse_field_name() + '_id'
+        through.objects.bulk_create([
+            through(**{source: instance.pk, target: related.pk})
+            for form, instance in zip(forms, instances)
+            for related in form.cleaned_data[field.name]
+        ])
+    pks = [instance.pk for instance in instances]
+    # bulk_create does not send model signals
+    if model is Pizza:
+        notify_menu_changed(pizza_ids=pks)
+    else:
+        notify_menu_changed(topping_ids=pks)
+    return pks
+
+
+# Function: _bulk_update
+# Parameters:
+#   - model: Topping or Pizza
+#   - forms: validated update forms
+# Description: Saves all updated objects with one bulk_update of their fields, then replaces the rows of
+#              their many-to-many relations with one DELETE and one bulk_create per relation.
+# Returns: list of the primary keys of the updated objects
+def _bulk_update(model, forms):
+    instances = [form.save(commit=False) for form in forms]
+    model.objects.bulk_update(instances, [field.name for field in model._meta.concrete_fields
+                                          if not field.primary_key])
+    pks = [instance.pk for instance in instances]
+    for field in model._meta.many_to_many:
+        # Skip relations the form does not edit
+        if field.name not in forms[0].cleaned_data:
+            continue
+        through = field.remote_field.through
+        source = field.m2m_field_name() + '_id'
+        target = field.m2m_reverse_field_name() + '_id'
+        filter_in(through.objects.all(), source, pks).delete()
+        through.objects.bulk_create([through(**{source: instance.pk, target: related.pk})
+                                     for form, instance in zip(forms, instances)
+                                     for related in form.cleaned_data[field.name]])
+    # bulk_update sends no model signals; the recipe fingerprints were set by the forms
+    if model is Pizza:
+        notify_menu_changed(pizza_ids=pks)
+    else:
+        # A renamed topping changes the cards of the pizzas using it
+        links = filter_in(Pizza.toppings.through.objects.all(), 'topping_id', pks)
+        notify_menu_changed(pizza_ids=links.values_list('pizza_id', flat=True), topping_ids=pks)
+    return pks
+
+
+# Function: _is_id
+# Parameters: value - raw value of a JSON payload
+# Description: Checks the value is an integer id (JSON true and false are not).
+# Returns: bool
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Function: bulk_write
+# Parameters:
+#   - request (HttpRequest): POST request with a JSON body of the form
+#       {"create": [{fields}], "update": [{"id": 1, fields}], "delete": [ids]}
+#   - queryset: Topping or Pizza queryset used to look objects up and to serialize the results
+#   - form_class: ToppingForm or PizzaForm, used to validate every created or updated item
+#   - serialize: function converting one object into a dict
+#   - delete: function deleting objects by id with set-based statements (see Owner.deletion)
+# Description: Applies all deletes, updates and creates of the request in one transaction. Deletes run
+#              first so their names can be reused. Every item is validated with the regular form, against
+#              lookups made once for the whole batch (form_class.bulk_context: existing names, toppings and
+#              recipes), and names and recipes must also be unique within the request. If any item is
+#              invalid nothing is written and the errors are returned by operation and index. Ids must be
+#              integers. Updated objects are saved with bulk_update and new ones inserted with bulk_create
+#              instead of one save per item, and the menu version is bumped once for the whole request.
+#              The transaction is run again if the database is locked by another writer.
+# Returns: JsonResponse
+@retry_on_lock
+def bulk_write(request, queryset, form_class, serialize, delete):
+    try:
+        payload = parse_json_body(request)
+        creates = _item_list(payload, 'create')
+        updates = _item_list(payload, 'update')
+        deletes = _item_list(payload, 'delete')
+        limit = getattr(settings, 'API_BULK_LIMIT', DEFAULT_BULK_LIMIT)
+        if len(creates) + len(updates) + len(deletes) > limit:
+            raise ApiError("A bulk request may contain at most %d items." % limit, status=413)
+        if not all(isinstance(item, dict) for item in creates + updates):
+            raise ApiError("'create' and 'update' items must be JSON objects.")
+        # Ids are hashed and looked up below: reject anything else before
+        bad_ids = {}
+        for index, pk in enumerate(deletes):
+            if not _is_id(pk):
+                bad_ids.setdefault('delete', {})[index] = ["Must be an integer id."]
+        for index, item in enumerate(updates):
+            if not _is_id(item.get('id')):
+                bad_ids.setdefault('update', {})[index] = {'id': ["Must be an integer id."]}
+        if bad_ids:
+            raise ApiError("Some ids are invalid.", errors=bad_ids)
+        model = queryset.model
+
+        # One menu change for the whole request, whatever the number of items
+        with transaction.atomic(), collect_menu_changes():
+            errors = {}
+
+            # Every object to delete or update is loaded with one query
+            objects = queryset.in_bulk(deletes + [item['id'] for item in updates])
+
+            # Deletes: set-based statements, after checking every id exists
+            found = set(deletes) & set(objects)
+            missing = {index: ["Not found."] for index, pk in enumerate(deletes) if pk not in found}
+            if missing:
+                errors['delete'] = missing
+            elif found:
+                delete(list(found))
+
+            # Lookups shared by every item, after the deletes so their names and recipes can be reused
+            bulk = form_class.bulk_context(creates + updates)
+
+            # Updates: validate each with the form
+            update_forms = []
+            for index, item in enumerate(updates):
+                instance = objects.get(item['id'])
+                if instance is None or instance.pk in found:
+                    errors.setdefault('update', {})[index] = {'id': ["Not found."]}
+                    continue
+                form = form_class(item, instance=instance, bulk=bulk)
+                if not form.is_valid():
+                    errors.setdefault('update', {})[index] = _form_errors(form)
+                update_forms.append((index, form))
+
+            # Creates: validate each with the form
+            create_forms = []
+            for index, item in enumerate(creates):
+                form = form_class(item, bulk=bulk)
+                if not form.is_valid():
+                    errors.setdefault('create', {})[index] = _form_errors(form)
+                create_forms.append((index, form))
+
+            # Names (and recipes) must also be unique within the request itself
+            seen = set()
+            for operation, forms in (('update', update_forms), ('create', create_forms)):
+                for index, form in forms:
+                    for field, key, message in form.batch_keys():
+                        if key in seen:
+                            errors.setdefault(operation, {}).setdefault(index, {field: [message]})
+                        seen.add(key)
+
+            if errors:
+                # Raising inside the transaction rolls back the deletes already applied
+                raise ApiError("Some items are invalid.", errors=errors)
+
+            updated = _bulk_update(model, [form for index, form in update_forms]) if update_forms else []
+            created = _bulk_create(model, [form for index, form in create_forms]) if create_forms else []
+    except ApiError as error:
+        return error.response()
+    except IntegrityError:
+        # A concurrent request took one of the names after validation
+        return ApiError("Some items conflict with existing data, please retry.", status=409).response()
+
+    # Both lists are read back with one query
+    objects = queryset.in_bulk(created + updated)
+    return JsonResponse({
+        'created': [serialize(objects[pk]) for pk in created],
+        'updated': [serialize(objects[pk]) for pk in updated],
+        'deleted': sorted(found),
+    })
+
+
+# Function: topping_collection
+# Parameters: request (HttpRequest)
+# Description: API endpoint listing toppings as JSON, one keyset paginated page at a time.
+#              Requires Owner authentication to access.
+# Returns: JsonResponse
+@owner_required
+@require_GET
+def topping_collection(request):
+    return page_response(request, Topping.objects.all(), serialize_topping)
+
+
+# Function: topping_search
+# Parameters: request (HttpRequest)
+# Description: API endpoint searching toppings by name (prefix and typo tolerant), best matches first.
+# Returns: JsonResponse
+@owner_required
+@require_GET
+def topping_search(request):
+    return search_response(request, search_toppings, serialize_topping)
+
+
+# Function: topping_detail
+# Parameters: request (HttpRequest), topping_id (int)
+# Description: API endpoint returning a single topping as JSON.
+# Returns: JsonResponse
+@owner_required
+@require_GET
+def topping_detail(request, topping_id):
+    return detail_response(Topping.objects.all(), topping_id, serialize_topping)
+
+
+# Function: topping_bulk
+# Parameters: request (HttpRequest)
+# Description: API endpoint creating, updating and deleting many toppings in one transaction.
+# Returns: JsonResponse
+@owner_required
+@require_POST
+def topping_bulk(request):
+    return bulk_write(request, Topping.objects.all(), ToppingForm, serialize_topping, delete=delete_toppings)
+
+
+# Function: topping_deletion_impact
+# Parameters: request (HttpRequest), topping_id (int)
+# Description: API endpoint previewing the deletion of a topping: how many pizzas use it, how many would be
+#              left without toppings, and the names of a few of them. Shown before the owner confirms.
+# Returns: JsonResponse
+@owner_required
+@require_GET
+def topping_deletion_impact(request, topping_id):
+    if not Topping.objects.filter(pk=topping_id).exists():
+        return ApiError("Not found.", status=404).response()
+    return JsonResponse(deletion_impact([topping_id]))
+
+
+# Function: topping_merge
+# Parameters: request (HttpRequest) - POST request with a JSON body of the form
+#       {"into": topping id, "toppings": [ids of the duplicates], "name": optional new name}
+# Description: API endpoint merging near-duplicate toppings into one: their pizzas get the canonical topping
+#              instead and the duplicates are deleted, in one transaction. Returns the merge summary, with
+#              the pizzas that now share the same toppings.
+# Returns: JsonResponse
+@owner_required
+@require_POST
+def topping_merge(request):
+    try:
+        payload = parse_json_body(request)
+        into, merged, name = payload.get('into'), _item_list(payload, 'toppings'), payload.get('name')
+        if not _is_id(into) or not merged or not all(_is_id(pk) for pk in merged):
+            raise ApiError("'into' must be a topping id and 'toppings' a list of topping ids.")
+        if name is not None and not isinstance(name, str):
+            raise ApiError("'name' must be a string.")
+        if not set(merged) - {into}:
+            raise ApiError("'toppings' must name at least one topping other than 'into'.")
+        ids = {into, *merged}
+        missing = ids - set(Topping.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        if missing:
+            raise ApiError("Some toppings do not exist.", status=404, errors={'toppings': sorted(missing)})
+        summary = retry_on_lock(merge_toppings)(into, merged, name)
+    except ApiError as error:
+        return error.response()
+    except ValidationError as error:
+        return ApiError("The new name is invalid.", errors=error.message_dict).response()
+    return JsonResponse(summary)
+
+
+# Function: fragment_cache_stats
+# Parameters: request (HttpRequest)
+# Description: API endpoint reporting the hit / miss counters of the dashboard fragment cache.
+# Returns: JsonResponse
+@owner_required
+@require_GET
+def fragment_cache_stats(request):
+    return JsonResponse(fragment_cache.stats())
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class OwnerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Owner'
+
+    def ready(self):
+        # Connect the menu change receivers and the user / role cache receivers
+        from . import fragment_cache, live, roles, signals, snapshot, topping_index  # noqa: F401
+        from .change_log import install_change_log
+        from .search import install_search_index
+        # Create (or repair) the full-text search index and the change log triggers after migrations
+        post_migrate.connect(install_search_index, sender=self)
+        post_migrate.connect(install_change_log, sender=self)
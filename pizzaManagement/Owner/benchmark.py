@@ -0,0 +1,405 @@
+import itertools
+import math
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+
+from django.db import close_old_connections, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import Pizza, Topping, recipe_fingerprint
+from .signals import notify_menu_changed
+
+# Words the synthetic topping and pizza names are made of
+TOPPING_STYLES = ['Fresh', 'Smoked', 'Roasted', 'Grilled', 'Spicy', 'Sweet', 'Pickled', 'Aged', 'Crispy',
+                  'Marinated', 'Wild', 'Sun-Dried', 'Caramelized', 'Garlic', 'Truffle']
+TOPPING_INGREDIENTS = ['Mozzarella', 'Pepperoni', 'Mushrooms', 'Onions', 'Peppers', 'Olives', 'Basil', 'Ham',
+                       'Pineapple', 'Sausage', 'Bacon', 'Spinach', 'Tomatoes', 'Artichokes', 'Anchovies',
+                       'Chicken', 'Jalapenos', 'Ricotta', 'Gorgonzola', 'Parmesan', 'Arugula', 'Salami',
+                       'Prosciutto', 'Eggplant', 'Zucchini', 'Corn', 'Feta', 'Capers', 'Oregano', 'Chorizo']
+PIZZA_STYLES = ['Classic', 'Supreme', 'Rustic', 'Neapolitan', 'Sicilian', 'Roman', 'Deluxe', 'Garden',
+                'Fiery', 'Smoky', 'Royal', 'Country', 'Harbor', 'Mountain', 'Midnight']
+PIZZA_NAMES = ['Margherita', 'Marinara', 'Diavola', 'Capricciosa', 'Quattro Formaggi', 'Hawaiian', 'Calzone',
+               'Ortolana', 'Boscaiola', 'Bianca', 'Carbonara', 'Primavera', 'Napoli', 'Tonno', 'Funghi']
+
+# Topping popularity follows a Zipf law: the topping of rank r is used in proportion to 1 / r ** ZIPF_EXPONENT,
+# so a few toppings (cheese, tomato) are on most pizzas and most toppings are on few
+ZIPF_EXPONENT = 1.1
+# Toppings per pizza: normally distributed around the mean, clamped to [1, max]
+DEFAULT_MEAN_TOPPINGS = 4
+TOPPINGS_STDDEV = 1.5
+DEFAULT_MAX_TOPPINGS = 12
+# Rows per bulk insert while generating
+GENERATE_BATCH_SIZE = 5000
+# Recipes drawn at most to find one no pizza has
+FRESH_RECIPE_ATTEMPTS = 100
+
+
+# Function: _names
+# Parameters: styles (list of str), names (list of str)
+# Description: Generates distinct names "<style> <name>", then "<style> <name> 2", "... 3" and so on.
+# Returns: iterator of str
+def _names(styles, names):
+    for round_number in itertools.count(1):
+        suffix = '' if round_number == 1 else ' %d' % round_number
+        for style in styles:
+            for name in names:
+                yield '%s %s%s' % (style, name, suffix)
+
+
+# Class: SyntheticMenu
+# Description: A generated menu: the ids of its toppings (most popular first) and of its pizzas, and the
+#              random generator and settings used to draw new recipes from it.
+class SyntheticMenu:
+    def __init__(self, topping_ids, pizza_ids, rng, mean_toppings=DEFAULT_MEAN_TOPPINGS,
+                 max_toppings=DEFAULT_MAX_TOPPINGS):
+        self.topping_ids = topping_ids
+        self.pizza_ids = pizza_ids
+        self.rng = rng
+        self.mean_toppings = mean_toppings
+        self.max_toppings = max_toppings
+        # Recipes are drawn from the toppings generated (delete requests shrink topping_ids, they run last)
+        self._popular = list(topping_ids)
+        self._cum_weights = list(itertools.accumulate(1 / rank ** ZIPF_EXPONENT
+                                                      for rank in range(1, len(topping_ids) + 1)))
+        self._counter = itertools.count(1)
+
+    # Function: recipe
+    # Parameters: self
+    # Description: Draws the toppings of one pizza: a normally distributed number of distinct toppings,
+    #              picked according to their popularity.
+    # Returns: list of topping ids
+    def recipe(self):
+        size = round(self.rng.gauss(self.mean_toppings, TOPPINGS_STDDEV))
+        size = max(1, min(size, self.max_toppings, len(self._popular)))
+        chosen = set()
+        while len(chosen) < size:
+            chosen.update(self.rng.choices(self._popular, cum_weights=self._cum_weights, k=size - len(chosen)))
+        return sorted(chosen)
+
+    # Function: fresh_recipe
+    # Parameters: self
+    # Description: Draws a recipe no pizza has yet (see PizzaForm.clean), for create / update requests.
+    #              Gives up after FRESH_RECIPE_ATTEMPTS draws on tiny menus, the request then fails.
+    # Returns: list of topping ids
+    def fresh_recipe(self):
+        for _ in range(FRESH_RECIPE_ATTEMPTS):
+            recipe = self.recipe()
+            if not Pizza.objects.same_recipe(recipe).exists():
+                break
+        return recipe
+
+    # Function: unique_name
+    # Parameters: self, kind (str) - 'Topping' or 'Pizza'
+    # Description: A name no generated item has, for create requests.
+    # Returns: str
+    def unique_name(self, kind):
+        return 'Benchmark %s %d' % (kind, next(self._counter))
+
+    # Function: fork
+    # Parameters: self, seed (int)
+    # Description: A view of the same menu with its own random generator, for another thread. Forks share
+    #              the name counter (itertools.count is thread safe), so their unique names never clash.
+    # Returns: SyntheticMenu
+    def fork(self, seed):
+        menu = SyntheticMenu(self.topping_ids, self.pizza_ids, random.Random(seed), self.mean_toppings,
+                             self.max_toppings)
+        menu._counter = self._counter
+        return menu
+
+
+# Function: generate_menu
+# Parameters:
+#   - toppings (int): number of toppings to create
+#   - pizzas (int): number of pizzas to create
+#   - seed (int): seed of the random generator, the same seed generates the same menu
+#   - mean_toppings (int): average number of toppings per pizza
+#   - max_toppings (int): maximum number of toppings per pizza
+# Description: Fills an empty menu with synthetic toppings and pizzas, using bulk inserts. Topping
+#              popularity follows a Zipf law and pizza sizes a normal law (see ZIPF_EXPONENT).
+# Returns: SyntheticMenu
+def generate_menu(toppings, pizzas, seed=0, mean_toppings=DEFAULT_MEAN_TOPPINGS, max_toppings=DEFAULT_MAX_TOPPINGS):
+    rng = random.Random(seed)
+    with transaction.atomic():
+        topping_names = _names(TOPPING_STYLES, TOPPING_INGREDIENTS)
+        topping_ids = []
+        for start in range(0, toppings, GENERATE_BATCH_SIZE):
+            batch = [Topping(name=next(topping_names)) for _ in range(min(GENERATE_BATCH_SIZE, toppings - start))]
+            topping_ids.extend(topping.pk for topping in Topping.objects.bulk_create(batch))
+        # Shuffle so popularity does not follow the alphabetical order of the names
+        rng.shuffle(topping_ids)
+        menu = SyntheticMenu(topping_ids, [], rng, mean_toppings, max_toppings)
+
+        pizza_names = _names(PIZZA_STYLES, PIZZA_NAMES)
+        through = Pizza.toppings.through
+        fingerprints = set()
+        for start in range(0, pizzas if topping_ids else 0, GENERATE_BATCH_SIZE):
+            recipes = []
+            for _ in range(min(GENERATE_BATCH_SIZE, pizzas - start)):
+                # Like PizzaForm, avoid recipes another pizza has (unless the menu is too small for that)
+                for _ in range(FRESH_RECIPE_ATTEMPTS):
+                    recipe = menu.recipe()
+                    if recipe_fingerprint(recipe) not in fingerprints:
+                        break
+                fingerprints.add(recipe_fingerprint(recipe))
+                recipes.append(recipe)
+            created = Pizza.objects.bulk_create([
+                Pizza(name=next(pizza_names), recipe_fingerprint=recipe_fingerprint(recipe)) for recipe in recipes
+            ])
+            through.objects.bulk_create([
+                through(pizza_id=pizza.pk, topping_id=topping_id)
+                for pizza, recipe in zip(created, recipes)
+                for topping_id in recipe
+            ])
+            menu.pizza_ids.extend(pizza.pk for pizza in created)
+        # bulk_create does not send model signals
+        notify_menu_changed(pizza_ids=menu.pizza_ids, topping_ids=topping_ids)
+    return menu
+
+
+# Class: Endpoint
+# Description: A benchmarked page. prepare(menu) picks the arguments of the next request and returns
+#              (method, path, data); it runs outside the timed section. role is the user sending it
+#              ('Chef' or 'Owner'), expected the status code of a successful request.
+Endpoint = namedtuple('Endpoint', ['name', 'role', 'prepare', 'expected'])
+
+
+# Function: _take
+# Parameters: ids (list of int), rng (Random)
+# Description: Removes a random id from the list (for delete requests).
+# Returns: int
+def _take(ids, rng):
+    index = rng.randrange(len(ids))
+    ids[index], ids[-1] = ids[-1], ids[index]
+    return ids.pop()
+
+
+# Function: _created_pizza
+# Parameters: menu (SyntheticMenu)
+# Description: POST data creating a pizza with a new name and a recipe no pizza has.
+# Returns: dict
+def _created_pizza(menu):
+    return {'name': menu.unique_name('Pizza'), 'toppings': menu.fresh_recipe()}
+
+
+# Function: _updated_pizza
+# Parameters: menu (SyntheticMenu)
+# Description: Request updating a random pizza with a new name and recipe.
+# Returns: (method, path, data)
+def _updated_pizza(menu):
+    pizza_id = menu.rng.choice(menu.pizza_ids)
+    return 'post', reverse('update_pizza', args=[pizza_id]), _created_pizza(menu)
+
+
+# Endpoints in the order they are benchmarked: pages first, then the writes, deletes last.
+# Menus without pizzas skip the endpoints needing one.
+ENDPOINTS = [
+    Endpoint('chef_dashboard', 'Chef', lambda menu: ('get', reverse('chef_dashboard'), None), 200),
+    Endpoint('chef_dashboard_filtered', 'Chef',
+             lambda menu: ('get', reverse('chef_dashboard'), {'with': menu.topping_ids[0]}), 200),
+    Endpoint('owner_dashboard', 'Owner', lambda menu: ('get', reverse('owner_dashboard'), None), 200),
+    Endpoint('update_pizza_form', 'Chef',
+             lambda menu: ('get', reverse('update_pizza', args=[menu.rng.choice(menu.pizza_ids)]), None), 200),
+    Endpoint('update_pizza', 'Chef', _updated_pizza, 302),
+    Endpoint('create_pizza', 'Chef', lambda menu: ('post', reverse('create_pizza'), _created_pizza(menu)), 302),
+    Endpoint('add_topping', 'Owner',
+             lambda menu: ('post', reverse('add_topping'), {'name': menu.unique_name('Topping')}), 302),
+    Endpoint('delete_pizza', 'Chef',
+             lambda menu: ('post', reverse('delete_pizza', args=[_take(menu.pizza_ids, menu.rng)]), None), 302),
+    Endpoint('delete_topping', 'Owner',
+             lambda menu: ('post', reverse('delete_topping', args=[_take(menu.topping_ids, menu.rng)]), None), 302),
+]
+ENDPOINT_NAMES = [endpoint.name for endpoint in ENDPOINTS]
+# Endpoints that need at least one pizza (delete_pizza also consumes one per request)
+PIZZA_ENDPOINTS = {'update_pizza_form', 'update_pizza', 'delete_pizza'}
+
+
+# Function: percentile
+# Parameters: ordered (sorted list of numbers), fraction (float between 0 and 1)
+# Description: Nearest-rank percentile of a sorted sample.
+# Returns: number
+def percentile(ordered, fraction):
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(len(ordered) * fraction) - 1))]
+
+
+# Function: summarize
+# Parameters:
+#   - latencies: list of request durations in seconds
+#   - statuses: list of response status codes
+#   - elapsed: wall clock duration of the whole run in seconds
+#   - expected: status codes of successful requests
+# Description: Computes the throughput and latency figures of one benchmark run.
+# Returns: dict
+def summarize(latencies, statuses, elapsed, expected=(200,)):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for status in statuses if status not in expected),
+        'requests_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(statistics.mean(ordered) * 1000, 2),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+    }
+
+
+# Function: _send
+# Parameters: client (Client), request ((method, path, data))
+# Description: Sends one prepared request.
+# Returns: HttpResponse
+def _send(client, request):
+    method, path, data = request
+    return getattr(client, method)(path, data)
+
+
+# Function: benchmark_endpoint
+# Parameters:
+#   - endpoint (Endpoint): page to benchmark
+#   - client (Client): test client logged in as endpoint.role
+#   - menu (SyntheticMenu): generated menu the requests are drawn from
+#   - requests (int): number of timed requests
+#   - warmup (int): untimed requests sent first to fill caches
+#   - profiled (int): extra requests sent with query capture and tracemalloc on, to count the SQL queries
+#     and the peak Python memory of one request (kept out of the timed requests, tracemalloc is slow)
+# Description: Benchmarks one endpoint through the Django test client.
+# Returns: dict (see summarize) with queries (max per request) and peak_kib (max per request)
+def benchmark_endpoint(endpoint, client, menu, requests, warmup=0, profiled=3):
+    for _ in range(warmup):
+        _send(client, endpoint.prepare(menu))
+
+    latencies, statuses = [], []
+    for _ in range(requests):
+        request = endpoint.prepare(menu)
+        sent = time.perf_counter()
+        response = _send(client, request)
+        latencies.append(time.perf_counter() - sent)
+        statuses.append(response.status_code)
+    # Throughput counts the time spent in the client only, not preparing the requests
+    result = summarize(latencies, statuses, sum(latencies), (endpoint.expected,))
+
+    queries, peaks = [], []
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        for _ in range(profiled):
+            request = endpoint.prepare(menu)
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            with CaptureQueriesContext(connection) as captured:
+                _send(client, request)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            queries.append(len(captured))
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    result['queries'] = max(queries) if queries else None
+    result['peak_kib'] = round(max(peaks) / 1024, 1) if peaks else None
+    return result
+
+
+# Endpoints of the concurrency benchmark: pages read by chefs and owners, and the writes they make
+# concurrently. Deletes are left out, they consume the menu.
+CONCURRENT_READS = ['chef_dashboard', 'owner_dashboard', 'update_pizza_form']
+CONCURRENT_WRITES = ['create_pizza', 'update_pizza', 'add_topping']
+
+
+# Function: _concurrent_worker
+# Parameters:
+#   - clients (dict): test client per role
+#   - menu (SyntheticMenu): fork of the menu for this thread
+#   - write_ratio (float): share of write requests
+#   - start (threading.Barrier): released when every worker is ready
+#   - deadline (list of float): perf_counter() time to stop at, set once the workers are released
+#   - samples (list): (latency, status, is_write) of every request, appended to
+# Description: Sends random reads and writes until the deadline. Every request ends like it would in a
+#              server (close_old_connections(), which the test client skips), so CONN_MAX_AGE is honoured.
+# Returns: None
+def _concurrent_worker(clients, menu, write_ratio, start, deadline, samples):
+    endpoints = {endpoint.name: endpoint for endpoint in ENDPOINTS}
+    try:
+        start.wait()
+        while time.perf_counter() < deadline[0]:
+            is_write = menu.rng.random() < write_ratio
+            endpoint = endpoints[menu.rng.choice(CONCURRENT_WRITES if is_write else CONCURRENT_READS)]
+            request = endpoint.prepare(menu)
+            sent = time.perf_counter()
+            response = _send(clients[endpoint.role], request)
+            close_old_connections()
+            samples.append((time.perf_counter() - sent, response.status_code, is_write))
+    finally:
+        connection.close()
+
+
+# Function: benchmark_concurrency
+# Parameters:
+#   - clients (list of dict): test clients per role, one dict per worker thread
+#   - menu (SyntheticMenu): generated menu the requests are drawn from
+#   - duration (float): seconds to run for
+#   - write_ratio (float): share of write requests, e.g. 0.2
+#   - seed (int): seed of the random generators of the workers
+# Description: Sends a mix of reads and writes from one thread per client for the given duration, like
+#              chefs and owners using the site at the same time. Failed requests (500: "database is
+#              locked") count as errors.
+# Returns: dict (see summarize) with the write requests summarized under 'writes'
+def benchmark_concurrency(clients, menu, duration, write_ratio=0.2, seed=0):
+    samples = []
+    start = threading.Barrier(len(clients) + 1)
+    deadline = [math.inf]
+    workers = [
+        threading.Thread(target=_concurrent_worker,
+                         args=(worker_clients, menu.fork(seed + index), write_ratio, start, deadline, samples))
+        for index, worker_clients in enumerate(clients)
+    ]
+    for worker in workers:
+        worker.start()
+    started = time.perf_counter()
+    deadline[0] = started + duration
+    start.wait()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    if not samples:
+        return {'requests': 0}
+
+    expected = (200, 302)
+    result = summarize([latency for latency, status, is_write in samples],
+                       [status for latency, status, is_write in samples], elapsed, expected)
+    writes = [(latency, status) for latency, status, is_write in samples if is_write]
+    if writes:
+        result['writes'] = summarize([latency for latency, status in writes],
+                                     [status for latency, status in writes], elapsed, expected)
+    return result
+
+
+# Function: compare_results
+# Parameters:
+#   - baseline (dict): results of an earlier run (as saved by benchmark_views)
+#   - current (dict): results of this run
+#   - threshold (float): tolerated relative p95 increase, e.g. 0.2 for +20%
+#   - floor_ms (float): p95 increases smaller than this are treated as noise
+# Description: Finds the endpoints that got slower or run more queries than in the baseline, at every
+#              scale both runs measured.
+# Returns: list of messages, empty if nothing regressed
+def compare_results(baseline, current, threshold=0.2, floor_ms=1.0):
+    regressions = []
+    for scale, run in current.get('scales', {}).items():
+        before_run = baseline.get('scales', {}).get(scale)
+        if before_run is None:
+            continue
+        for name, result in run['endpoints'].items():
+            before = before_run['endpoints'].get(name)
+            if before is None:
+                continue
+            if (result['p95_ms'] > before['p95_ms'] * (1 + threshold)
+                    and result['p95_ms'] - before['p95_ms'] > floor_ms):
+                regressions.append("%s @ %s: p95 %.2f ms -> %.2f ms" % (name, scale, before['p95_ms'],
+                                                                        result['p95_ms']))
+            if None not in (result['queries'], before['queries']) and result['queries'] > before['queries']:
+                regressions.append("%s @ %s: %d -> %d queries" % (name, scale, before['queries'],
+                                                                  result['queries']))
+    return regressions
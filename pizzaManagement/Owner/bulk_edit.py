@@ -0,0 +1,145 @@
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, Value
+
+from .deletion import delete_rows
+from .forms import ToppingForm
+from .models import Pizza, Topping, refresh_recipe_fingerprints
+from .signals import notify_menu_changed
+from .topping_index import filter_in
+
+# Maximum number of conflicting pizzas named in a RecipeConflict
+CONFLICT_SAMPLE_SIZE = 10
+
+
+# Class: RecipeConflict
+# Description: Raised by apply_topping_changes when the change would leave pizzas without toppings or give
+#              several pizzas exactly the same toppings. Nothing has been written when it is raised.
+class RecipeConflict(Exception):
+    def __init__(self, empty, duplicates):
+        super().__init__("The change would leave pizzas without toppings or with the same toppings.")
+        # Names of pizzas left without toppings
+        self.empty = empty
+        # Lists of names of pizzas sharing the same toppings
+        self.duplicates = duplicates
+
+
+# Function: _conflicts
+# Parameters: pizza_ids (list of int) - pizzas whose toppings just changed, fingerprints already refreshed
+# Description: Finds the changed pizzas left without toppings, and the groups of pizzas sharing the topping
+#              set of a changed pizza (one aggregate on the indexed fingerprint). At most CONFLICT_SAMPLE_SIZE
+#              of each are returned.
+# Returns: (list of names, list of lists of names)
+def _conflicts(pizza_ids):
+    changed = filter_in(Pizza.objects.order_by(), 'pk', pizza_ids)
+    empty = list(changed.filter(recipe_fingerprint='').values_list('name', flat=True)[:CONFLICT_SAMPLE_SIZE])
+    fingerprints = changed.exclude(recipe_fingerprint='').values('recipe_fingerprint')
+    shared = list(Pizza.objects.order_by().filter(recipe_fingerprint__in=fingerprints)
+                  .values('recipe_fingerprint').annotate(pizzas=Count('pk')).filter(pizzas__gt=1)
+                  .values_list('recipe_fingerprint', flat=True)[:CONFLICT_SAMPLE_SIZE])
+    duplicates = {}
+    for fingerprint, name in (Pizza.objects.filter(recipe_fingerprint__in=shared)
+                              .values_list('recipe_fingerprint', 'name')):
+        duplicates.setdefault(fingerprint, []).append(name)
+    return empty, [duplicates[fingerprint] for fingerprint in shared]
+
+
+# Function: apply_topping_changes
+# Parameters:
+#   - pizza_ids (list of int): pizzas to edit, ids of missing pizzas are ignored
+#   - add (list of int): ids of existing toppings to put on every selected pizza
+#   - remove (list of int): ids of toppings to take off every selected pizza
+# Description: Adds and removes toppings on many pizzas in one transaction with set-based statements on the
+#              pizza / topping link table instead of one pizza.toppings.add() / remove() per pizza: one DELETE
+#              for the removed links, one SELECT of the links already there and one bulk INSERT of the new
+#              ones. The recipe fingerprints of the pizzas whose toppings changed are then refreshed and
+#              menu_changed is sent once. The change is rolled back with RecipeConflict if a pizza would be
+#              left without toppings or with the same toppings as another pizza (see PizzaForm.clean).
+# Returns: dict with pizzas (selected), changed (pizzas whose toppings changed), added and removed (links)
+def apply_topping_changes(pizza_ids, add=(), remove=()):
+    through = Pizza.toppings.through
+    with transaction.atomic():
+        pizza_ids = list(filter_in(Pizza.objects.order_by(), 'pk', set(pizza_ids)).values_list('pk', flat=True))
+        changed = set()
+        removed = 0
+        if remove and pizza_ids:
+            links = filter_in(through.objects.filter(topping_id__in=set(remove)), 'pizza_id', pizza_ids)
+            changed.update(links.values_list('pizza_id', flat=True).distinct())
+            # The link model has no delete signal nor relations: QuerySet.delete() runs a single DELETE
+            removed, _ = links.delete()
+        added = 0
+        if add and pizza_ids:
+            existing = set(filter_in(through.objects.filter(topping_id__in=set(add)), 'pizza_id', pizza_ids)
+                           .values_list('pizza_id', 'topping_id'))
+            new_links = [through(pizza_id=pizza_id, topping_id=topping_id)
+                         for pizza_id in pizza_ids for topping_id in set(add)
+                         if (pizza_id, topping_id) not in existing]
+            through.objects.bulk_create(new_links)
+            changed.update(link.pizza_id for link in new_links)
+            added = len(new_links)
+        if changed:
+            refresh_recipe_fingerprints(changed)
+            empty, duplicates = _conflicts(list(changed))
+            if empty or duplicates:
+                # Raising inside the transaction rolls the links back
+                raise RecipeConflict(empty, duplicates)
+            # bulk_create and QuerySet.delete() do not send m2m_changed
+            notify_menu_changed(pizza_ids=changed)
+    return {'pizzas': len(pizza_ids), 'changed': len(changed), 'added': added, 'removed': removed}
+
+
+# Function: merge_toppings
+# Parameters:
+#   - topping_id (int): id of the canonical topping the others are merged into
+#   - merged_ids (list of int): ids of the duplicate toppings to merge, then delete
+#   - name (str): optional new name for the canonical topping, e.g. the name of one of the duplicates
+# Description: Merges near-duplicate toppings ("Mushroom", "Mushrooms") into one in a single transaction, with
+#              set-based statements whatever the number of pizzas: one INSERT ... SELECT giving the canonical
+#              topping to the pizzas that only had a duplicate, one DELETE of the duplicates' links and one
+#              of the duplicates. The recipe fingerprints of the affected pizzas are then refreshed and
+#              menu_changed is sent once. Pizzas that end up with the same toppings are reported, not rejected:
+#              the duplicates made them different recipes only in name.
+#              Nothing is changed, nor renamed, when merged_ids names no other topping.
+# Returns: dict with topping, merged (toppings deleted), pizzas (affected), added and removed (links) and
+#          duplicates (lists of names of pizzas now sharing the same toppings), raises ValidationError if the
+#          new name is invalid.
+def merge_toppings(topping_id, merged_ids, name=None):
+    through = Pizza.toppings.through
+    merged_ids = set(merged_ids) - {topping_id}
+    if not merged_ids:
+        return {'topping': topping_id, 'merged': 0, 'pizzas': 0, 'added': 0, 'removed': 0, 'duplicates': []}
+    with transaction.atomic():
+        links = through.objects.filter(topping_id__in=merged_ids)
+        pizza_ids = set(links.values_list('pizza_id', flat=True).distinct())
+        # Pizzas that had a duplicate but not the canonical topping get a link to it, computed by the database
+        missing = (links.exclude(pizza_id__in=through.objects.filter(topping_id=topping_id).values('pizza_id'))
+                   .annotate(target=Value(topping_id)).values_list('pizza_id', 'target').distinct())
+        sql, params = missing.query.sql_with_params()
+        connection = connections[router.db_for_write(through)]
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO %s (%s, %s) %s' % (
+                quote(through._meta.db_table), quote(through._meta.get_field('pizza').column),
+                quote(through._meta.get_field('topping').column), sql), params)
+            added = cursor.rowcount
+        # The link model has no delete signal nor relations: QuerySet.delete() runs a single DELETE
+        removed, _ = links.delete()
+        # As in delete_toppings: the links are gone, one DELETE without the topping delete receivers
+        merged = delete_rows(Topping.objects.filter(pk__in=merged_ids))
+        if name is not None:
+            # Validated once the duplicates are gone, so the canonical topping can take one of their names
+            form = ToppingForm({'name': name}, instance=Topping.objects.get(pk=topping_id))
+            if not form.is_valid():
+                raise ValidationError(form.errors)
+            try:
+                # update() sends no post_save: the change is announced below with the rest of the merge
+                with transaction.atomic():
+                    Topping.objects.filter(pk=topping_id).update(name=form.cleaned_data['name'])
+            except IntegrityError:
+                # The name is held by another topping, the unique constraint is only checked here
+                raise ValidationError({'name': [form.duplicate_name_message]})
+        refresh_recipe_fingerprints(pizza_ids)
+        duplicates = _conflicts(list(pizza_ids))[1] if pizza_ids else []
+        notify_menu_changed(pizza_ids=pizza_ids, topping_ids=merged_ids | {topping_id})
+    return {'topping': topping_id, 'merged': merged, 'pizzas': len(pizza_ids), 'added': added,
+            'removed': removed, 'duplicates': duplicates}
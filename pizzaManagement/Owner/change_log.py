@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import Min
+
+from .models import MenuChange, Pizza, Topping
+from .topping_index import filter_in
+
+# Default and maximum number of log rows read by one changes_since() call
+DEFAULT_LIMIT = 5000
+MAX_LIMIT = 20000
+
+# Default number of log rows kept, overridden by MENU_CHANGE_LOG_RETENTION
+DEFAULT_RETENTION = 100000
+
+# Aliases of the databases the change log triggers are known to exist in
+_available = set()
+
+
+# Function: _tables
+# Parameters: None
+# Description: Table names used by the trigger SQL.
+# Returns: dict
+def _tables():
+    return {
+        'log': MenuChange._meta.db_table,
+        'topping': Topping._meta.db_table,
+        'pizza': Pizza._meta.db_table,
+        'through': Pizza.toppings.through._meta.db_table,
+    }
+
+
+# SQL appending a row to the log: kind, SQL expression of the object id, and 1 for a tombstone
+_LOG_SQL = "INSERT INTO {log}(kind, object_id, deleted) VALUES ('%s', %s, %d); "
+
+# Triggers logging every write to the menu tables in the transaction of the write, including bulk_create,
+# set-based deletes and raw SQL. Renaming a topping does not log its pizzas: they list topping ids, not names.
+TRIGGERS = {
+    'menu_change_topping_ai': "AFTER INSERT ON {topping} BEGIN "
+                              + _LOG_SQL % (MenuChange.TOPPING, 'NEW.id', 0) + "END",
+    'menu_change_topping_au': "AFTER UPDATE OF name ON {topping} BEGIN "
+                              + _LOG_SQL % (MenuChange.TOPPING, 'NEW.id', 0) + "END",
+    'menu_change_topping_ad': "AFTER DELETE ON {topping} BEGIN "
+                              + _LOG_SQL % (MenuChange.TOPPING, 'OLD.id', 1) + "END",
+    'menu_change_pizza_ai': "AFTER INSERT ON {pizza} BEGIN "
+                            + _LOG_SQL % (MenuChange.PIZZA, 'NEW.id', 0) + "END",
+    'menu_change_pizza_au': "AFTER UPDATE OF name ON {pizza} BEGIN "
+                            + _LOG_SQL % (MenuChange.PIZZA, 'NEW.id', 0) + "END",
+    'menu_change_pizza_ad': "AFTER DELETE ON {pizza} BEGIN "
+                            + _LOG_SQL % (MenuChange.PIZZA, 'OLD.id', 1) + "END",
+    'menu_change_pizza_toppings_ai': "AFTER INSERT ON {through} BEGIN "
+                                     + _LOG_SQL % (MenuChange.PIZZA, 'NEW.pizza_id', 0) + "END",
+    'menu_change_pizza_toppings_ad': "AFTER DELETE ON {through} BEGIN "
+                                     + _LOG_SQL % (MenuChange.PIZZA, 'OLD.pizza_id', 0) + "END",
+}
+
+# Trigger pruning the log: every tenth of the retention, the rows older than the retention are deleted, so
+# the log holds between retention and 1.1 x retention rows. Recreated when the retention changes.
+PRUNE_TRIGGER = 'menu_change_prune'
+_PRUNE_SQL = ("AFTER INSERT ON {log} WHEN NEW.sequence %% %(interval)d = 0 BEGIN "
+              "DELETE FROM {log} WHERE sequence <= NEW.sequence - %(retention)d; END")
+
+# SQL seeding the log with an entry per existing topping and pizza
+_SEED_SQL = ("INSERT INTO {log}(kind, object_id, deleted) SELECT '%s', id, 0 FROM {topping} ORDER BY id; "
+             % MenuChange.TOPPING,
+             "INSERT INTO {log}(kind, object_id, deleted) SELECT '%s', id, 0 FROM {pizza} ORDER BY id; "
+             % MenuChange.PIZZA)
+
+
+# Function: _prune_trigger_sql
+# Parameters: tables (dict) - see _tables
+# Description: CREATE TRIGGER statement of the prune trigger for the current MENU_CHANGE_LOG_RETENTION.
+# Returns: str
+def _prune_trigger_sql(tables):
+    retention = max(1, getattr(settings, 'MENU_CHANGE_LOG_RETENTION', DEFAULT_RETENTION))
+    return ("CREATE TRIGGER %s " % PRUNE_TRIGGER) + (_PRUNE_SQL % {
+        'interval': max(1, retention // 10), 'retention': retention}).format(**tables)
+
+
+# Function: ensure_change_log
+# Parameters: using (str) - database alias
+# Description: Creates the change log triggers that are missing. Runs after every migrate: SQLite migrations
+#              that rebuild a table drop its triggers, which are restored here. Writes made while a trigger
+#              was missing are not in the log, so clients are told to resync (see changes_since). The log
+#              then starts with an entry per existing topping and pizza, so a first sync from 0 gets the
+#              whole menu, including on a database that had a menu before the log existed. The prune
+#              trigger is (re)created for the current retention. Only SQLite databases have the triggers.
+# Returns: True if the change log is available
+def ensure_change_log(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or MenuChange._meta.db_table not in connection.introspection.table_names():
+        return False
+    tables = _tables()
+    prune_sql = _prune_trigger_sql(tables)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")
+        existing = dict(cursor.fetchall())
+        missing = [name for name in TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(("CREATE TRIGGER %s " % name) + TRIGGERS[name].format(**tables))
+        if missing:
+            if latest_sequence(using):
+                # Some writes may have gone unlogged: clear the log and skip a sequence number, so every client
+                # position is then older than the log and gets a reset
+                MenuChange.objects.using(using).all().delete()
+                cursor.execute("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = %s", [tables['log']])
+            for sql in _SEED_SQL:
+                cursor.execute(sql.format(**tables))
+        if existing.get(PRUNE_TRIGGER) != prune_sql:
+            cursor.execute("DROP TRIGGER IF EXISTS %s" % PRUNE_TRIGGER)
+            cursor.execute(prune_sql)
+    _available.add(using)
+    return True
+
+
+# Function: install_change_log
+# Parameters: sender (AppConfig), using (str) - database alias, kwargs
+# Description: post_migrate receiver creating or repairing the change log triggers of the migrated database.
+# Returns: None
+def install_change_log(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    ensure_change_log(using)
+
+
+# Function: change_log_available
+# Parameters: using (str) - database alias
+# Description: Checks whether the change log triggers exist in the database.
+# Returns: bool
+def change_log_available(using=DEFAULT_DB_ALIAS):
+    if using not in _available:
+        connection = connections[using]
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)"
+                               % ', '.join(['%s'] * len(TRIGGERS)), list(TRIGGERS))
+                if cursor.fetchone()[0] == len(TRIGGERS):
+                    _available.add(using)
+    return using in _available
+
+
+# Function: latest_sequence
+# Parameters: using (str) - database alias
+# Description: Position of the last change logged, even if the log was pruned since (SQLite keeps the largest
+#              AUTOINCREMENT value handed out), 0 if nothing was ever logged. Read it in the transaction that
+#              reads the menu, so the menu and the position match.
+# Returns: int
+def latest_sequence(using=DEFAULT_DB_ALIAS):
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [MenuChange._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+# Function: changes_since
+# Parameters:
+#   - since (int): last sequence number the client has applied, 0 for none
+#   - limit (int): maximum number of log rows read; the client asks again for the rest
+# Description: Reads the changes logged after since, in one transaction on the primary database. Changes to
+#              the same object are merged: the client gets the current state of every changed topping
+#              ([id, name]) and pizza ([id, name, [topping ids]]), and the ids of those deleted (tombstones).
+#              If since is ahead of the log, or older than its first row (the log was cleared or pruned),
+#              the client cannot catch up from it and gets reset instead: it must reload the whole menu
+#              (e.g. /menu/snapshot/, which carries the matching sequence number).
+# Returns: dict with since, next (the sequence to ask from next time), more (other changes follow), reset,
+#          and toppings and pizzas, each {"updated": [...], "deleted": [ids]}
+def changes_since(since, limit=DEFAULT_LIMIT):
+    database = router.db_for_write(MenuChange)
+    limit = max(1, min(limit, MAX_LIMIT))
+    with transaction.atomic(using=database):
+        log = MenuChange.objects.using(database)
+        latest = latest_sequence(database)
+        # Oldest change still logged; past the latest one when the log is empty
+        first = log.aggregate(first=Min('sequence'))['first'] or latest + 1
+        result = {'since': since, 'next': latest, 'more': False, 'reset': False,
+                  'toppings': {'updated': [], 'deleted': []}, 'pizzas': {'updated': [], 'deleted': []}}
+        if since > latest or since < first - 1:
+            result['reset'] = True
+            return result
+        rows = list(log.filter(sequence__gt=since).order_by('sequence')
+                    .values_list('sequence', 'kind', 'object_id', 'deleted')[:limit + 1])
+        result['more'] = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            result['next'] = rows[-1][0]
+        # Latest entry of every changed object
+        changed = {(kind, object_id): deleted for sequence, kind, object_id, deleted in rows}
+        topping_ids = [pk for (kind, pk), deleted in changed.items() if kind == MenuChange.TOPPING and not deleted]
+        pizza_ids = [pk for (kind, pk), deleted in changed.items() if kind == MenuChange.PIZZA and not deleted]
+        # Objects deleted after the last row read come back as tombstones later: current state wins here
+        toppings = dict(filter_in(Topping.objects.using(database), 'pk', topping_ids).values_list('pk', 'name'))
+        pizzas = dict(filter_in(Pizza.objects.using(database), 'pk', pizza_ids).values_list('pk', 'name'))
+        recipes = {}
+        for pizza_id, topping_id in (filter_in(Pizza.toppings.through.objects.using(database), 'pizza_id', pizzas)
+                                     .order_by('topping_id').values_list('pizza_id', 'topping_id')):
+            recipes.setdefault(pizza_id, []).append(topping_id)
+    for (kind, pk), deleted in sorted(changed.items()):
+        if kind == MenuChange.TOPPING:
+            if pk in toppings:
+                result['toppings']['updated'].append([pk, toppings[pk]])
+            else:
+                result['toppings']['deleted'].append(pk)
+        elif pk in pizzas:
+            result['pizzas']['updated'].append([pk, pizzas[pk], recipes.get(pk, [])])
+        else:
+            result['pizzas']['deleted'].append(pk)
+    return result
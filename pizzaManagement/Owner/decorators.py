@@ -1,20 +1,139 @@
+import asyncio
+import hashlib
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
 from django.http import HttpResponseForbidden
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import MenuVersion
+from .roles import OWNER, has_role
+
+
+# Function: _is_owner
+# Parameters: request (HttpRequest)
+# Description: Checks if the user of the request is authenticated and has the owner role.
+# Returns: bool
+def _is_owner(request):
+    return has_role(request, OWNER)
 
 
 # Function: owner_required
 # Parameters:
-#   - view_func: The view function to be wrapped
+#   - view_func: The view function to be wrapped (sync or async)
 # Description: Decorator function that checks if the user is authenticated and is an owner.
 #              If the user is authenticated and is an owner, the wrapped view function is called.
 #              Otherwise, returns an HTTP 403 Forbidden response.
+#              Async views get an async wrapper, so they stay coroutines under ASGI.
 # Returns: The wrapped view function.
 def owner_required(view_func):
+    if asyncio.iscoroutinefunction(view_func):
+        async def async_wrapped_view(request, *args, **kwargs):
+            # Loading the lazy request.user may read the session and user tables, so check it off the event loop
+            if await sync_to_async(_is_owner)(request):
+                # Call the view function
+                return await view_func(request, *args, **kwargs)
+            # Return HTTP 403 Forbidden response if not authenticated or not an owner
+            return HttpResponseForbidden("You don't have permission to access this page.")
+        return async_wrapped_view
+
     def wrapped_view(request, *args, **kwargs):
         # Check if the user is authenticated and is an owner
-        if request.user.is_authenticated and request.user.username == 'Owner':
+        if _is_owner(request):
             # Call the view function
             return view_func(request, *args, **kwargs)
         else:
             # Return HTTP 403 Forbidden response if not authenticated or not an owner
             return HttpResponseForbidden("You don't have permission to access this page.")
     return wrapped_view
+
+
+# Function: _menu_etag
+# Parameters:
+#   - request (HttpRequest)
+#   - version (int): current menu version
+# Description: Builds the ETag of a dashboard page. Besides the menu version the page depends on the user
+#              and on the CSRF token embedded in its forms, so both are hashed into the tag as well.
+# Returns: str (quoted entity tag)
+def _menu_etag(request, version):
+    user_id = request.user.pk if request.user.is_authenticated else ''
+    # Set by CsrfViewMiddleware from the cookie, or by get_token() when the page creates a new one
+    csrf_cookie = request.META.get('CSRF_COOKIE') or request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+    digest = hashlib.sha1(('%s:%s:%s' % (request.get_full_path(), user_id, csrf_cookie)).encode('utf-8'))
+    return '"menu-%d-%s"' % (version, digest.hexdigest()[:16])
+
+
+# Function: read_menu_version
+# Parameters: request (HttpRequest)
+# Description: The MenuVersion menu_conditional read for this request, for views that would otherwise read it
+#              again (see Owner.fragment_cache.render_fragments).
+# Returns: (version, updated_at) tuple, None if it was not read (not a GET / HEAD request)
+def read_menu_version(request):
+    if getattr(request, 'menu_version', None) is None:
+        return None
+    return request.menu_version, request.menu_updated_at
+
+
+# Function: menu_conditional
+# Parameters:
+#   - view_func: The view function to be wrapped (sync or async)
+# Description: Decorator for pages rendered from the menu. GET / HEAD requests carrying a matching
+#              If-None-Match (or If-Modified-Since) are answered with 304 Not Modified after a single
+#              MenuVersion lookup, without running the view or touching the pizza and topping tables.
+#              Full responses get ETag / Last-Modified headers and must be revalidated before reuse.
+#              Apply it inside owner_required / chef_required, which load request.user beforehand.
+# Returns: The wrapped view function.
+def menu_conditional(view_func):
+    # Function: finish
+    # Parameters: response (HttpResponse), etag (str), last_modified (int timestamp or None)
+    # Description: Adds the validators and cache headers to a full or 304 response.
+    # Returns: HttpResponse
+    def finish(response, etag, last_modified):
+        if response.status_code in (200, 304):
+            response.headers.setdefault('ETag', etag)
+            if last_modified is not None:
+                response.headers.setdefault('Last-Modified', http_date(last_modified))
+            # The page is per user: browsers may keep it but must revalidate it on every visit
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    if asyncio.iscoroutinefunction(view_func):
+        async def async_wrapped_view(request, *args, **kwargs):
+            # Only safe requests can be answered from the client's copy
+            if request.method not in ('GET', 'HEAD'):
+                return await view_func(request, *args, **kwargs)
+
+            version, updated_at = await MenuVersion.acurrent()
+            # The version the page shows, where its live updates start from (see Owner.live)
+            request.menu_version = version
+            request.menu_updated_at = updated_at
+            etag = _menu_etag(request, version)
+            last_modified = int(updated_at.timestamp()) if updated_at else None
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = await view_func(request, *args, **kwargs)
+                # Rendering may have created the CSRF token, tag the page with the token it embeds
+                etag = _menu_etag(request, version)
+            return finish(response, etag, last_modified)
+        return async_wrapped_view
+
+    def wrapped_view(request, *args, **kwargs):
+        # Only safe requests can be answered from the client's copy
+        if request.method not in ('GET', 'HEAD'):
+            return view_func(request, *args, **kwargs)
+
+        version, updated_at = MenuVersion.current()
+        # The version the page shows, where its live updates start from (see Owner.live)
+        request.menu_version = version
+        request.menu_updated_at = updated_at
+        etag = _menu_etag(request, version)
+        last_modified = int(updated_at.timestamp()) if updated_at else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view_func(request, *args, **kwargs)
+            # Rendering may have created the CSRF token, tag the page with the token it embeds
+            etag = _menu_etag(request, version)
+        return finish(response, etag, last_modified)
+    return wrapped_view
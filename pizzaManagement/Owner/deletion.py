@@ -0,0 +1,95 @@
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Q
+
+from .models import Pizza, Topping, refresh_recipe_fingerprints
+from .signals import notify_menu_changed
+
+# Maximum number of affected pizzas named in a deletion preview
+PREVIEW_SAMPLE_SIZE = 10
+
+
+# Function: deletion_impact
+# Parameters: topping_ids (list of int)
+# Description: Previews what deleting the given toppings would change, with aggregate queries only (three
+#              queries whatever the number of pizzas involved): the pizzas losing a topping, the links
+#              removed, the pizzas left without any topping and the names of a few affected pizzas.
+# Returns: dict with toppings, pizzas, links, emptied and sample
+def deletion_impact(topping_ids):
+    through = Pizza.toppings.through
+    links = through.objects.filter(topping_id__in=topping_ids)
+    counts = links.aggregate(links=Count('pk'), pizzas=Count('pizza_id', distinct=True))
+    # Pizzas all of whose links are removed: count each affected pizza's links, and the removed ones
+    emptied = (through.objects.filter(pizza_id__in=links.values('pizza_id'))
+               .values('pizza_id')
+               .annotate(total=Count('pk'), removed=Count('pk', filter=Q(topping_id__in=topping_ids)))
+               .filter(total=F('removed'))
+               .count())
+    sample = list(Pizza.objects.filter(pk__in=links.values('pizza_id'))
+                  .values_list('name', flat=True)[:PREVIEW_SAMPLE_SIZE])
+    return {
+        'toppings': len(set(topping_ids)),
+        'pizzas': counts['pizzas'],
+        'links': counts['links'],
+        'emptied': emptied,
+        'sample': sample,
+    }
+
+
+# Function: delete_rows
+# Parameters: queryset - rows to delete
+# Description: Deletes the rows of a queryset with one explicit DELETE ... WHERE pk IN (SELECT ...), without the
+#              ORM collector, which loads every row to send the model delete signals. Use it only once the rows
+#              have no related rows left; callers announce the change themselves with notify_menu_changed.
+# Returns: int - number of rows deleted
+def delete_rows(queryset):
+    model = queryset.model
+    using = router.db_for_write(model)
+    connection = connections[using]
+    try:
+        sql, params = queryset.order_by().values('pk').query.get_compiler(using=using).as_sql()
+    except EmptyResultSet:
+        # e.g. pk__in=[]: nothing to delete
+        return 0
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            quote(model._meta.db_table), quote(model._meta.pk.column), sql), params)
+        return cursor.rowcount
+
+
+# Function: delete_toppings
+# Parameters: topping_ids (list of int)
+# Description: Deletes the given toppings with set-based statements instead of Model.delete(), which loads
+#              and deletes every pizza link of a topping through the ORM collector: one DELETE for all their
+#              pizza links, one for the toppings. The recipe fingerprints of the affected pizzas are then
+#              refreshed and menu_changed is sent once, as the model signals are bypassed.
+# Returns: (number of toppings deleted, set of affected pizza ids)
+def delete_toppings(topping_ids):
+    with transaction.atomic():
+        links = Pizza.toppings.through.objects.filter(topping_id__in=topping_ids)
+        pizza_ids = set(links.values_list('pizza_id', flat=True).distinct())
+        # The link model has no delete signal nor relations: QuerySet.delete() runs a single DELETE
+        links.delete()
+        toppings = Topping.objects.filter(pk__in=topping_ids)
+        deleted_ids = list(toppings.values_list('pk', flat=True))
+        # The links are already gone, the search index follows through its triggers
+        deleted = delete_rows(toppings)
+        refresh_recipe_fingerprints(pizza_ids)
+        notify_menu_changed(pizza_ids=pizza_ids, topping_ids=deleted_ids)
+    return deleted, pizza_ids
+
+
+# Function: delete_pizzas
+# Parameters: pizza_ids (list of int)
+# Description: Deletes the given pizzas with two set-based statements, one for their topping links and one
+#              for the pizzas, instead of the ORM collector, which loads every pizza and sends menu_changed
+#              once per pizza. menu_changed is sent once for all of them.
+# Returns: int - number of pizzas deleted
+def delete_pizzas(pizza_ids):
+    # No savepoint of its own: a failure rolls back the caller's whole transaction
+    with transaction.atomic(savepoint=False):
+        Pizza.toppings.through.objects.filter(pizza_id__in=pizza_ids).delete()
+        deleted = delete_rows(Pizza.objects.filter(pk__in=pizza_ids))
+        notify_menu_changed(pizza_ids=pizza_ids)
+    return deleted
@@ -1,33 +1,97 @@
 from django import forms
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Lower
+from pizzaManagement.database import retry_on_lock
 from .models import Topping
 
 
-# Class: ToppingForm
-# Description: Form for adding or updating toppings.
-class ToppingForm(forms.ModelForm):
-    # Metaclass to specify model and fields
-    class Meta:
-        # Model associated with the form
-        model = Topping
-        # Fields to include in the form (the topping name)
-        fields = ['name']
+# Class: BulkContext
+# Description: Lookups shared by the forms validating the items of one bulk API request, made once for the
+#              whole batch instead of once per item (see UniqueNameModelForm.bulk_context).
+#              names maps the lowercase names requested to the id of the row holding them, other lookups
+#              are added by the form classes.
+class BulkContext:
+    def __init__(self, names, **lookups):
+        self.names = names
+        self.__dict__.update(lookups)
+
+
+# Class: UniqueNameModelForm
+# Description: Base form for models whose name is unique regardless of case (Topping, Pizza).
+#              Uniqueness is not checked during validation: the model's functional unique constraint
+#              rejects a duplicate on save (see save_unique), so a create is a single INSERT and
+#              concurrent requests cannot race. Forms of a bulk request get a BulkContext and also
+#              check the name against it, to report every duplicate of the batch at once.
+class UniqueNameModelForm(forms.ModelForm):
+    # Error shown on the name field when the database rejects a duplicate name
+    duplicate_name_message = "An item with this name already exists."
+
+    def __init__(self, *args, bulk=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bulk = bulk
+        # Skip the constraint query, the database enforces it on save (see Topping.validate_constraints)
+        self.instance.name_checked = True
+
+    # Function: bulk_context
+    # Parameters: cls, items (list of dict) - raw create and update items of a bulk request
+    # Description: Looks up the rows already holding any of the requested names, with one query.
+    # Returns: BulkContext
+    @classmethod
+    def bulk_context(cls, items):
+        names = {str(item.get('name') or '').strip().lower() for item in items} - {''}
+        rows = (cls._meta.model.objects.alias(lower_name=Lower('name')).filter(lower_name__in=names)
+                .values_list('name', 'pk'))
+        return BulkContext({name.lower(): pk for name, pk in rows})
 
     # Function: clean_name
     # Parameters: self
-    # Description: Validates the name field to ensure uniqueness of topping names.
-    # Returns: The cleaned name if it's unique.
+    # Description: Strips leading and trailing whitespaces from the name field. In a bulk request, the
+    #              name is also checked against the names looked up for the whole batch.
+    # Returns: The cleaned name.
     def clean_name(self):
         # Get the cleaned name from the form data
         name = self.cleaned_data.get('name')
         if name:
             # Strip leading and trailing whitespaces from the name field
             name = name.strip()
-        # Get the instance of the form, if it exists
-        instance = getattr(self, 'instance', None)
-        # Check if an instance exists and if a topping with the same name already exists
-        if instance and Topping.objects.exclude(pk=instance.pk).filter(name__iexact=name).exists():
-            # Raise a validation error if a topping with the same name already exists
-            raise forms.ValidationError("A topping with this name already exists.")
-        # Return the cleaned name if it's unique
+        if name and self.bulk is not None and self.bulk.names.get(name.lower(), self.instance.pk) != self.instance.pk:
+            raise forms.ValidationError(self.duplicate_name_message, code='unique')
         return name
 
+    # Function: batch_keys
+    # Parameters: self - a validated form
+    # Description: Values that must also be unique among the items of one bulk request, with the error to
+    #              report on a duplicate: the lowercase name (PizzaForm adds the recipe).
+    # Returns: list of (field, key, message) tuples
+    def batch_keys(self):
+        name = self.cleaned_data.get('name')
+        return [('name', ('name', name.lower()), self.duplicate_name_message)] if name else []
+
+    # Function: save_unique
+    # Parameters: self
+    # Description: Saves the form in a single transaction, retried if the database is locked by another
+    #              writer. If another request inserted the same name in the meantime, the constraint
+    #              violation is turned into a form error.
+    # Returns: The saved instance, or None if the name is already taken.
+    @retry_on_lock
+    def save_unique(self):
+        try:
+            with transaction.atomic():
+                return self.save()
+        except IntegrityError:
+            # Duplicate name raced past validation, report it on the name field
+            self.add_error('name', self.duplicate_name_message)
+            return None
+
+
+# Class: ToppingForm
+# Description: Form for adding or updating toppings.
+class ToppingForm(UniqueNameModelForm):
+    duplicate_name_message = "A topping with this name already exists."
+
+    # Metaclass to specify model and fields
+    class Meta:
+        # Model associated with the form
+        model = Topping
+        # Fields to include in the form (the topping name)
+        fields = ['name']
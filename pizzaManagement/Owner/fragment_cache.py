@@ -0,0 +1,219 @@
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from pizzaManagement.routers import is_replica, replica_lag
+
+from .models import MenuVersion
+from .signals import menu_changed
+
+# Kinds of cached fragments
+PIZZA_CARD = 'pizza'
+TOPPING_ROW = 'topping'
+
+# Default lifetime of a rendered fragment, in seconds
+DEFAULT_TIMEOUT = 24 * 60 * 60
+
+# Cache keys of the hit / miss counters
+HITS_KEY = 'menu:fragments:hits'
+MISSES_KEY = 'menu:fragments:misses'
+
+# MenuVersion the fragment versions of this process reflect ('version' is None when unknown), and its
+# MenuVersion.updated_at (None if not read yet: version numbers can be reused after a rollback). The default
+# cache is local to each process, which only learns about the changes of the others from the database.
+_menu_state = {'version': None, 'updated_at': None}
+_menu_lock = threading.Lock()
+
+
+# Function: version_key / fragment_key
+# Parameters: kind (PIZZA_CARD or TOPPING_ROW), pk (int), version (str)
+# Description: Cache keys of an object's current fragment version and of its rendered fragment.
+#              Each object has its own version, so a change only invalidates the fragments it affects.
+# Returns: str
+def version_key(kind, pk):
+    return 'menu:version:%s:%s' % (kind, pk)
+
+
+# Function: generation_key
+# Parameters: kind (PIZZA_CARD or TOPPING_ROW)
+# Description: Cache key of the generation of all the fragments of a kind, part of every fragment version:
+#              dropping it invalidates them all at once (see invalidate_all).
+# Returns: str
+def generation_key(kind):
+    return 'menu:generation:%s' % kind
+
+
+def fragment_key(kind, pk, version):
+    return 'menu:fragment:%s:%s:%s' % (kind, pk, version)
+
+
+# Function: _get_versions
+# Parameters: kind, pks (list of int)
+# Description: Fetches the current fragment versions of the given objects, and the generation of their
+#              kind, in one cache round trip. Objects without a version (never rendered, invalidated or
+#              evicted) get a fresh random one, so a fragment stored under an older version can never be
+#              served again; the same goes for a missing generation.
+# Returns: dict mapping pk to version
+def _get_versions(kind, pks):
+    keys = {pk: version_key(kind, pk) for pk in pks}
+    generation = generation_key(kind)
+    found = cache.get_many([generation, *keys.values()])
+    missing = {key: uuid.uuid4().hex for key in (generation, *keys.values()) if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return {pk: '%s.%s' % (found[generation], found[key]) for pk, key in keys.items()}
+
+
+# Function: _check_menu_version
+# Parameters: menu_version - (version, updated_at) already read from the database, None to read it
+# Description: Compares the database MenuVersion (one primary key lookup) with the version the cached
+#              fragments reflect. When it moved in a way this process has not seen (a change made by
+#              another process, or one rolled back since), every fragment is dropped at once, as the
+#              changed objects are not known.
+# Returns: None
+def _check_menu_version(menu_version=None):
+    version, updated_at = menu_version or MenuVersion.current()
+    with _menu_lock:
+        if version != _menu_state['version'] or _menu_state['updated_at'] not in (None, updated_at):
+            invalidate_all(PIZZA_CARD)
+            invalidate_all(TOPPING_ROW)
+        _menu_state.update(version=version, updated_at=updated_at)
+
+
+# Function: _apply_menu_version
+# Parameters: version (int) - MenuVersion of a change committed by this process
+# Description: Records that the fragment versions reflect a committed change. Changes must arrive one version
+#              at a time, otherwise one was missed and the next render drops every fragment.
+# Returns: None
+def _apply_menu_version(version):
+    with _menu_lock:
+        if _menu_state['version'] is not None and version == _menu_state['version'] + 1:
+            _menu_state.update(version=version, updated_at=None)
+        else:
+            _menu_state['version'] = None
+
+
+# Function: _count
+# Parameters: key (str), amount (int)
+# Description: Adds to one of the shared hit / miss counters.
+# Returns: None
+def _count(key, amount):
+    if not amount:
+        return
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # First use of the counter (or evicted)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, amount)
+
+
+# Function: render_fragments
+# Parameters:
+#   - kind: PIZZA_CARD or TOPPING_ROW
+#   - objects: list of pizzas or toppings to render
+#   - template_name: template rendering one object (must not contain per-user data such as CSRF tokens)
+#   - context_name: name of the object in the template context
+#   - prepare: optional function called with the objects that have to be rendered, e.g. to prefetch
+#              the data their template needs only for those objects
+#   - menu_version: optional (version, updated_at) read before the objects (see read_menu_version in
+#              Owner.decorators), saves reading it again
+# Description: Returns the rendered fragment of every object, reusing cached fragments. The database
+#              MenuVersion is checked first, then versions and fragments are each fetched in a single cache
+#              round trip; only misses are rendered.
+# Returns: list of safe HTML strings, in the order of objects
+def render_fragments(kind, objects, template_name, context_name, prepare=None, menu_version=None):
+    if not objects:
+        return []
+    _check_menu_version(menu_version)
+    versions = _get_versions(kind, [obj.pk for obj in objects])
+    keys = {obj.pk: fragment_key(kind, obj.pk, versions[obj.pk]) for obj in objects}
+    fragments = cache.get_many(keys.values())
+    misses = [obj for obj in objects if keys[obj.pk] not in fragments]
+    if misses:
+        if prepare:
+            prepare(misses)
+        rendered = {keys[obj.pk]: render_to_string(template_name, {context_name: obj}) for obj in misses}
+        timeout = getattr(settings, 'MENU_FRAGMENT_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+        if any(is_replica(obj._state.db) for obj in misses):
+            # A replica may not have the change that invalidated the fragment yet: keep what was rendered
+            # from it only as long as a replica may lag
+            timeout = min(timeout, replica_lag())
+        cache.set_many(rendered, timeout=timeout)
+        fragments.update(rendered)
+    _count(HITS_KEY, len(objects) - len(misses))
+    _count(MISSES_KEY, len(misses))
+    return [mark_safe(fragments[keys[obj.pk]]) for obj in objects]
+
+
+# Function: render_pizza_cards
+# Parameters: pizzas (list of Pizza), menu_version (see render_fragments)
+# Description: Renders the dashboard card of each pizza, reusing cached cards. Toppings are prefetched
+#              (in one query) only for the pizzas whose card is not cached.
+# Returns: list of rendered cards
+def render_pizza_cards(pizzas, menu_version=None):
+    return render_fragments(PIZZA_CARD, pizzas, 'pizza_card.html', 'pizza',
+                            prepare=lambda misses: prefetch_related_objects(misses, 'toppings'),
+                            menu_version=menu_version)
+
+
+# Function: render_topping_rows
+# Parameters: toppings (list of Topping), menu_version (see render_fragments)
+# Description: Renders the dashboard row of each topping, reusing cached rows.
+# Returns: list of rendered rows
+def render_topping_rows(toppings, menu_version=None):
+    return render_fragments(TOPPING_ROW, toppings, 'topping_row.html', 'topping', menu_version=menu_version)
+
+
+# Function: invalidate
+# Parameters: kind, pks (iterable of int, or None for all the objects of the kind)
+# Description: Drops the current fragment version of the given objects, so their next render is a miss.
+# Returns: None
+def invalidate(kind, pks):
+    if pks is None:
+        invalidate_all(kind)
+        return
+    keys = [version_key(kind, pk) for pk in pks]
+    if keys:
+        cache.delete_many(keys)
+
+
+# Function: invalidate_all
+# Parameters: kind
+# Description: Drops the generation of a kind: every fragment of that kind misses on its next render, for
+#              the cost of a single cache delete. The orphaned fragments expire with their timeout.
+# Returns: None
+def invalidate_all(kind):
+    cache.delete(generation_key(kind))
+
+
+# Function: stats
+# Parameters: None
+# Description: Reads the fragment cache hit / miss counters.
+# Returns: dict with hits, misses and hit_rate
+def stats():
+    counters = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counters.get(HITS_KEY, 0), counters.get(MISSES_KEY, 0)
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None}
+
+
+@receiver(menu_changed)
+def invalidate_changed_fragments(sender, pizza_ids, topping_ids, version=None, **kwargs):
+    def drop():
+        invalidate(PIZZA_CARD, pizza_ids)
+        invalidate(TOPPING_ROW, topping_ids)
+
+    def committed():
+        drop()
+        _apply_menu_version(version)
+    # Drop the versions right away, and again once the transaction commits so a concurrent render that
+    # read the old rows before the commit cannot leave a stale fragment under a fresh version
+    drop()
+    transaction.on_commit(committed)
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+
+from .fragment_cache import render_pizza_cards, render_topping_rows
+from .models import MenuVersion, Pizza, Topping
+from .signals import menu_changed
+
+# Default seconds between keep-alive comments on an idle stream, overridden by MENU_EVENTS_KEEPALIVE. Also how
+# often a process checks the database for changes made by other processes while clients are connected.
+DEFAULT_KEEPALIVE = 15
+# Default number of past events kept for reconnecting clients, overridden by MENU_EVENTS_HISTORY
+DEFAULT_HISTORY = 100
+# Default maximum number of pizzas or toppings whose fragments are sent in one event, overridden by
+# MENU_EVENTS_FRAGMENT_LIMIT. Past it the event only tells the clients their list is out of date.
+DEFAULT_FRAGMENT_LIMIT = 50
+# Events waiting for a client before it is deemed too slow: its backlog is replaced by a reload event
+QUEUE_SIZE = 32
+# Milliseconds a client waits before reconnecting a dropped stream
+RETRY_MS = 3000
+
+# Event types: a change the client can patch its page with, or a change it cannot (it missed events,
+# or the change was made by another process) and must reload for
+CHANGE = 'change'
+RELOAD = 'reload'
+
+
+# Function: format_event
+# Parameters: event (tuple) - (version, type, JSON data)
+# Description: Encodes an event in the text/event-stream format. The id is the menu version, sent back by
+#              the browser as Last-Event-ID when it reconnects.
+# Returns: str
+def format_event(event):
+    version, kind, data = event
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (version, kind, data)
+
+
+# Class: Subscription
+# Description: Queue of the events waiting to be sent to one connected client, filled from any thread and
+#              drained by the client's stream on the event loop. An idle client costs this queue and its
+#              suspended stream, no thread.
+class Subscription:
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+    # Function: put
+    # Parameters: self, event (tuple)
+    # Description: Queues an event; safe to call from any thread.
+    # Returns: None
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The event loop of the client is closed, its stream is gone
+            pass
+
+    def _put(self, event):
+        if self.queue.full():
+            # The client does not keep up: drop its backlog, it reloads the page instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = (event[0], RELOAD, '{}')
+        self.queue.put_nowait(event)
+
+
+# Class: Broadcaster
+# Description: In-process fan-out of the menu change events to every connected dashboard. Each change is
+#              encoded once and queued for every subscription. The last events are kept so a client that
+#              reconnects with Last-Event-ID gets what it missed. Changes made by other processes are not
+#              published here: they are noticed by a version check every keep-alive interval, or by the gap
+#              they leave before the next version published here, and the clients are told to reload.
+class Broadcaster:
+    def __init__(self, history=None):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history or getattr(settings, 'MENU_EVENTS_HISTORY', DEFAULT_HISTORY))
+        # Last menu version published or seen in the database, and when the database was last checked
+        self._version = None
+        self._checked_at = 0.0
+
+    # Function: subscribers
+    # Parameters: self
+    # Description: Number of connected clients.
+    # Returns: int
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    # Function: publish
+    # Parameters: self, version (int), kind (CHANGE or RELOAD), data (str) - JSON payload
+    # Description: Records an event and queues it for every connected client; safe to call from any thread.
+    # Returns: None
+    def publish(self, version, kind, data):
+        event = (version, kind, data)
+        with self._lock:
+            self._history.append(event)
+            self._version = max(version, self._version or 0)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    # Function: missed
+    # Parameters: self, since (int) - last version the client received, current (int) - current version
+    # Description: The events after since, if this process published every version up to current.
+    # Returns: list of events, or None if some are unknown
+    def missed(self, since, current):
+        with self._lock:
+            events = [event for event in self._history if since < event[0] <= current]
+        if [event[0] for event in events] != list(range(since + 1, current + 1)):
+            return None
+        return events
+
+    # Function: check_version
+    # Parameters: self
+    # Description: At most once per keep-alive interval, compares the database menu version with the last one
+    #              published: if another process changed the menu, the clients are told to reload.
+    # Returns: None
+    async def check_version(self):
+        now = time.monotonic()
+        if now - self._checked_at < getattr(settings, 'MENU_EVENTS_KEEPALIVE', DEFAULT_KEEPALIVE):
+            return
+        self._checked_at = now
+        version, _ = await MenuVersion.acurrent()
+        if self._version is None:
+            self._version = version
+        elif version > self._version:
+            self.publish(version, RELOAD, '{}')
+
+    # Function: stream
+    # Parameters: self, last_version (int or None) - Last-Event-ID sent by a reconnecting client
+    # Description: Async generator of the text/event-stream of one client: the events it missed since
+    #              last_version, then every new event, with a keep-alive comment when idle. An event that
+    #              does not follow the last version sent is replaced by a reload, so a version published out
+    #              of order or never published here is not silently skipped. The client is unsubscribed when
+    #              the stream is closed (the client disconnected).
+    # Returns: async iterator of str
+    async def stream(self, last_version=None):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.add(subscription)
+        try:
+            # Read after subscribing, so no change falls between the two
+            sent, _ = await MenuVersion.acurrent()
+            yield 'retry: %d\n\n' % RETRY_MS
+            if last_version is not None and last_version < sent:
+                events = self.missed(last_version, sent)
+                for event in events or [(sent, RELOAD, '{}')]:
+                    yield format_event(event)
+            keepalive = getattr(settings, 'MENU_EVENTS_KEEPALIVE', DEFAULT_KEEPALIVE)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    await self.check_version()
+                    continue
+                # Skip the events already sent, or covered by a reload sent since
+                if event[0] <= sent:
+                    continue
+                if event[0] != sent + 1:
+                    # Versions in between are unknown here: changed by another process, or published later
+                    # by a slower thread. The client reloads up to this version instead.
+                    event = (event[0], RELOAD, '{}')
+                sent = event[0]
+                yield format_event(event)
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscription)
+
+
+# Broadcaster of this process
+broadcaster = Broadcaster()
+
+
+# Function: _fragments
+# Parameters:
+#   - model: Pizza or Topping
+#   - pks: ids of the changed objects, None if too many changed to list
+#   - render: render_pizza_cards or render_topping_rows
+# Description: Renders the dashboard fragment and name of every changed object, null for deleted ones.
+#              Fragments come from the fragment cache, and are cached for the next page render.
+# Returns: dict mapping the id (str) to {"name", "html"} or None, or None past MENU_EVENTS_FRAGMENT_LIMIT
+def _fragments(model, pks, render):
+    if pks is None or len(pks) > getattr(settings, 'MENU_EVENTS_FRAGMENT_LIMIT', DEFAULT_FRAGMENT_LIMIT):
+        return None
+    objects = list(model.objects.filter(pk__in=pks))
+    rendered = {obj.pk: {'name': obj.name, 'html': html} for obj, html in zip(objects, render(objects))}
+    return {str(pk): rendered.get(pk) for pk in pks}
+
+
+@receiver(menu_changed)
+def broadcast_menu_change(sender, pizza_ids, topping_ids, version, **kwargs):
+    # Nothing to render when no dashboard listens in this process
+    if not broadcaster.subscribers:
+        return
+
+    def publish():
+        data = json.dumps({
+            'pizzas': _fragments(Pizza, pizza_ids, render_pizza_cards),
+            'toppings': _fragments(Topping, topping_ids, render_topping_rows),
+        })
+        broadcaster.publish(version, CHANGE, data)
+    # Published once committed, so clients never see a change that is rolled back. A failure to render
+    # must not fail the request that changed the menu.
+    transaction.on_commit(publish, robust=True)
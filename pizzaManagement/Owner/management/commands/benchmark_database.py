@@ -0,0 +1,110 @@
+import copy
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from Owner.benchmark import benchmark_concurrency, generate_menu
+from Owner.roles import ROLES
+from pizzaManagement.database import DATABASE_PROFILES
+
+
+# Class: Command
+# Description: manage.py benchmark_database - compares the SQLite profiles of pizzaManagement.database under
+#              concurrent chefs and owners. For every --profile, a throwaway database file configured with that
+#              profile is filled with a synthetic menu, then --workers threads send a mix of page views and
+#              writes for --duration seconds. Reported per profile: throughput, p50 / p95 / p99 latency (of all
+#              requests and of the writes) and failed requests, which are "database is locked" errors. The
+#              configured database is never touched.
+class Command(BaseCommand):
+    help = "Benchmark the SQLite database profiles under concurrent reads and writes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', action='append', choices=list(DATABASE_PROFILES),
+                            help="Database profile to benchmark, repeatable (default: all).")
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent clients (default: 8).")
+        parser.add_argument('--duration', type=float, default=10, help="Seconds per profile (default: 10).")
+        parser.add_argument('--writes', type=float, default=0.2,
+                            help="Share of write requests, 0.2 = 20%% (default: 0.2).")
+        parser.add_argument('--scale', type=int, default=200,
+                            help="Toppings and pizzas in the menu (default: 200).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed of the menu and requests (default: 0).")
+        parser.add_argument('--output', help="Save the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The database profiles only apply to SQLite.")
+        if options['workers'] < 1 or options['duration'] <= 0 or options['scale'] < 1:
+            raise CommandError("--workers, --duration and --scale must be positive.")
+        if not 0 <= options['writes'] <= 1:
+            raise CommandError("--writes must be between 0 and 1.")
+
+        results = {'workers': options['workers'], 'duration': options['duration'], 'writes': options['writes'],
+                   'scale': options['scale'], 'profiles': {}}
+        saved = copy.deepcopy(connection.settings_dict)
+        # Logging every request, and every "database is locked" traceback, would skew the figures
+        logging.disable(logging.CRITICAL)
+        try:
+            # The test client sends requests to the host "testserver"
+            with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+                for profile in options['profile'] or list(DATABASE_PROFILES):
+                    results['profiles'][profile] = self.run_profile(profile, options)
+        finally:
+            logging.disable(logging.NOTSET)
+            # The worker threads share this dict with the main connection, restore it in place
+            connection.settings_dict.clear()
+            connection.settings_dict.update(saved)
+
+        profiles = results['profiles']
+        if len(profiles) > 1 and profiles.get('default', {}).get('requests_per_sec'):
+            for profile, result in profiles.items():
+                if profile != 'default':
+                    self.stdout.write("%s: %.1fx the throughput of default" % (
+                        profile, result['requests_per_sec'] / profiles['default']['requests_per_sec']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write("Results saved to %s" % options['output'])
+
+    # Function: run_profile
+    # Parameters: self, profile (str), options (dict)
+    # Description: Benchmarks one profile on a fresh database file configured with it.
+    # Returns: dict, see benchmark_concurrency
+    def run_profile(self, profile, options):
+        connection.settings_dict.update(copy.deepcopy(DATABASE_PROFILES[profile]))
+        # A file, not memory: journaling, locking and reconnecting are what is measured
+        connection.settings_dict['TEST'] = dict(connection.settings_dict.get('TEST') or {},
+                                                NAME=os.path.join(tempfile.gettempdir(), 'benchmark_database.sqlite3'))
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            menu = generate_menu(options['scale'], options['scale'], options['seed'])
+            users = {role: User.objects.get_or_create(username=role)[0] for role in ROLES}
+            for role, user in users.items():
+                user.groups.add(Group.objects.get_or_create(name=role)[0])
+            clients = []
+            for _ in range(options['workers']):
+                worker_clients = {}
+                for role, user in users.items():
+                    # Failing views return a 500 response, counted as an error, instead of raising
+                    worker_clients[role] = Client(raise_request_exception=False)
+                    worker_clients[role].force_login(user)
+                clients.append(worker_clients)
+            connection.close()
+
+            result = benchmark_concurrency(clients, menu, options['duration'], options['writes'], options['seed'])
+            if not result['requests']:
+                raise CommandError("No request completed with the %s profile." % profile)
+            writes = result.get('writes', {})
+            self.stdout.write(
+                "%-10s %7.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  writes p95 %7.2f ms  %d errors" % (
+                    profile, result['requests_per_sec'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    writes.get('p95_ms', 0.0), result['errors']))
+            return result
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,165 @@
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from Owner.benchmark import summarize
+
+# Deployments that can be benchmarked
+WSGI = 'wsgi'
+ASGI = 'asgi'
+
+
+# Class: Command
+# Description: manage.py benchmark_handlers - compares requests/sec of the WSGI deployment (wsgi.py) and the
+#              ASGI deployment (asgi.py) on one page. Both Django handlers are driven in-process with the same
+#              logged in session and concurrency, so the figures compare Django's request path (sync views in
+#              a thread pool vs async views on an event loop) without any web server overhead:
+#                - WSGI: WSGIHandler called from a pool of --concurrency threads, like a threaded WSGI server
+#                - ASGI: ASGIHandler called from one event loop with --concurrency requests in flight
+#              The page is only read, so the command is safe to run against any database.
+class Command(BaseCommand):
+    help = "Compare requests/sec of the WSGI and ASGI handlers on a page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="Page to request (default: the chef dashboard).")
+        parser.add_argument('--user', default='Chef', help="User the requests are logged in as (default: Chef).")
+        parser.add_argument('--requests', type=int, default=500,
+                            help="Number of timed requests per deployment (default: 500).")
+        parser.add_argument('--concurrency', type=int, default=10,
+                            help="Number of requests in flight at a time (default: 10).")
+        parser.add_argument('--warmup', type=int, default=20,
+                            help="Untimed requests sent first to fill caches (default: 20).")
+        parser.add_argument('--mode', choices=[WSGI, ASGI, 'both'], default='both',
+                            help="Deployment(s) to benchmark (default: both).")
+        parser.add_argument('--host', default='localhost', help="Host header sent (default: localhost).")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1 or options['warmup'] < 0:
+            raise CommandError("--requests and --concurrency must be at least 1, --warmup at least 0.")
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError("User %s does not exist." % options['user'])
+
+        url = urlsplit(options['path'] or reverse('chef_dashboard'))
+        self.path, self.query = url.path, url.query
+        self.host = options['host']
+        self.concurrency = options['concurrency']
+
+        # Log in once and share the session cookie between all requests
+        client = Client()
+        client.force_login(user)
+        self.cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value)
+        modes = [WSGI, ASGI] if options['mode'] == 'both' else [options['mode']]
+        try:
+            results = {}
+            for mode in modes:
+                run = self.run_wsgi if mode == WSGI else self.run_asgi
+                if options['warmup']:
+                    run(options['warmup'])
+                results[mode] = run(options['requests'])
+        finally:
+            # Remove the benchmark session
+            client.logout()
+
+        if options['json']:
+            self.stdout.write(json.dumps({'path': self.path, 'concurrency': self.concurrency, 'results': results},
+                                         indent=2))
+            return
+        self.stdout.write("%s, %d concurrent requests" % (self.path, self.concurrency))
+        for mode, result in results.items():
+            self.stdout.write(
+                "%s: %.1f requests/sec, mean %.2f ms, p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, %d errors" % (
+                mode.upper(), result['requests_per_sec'], result['mean_ms'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms'], result['errors']))
+        if len(results) == 2 and results[WSGI]['requests_per_sec']:
+            self.stdout.write("ASGI / WSGI throughput: %.2fx" % (
+                results[ASGI]['requests_per_sec'] / results[WSGI]['requests_per_sec']))
+
+    # Function: run_wsgi
+    # Parameters: self, count (int) - number of requests
+    # Description: Sends count GET requests through the WSGI handler from a thread pool.
+    # Returns: dict (see summarize)
+    def run_wsgi(self, count):
+        application = WSGIHandler()
+
+        def request():
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': self.path, 'QUERY_STRING': self.query, 'SCRIPT_NAME': '',
+                'SERVER_NAME': self.host, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_HOST': self.host, 'HTTP_COOKIE': self.cookie, 'REMOTE_ADDR': '127.0.0.1',
+                'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+                'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            status = []
+            started = time.perf_counter()
+            body = application(environ, lambda line, headers: status.append(int(line.split()[0])))
+            try:
+                for _chunk in body:
+                    pass
+            finally:
+                # Closing the response fires request_finished, like a WSGI server does
+                body.close()
+            return time.perf_counter() - started, status[0]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            timings = list(pool.map(lambda _: request(), range(count)))
+        elapsed = time.perf_counter() - started
+        return summarize([t for t, _ in timings], [s for _, s in timings], elapsed)
+
+    # Function: run_asgi
+    # Parameters: self, count (int) - number of requests
+    # Description: Sends count GET requests through the ASGI handler from a single event loop.
+    # Returns: dict (see summarize)
+    def run_asgi(self, count):
+        application = ASGIHandler()
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': self.path, 'raw_path': self.path.encode(), 'root_path': '',
+            'query_string': self.query.encode(), 'client': ('127.0.0.1', 0), 'server': (self.host, 80),
+            'headers': [(b'host', self.host.encode()), (b'cookie', self.cookie.encode())],
+        }
+
+        async def request(semaphore):
+            async with semaphore:
+                messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+                status = []
+
+                async def receive():
+                    if messages:
+                        return messages.pop()
+                    # The client never disconnects early
+                    await asyncio.Event().wait()
+
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        status.append(message['status'])
+
+                started = time.perf_counter()
+                await application(dict(scope), receive, send)
+                return time.perf_counter() - started, status[0]
+
+        async def run():
+            semaphore = asyncio.Semaphore(self.concurrency)
+            return await asyncio.gather(*(request(semaphore) for _ in range(count)))
+
+        started = time.perf_counter()
+        # A fresh event loop, as an ASGI server would run, so sync code uses per-request threads
+        timings = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+        return summarize([t for t, _ in timings], [s for _, s in timings], elapsed)
@@ -0,0 +1,140 @@
+import json
+import os
+import platform
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.utils import timezone
+
+from Owner.benchmark import (DEFAULT_MEAN_TOPPINGS, ENDPOINT_NAMES, ENDPOINTS, PIZZA_ENDPOINTS, benchmark_endpoint,
+                             compare_results, generate_menu)
+from Owner.roles import ROLES
+
+# Default menu sizes (toppings and pizzas each)
+DEFAULT_SCALES = [100, 1000]
+
+
+# Class: Command
+# Description: manage.py benchmark_views - measures how the dashboards and the create / update / delete views
+#              behave as the menu grows. For every --scale, a throwaway test database is created (the same one
+#              manage.py test uses, see the TEST settings of the database) and filled with a synthetic menu of
+#              that many toppings and pizzas, then every endpoint is driven through the Django test client.
+#              Reported per endpoint: p50 / p95 / p99 latency, SQL queries per request and peak Python memory
+#              per request (tracemalloc). --output saves the results as JSON, --compare checks them against a
+#              saved run and fails on regressions. The configured database is never touched.
+class Command(BaseCommand):
+    help = "Benchmark the menu views on synthetic menus of growing size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, nargs='+', default=DEFAULT_SCALES,
+                            help="Menu sizes to benchmark, in toppings and pizzas each (default: 100 1000).")
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINT_NAMES,
+                            help="Endpoint to benchmark, repeatable (default: all).")
+        parser.add_argument('--requests', type=int, default=50,
+                            help="Number of timed requests per endpoint (default: 50).")
+        parser.add_argument('--warmup', type=int, default=5,
+                            help="Untimed requests sent first to fill caches (default: 5).")
+        parser.add_argument('--profiled', type=int, default=3,
+                            help="Extra requests counting queries and memory (default: 3).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed of the menus and requests (default: 0).")
+        parser.add_argument('--mean-toppings', type=int, default=DEFAULT_MEAN_TOPPINGS,
+                            help="Average number of toppings per pizza (default: %d)." % DEFAULT_MEAN_TOPPINGS)
+        parser.add_argument('--output', help="Save the results to this JSON file.")
+        parser.add_argument('--compare', help="JSON results of an earlier run to check for regressions.")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="Tolerated p95 latency increase when comparing, 0.2 = +20%% (default: 0.2).")
+
+    def handle(self, *args, **options):
+        if min(options['scale']) < 1:
+            raise CommandError("--scale must be at least 1.")
+        if options['requests'] < 1 or options['warmup'] < 0 or options['profiled'] < 0:
+            raise CommandError("--requests must be at least 1, --warmup and --profiled at least 0.")
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError("Cannot read %s: %s" % (options['compare'], e))
+        selected = [endpoint for endpoint in ENDPOINTS
+                    if not options['endpoint'] or endpoint.name in options['endpoint']]
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # SQLite test databases default to memory, which would hide disk I/O and survive between scales
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'benchmark_views.sqlite3')
+
+        results = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'seed': options['seed'],
+            'requests': options['requests'],
+            'scales': {},
+        }
+        # The test client sends requests to the host "testserver"
+        with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+            for scale in options['scale']:
+                results['scales'][str(scale)] = self.run_scale(scale, selected, options)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write("Results saved to %s" % options['output'])
+        if baseline is not None:
+            regressions = compare_results(baseline, results, options['threshold'])
+            for message in regressions:
+                self.stdout.write("REGRESSION %s" % message)
+            if regressions:
+                raise CommandError("%d regression(s) against %s." % (len(regressions), options['compare']))
+            self.stdout.write("No regression against %s." % options['compare'])
+
+    # Function: run_scale
+    # Parameters: self, scale (int), endpoints (list of Endpoint), options (dict)
+    # Description: Benchmarks the endpoints on a fresh test database holding a menu of the given size.
+    # Returns: dict with the menu size, the generation time and the results of each endpoint
+    def run_scale(self, scale, endpoints, options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # Log in as a Chef and an Owner, members of their role group
+            clients = {}
+            for role in ROLES:
+                user = User.objects.get_or_create(username=role)[0]
+                user.groups.add(Group.objects.get_or_create(name=role)[0])
+                clients[role] = Client()
+                clients[role].force_login(user)
+
+            started = time.perf_counter()
+            menu = generate_menu(scale, scale, options['seed'], options['mean_toppings'])
+            generated = time.perf_counter() - started
+            self.stdout.write("Scale %d: generated %d toppings and %d pizzas in %.1fs" % (
+                scale, len(menu.topping_ids), len(menu.pizza_ids), generated))
+
+            # Requests sent per endpoint: delete endpoints consume one pizza or topping each
+            needed = options['warmup'] + options['requests'] + options['profiled']
+            run = {'toppings': scale, 'pizzas': scale, 'generate_sec': round(generated, 2), 'endpoints': {}}
+            for endpoint in endpoints:
+                if endpoint.name in PIZZA_ENDPOINTS and not menu.pizza_ids:
+                    self.stdout.write("  %-24s skipped, needs a pizza" % endpoint.name)
+                    continue
+                if endpoint.name == 'delete_pizza' and len(menu.pizza_ids) < needed:
+                    self.stdout.write("  %-24s skipped, needs %d pizzas" % (endpoint.name, needed))
+                    continue
+                if endpoint.name == 'delete_topping' and len(menu.topping_ids) < needed:
+                    self.stdout.write("  %-24s skipped, needs %d toppings" % (endpoint.name, needed))
+                    continue
+                result = benchmark_endpoint(endpoint, clients[endpoint.role], menu, options['requests'],
+                                            options['warmup'], options['profiled'])
+                run['endpoints'][endpoint.name] = result
+                self.stdout.write(
+                    "  %-24s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  %3s queries  %8s KiB  %d errors" % (
+                    endpoint.name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['queries'],
+                    result['peak_kib'], result['errors']))
+            return run
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
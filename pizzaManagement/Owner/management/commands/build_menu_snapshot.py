@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from Owner.snapshot import snapshot_writer
+
+
+# Class: Command
+# Description: manage.py build_menu_snapshot - writes the menu snapshot files served at /menu/snapshot/ (see
+#              Owner.snapshot). Once written, the server keeps them up to date; run it on deploy, so the snapshot
+#              also includes changes made while no server was running.
+class Command(BaseCommand):
+    help = "Build the JSON and MessagePack menu snapshot served to menu boards and kiosks."
+
+    def handle(self, *args, **options):
+        version, sizes = snapshot_writer.write()
+        if not sizes:
+            self.stdout.write("A newer snapshot than version %d is already written." % version)
+            return
+        for encoding, size in sizes.items():
+            self.stdout.write(self.style.SUCCESS("Wrote %s (version %d, %d bytes)."
+                                                 % (snapshot_writer.path(encoding), version, size)))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Owner.menu_io import CSV, FORMATS, encode_records, guess_format, iter_menu_records
+
+
+# Class: Command
+# Description: manage.py export_menu - streams the full topping and pizza catalog to a CSV or JSON Lines
+#              file (or stdout) with constant memory. The output can be read back with import_menu.
+class Command(BaseCommand):
+    help = "Export all toppings and pizzas as CSV or JSON Lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-',
+                            help="File to write to, or - for standard output (default).")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="Output format, inferred from the output file extension (default: csv).")
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Number of rows read from the database at a time (default: 2000).")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        fmt = options['format'] or (guess_format(output) if output != '-' else None) or CSV
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        records = iter_menu_records(chunk_size=options['chunk_size'])
+        if output == '-':
+            for line in encode_records(records, fmt):
+                self.stdout.write(line, ending='')
+            return
+        with open(output, 'w', encoding='utf-8', newline='') as stream:
+            for line in encode_records(records, fmt):
+                stream.write(line)
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Owner.benchmark import DEFAULT_MAX_TOPPINGS, DEFAULT_MEAN_TOPPINGS, generate_menu
+from Owner.models import Pizza, Topping
+
+
+# Class: Command
+# Description: manage.py generate_menu - fills an empty database with a synthetic menu of any size, for
+#              profiling by hand. Topping popularity and pizza sizes follow realistic distributions (see
+#              Owner.benchmark.generate_menu); the same --seed always generates the same menu.
+class Command(BaseCommand):
+    help = "Fill an empty menu with synthetic toppings and pizzas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--toppings', type=int, default=1000, help="Number of toppings (default: 1000).")
+        parser.add_argument('--pizzas', type=int, default=1000, help="Number of pizzas (default: 1000).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed (default: 0).")
+        parser.add_argument('--mean-toppings', type=int, default=DEFAULT_MEAN_TOPPINGS,
+                            help="Average number of toppings per pizza (default: %d)." % DEFAULT_MEAN_TOPPINGS)
+        parser.add_argument('--max-toppings', type=int, default=DEFAULT_MAX_TOPPINGS,
+                            help="Maximum number of toppings per pizza (default: %d)." % DEFAULT_MAX_TOPPINGS)
+
+    def handle(self, *args, **options):
+        if options['toppings'] < 0 or options['pizzas'] < 0:
+            raise CommandError("--toppings and --pizzas cannot be negative.")
+        if options['pizzas'] and not options['toppings']:
+            raise CommandError("Pizzas need at least one topping.")
+        if options['mean_toppings'] < 1 or options['max_toppings'] < 1:
+            raise CommandError("--mean-toppings and --max-toppings must be at least 1.")
+        # Generated names would clash with an existing menu
+        if Topping.objects.exists() or Pizza.objects.exists():
+            raise CommandError("The menu is not empty, generate into an empty database.")
+
+        started = time.perf_counter()
+        menu = generate_menu(options['toppings'], options['pizzas'], options['seed'],
+                             options['mean_toppings'], options['max_toppings'])
+        self.stdout.write("Generated %d toppings and %d pizzas in %.1fs" % (
+            len(menu.topping_ids), len(menu.pizza_ids), time.perf_counter() - started))
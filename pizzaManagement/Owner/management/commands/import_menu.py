@@ -0,0 +1,175 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from Owner.menu_io import FORMATS, PIZZA, TOPPING, RecordError, guess_format, read_records
+from Owner.models import Pizza, Topping, recipe_fingerprint
+from Owner.signals import notify_menu_changed
+
+# Maximum number of rejected rows printed individually
+MAX_REPORTED_REJECTS = 100
+
+
+# Class: Command
+# Description: manage.py import_menu - streams toppings and pizzas from a CSV or JSON Lines file into the
+#              database in batches. Each batch costs a constant number of queries: one name lookup and one
+#              bulk insert per model, one lookup resolving topping names and one bulk insert of the
+#              Pizza.toppings rows. Names follow the models' rules: trimmed, non-empty and unique
+#              regardless of case. Invalid or duplicate rows are rejected and reported, not imported.
+class Command(BaseCommand):
+    help = "Import toppings and pizzas from a CSV or JSON Lines file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Menu file to import, or - to read standard input.")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="File format, inferred from the file extension by default.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of records written per batch (default: 500).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        if fmt is None:
+            raise CommandError("Cannot infer the format of %s, use --format." % path)
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        self.rows = 0
+        self.rejected = 0
+        self.created = {TOPPING: 0, PIZZA: 0}
+        started = time.monotonic()
+
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        try:
+            batch = []
+            for record in read_records(stream, fmt):
+                self.rows += 1
+                if isinstance(record, RecordError):
+                    self.reject(record.line, record.reason)
+                    continue
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        elapsed = time.monotonic() - started
+        rate = self.rows / elapsed if elapsed > 0 else float(self.rows)
+        self.stdout.write(self.style.SUCCESS(
+            "Imported %d toppings and %d pizzas from %d rows in %.2fs (%.0f rows/sec), %d rejected."
+            % (self.created[TOPPING], self.created[PIZZA], self.rows, elapsed, rate, self.rejected)))
+
+    # Function: reject
+    # Parameters: self, line (int), reason (str)
+    # Description: Counts a rejected row and reports it on stderr (only the first MAX_REPORTED_REJECTS).
+    # Returns: None
+    def reject(self, line, reason):
+        self.rejected += 1
+        if self.rejected <= MAX_REPORTED_REJECTS:
+            self.stderr.write("Line %d rejected: %s" % (line, reason))
+        elif self.rejected == MAX_REPORTED_REJECTS + 1:
+            self.stderr.write("Further rejected rows are not listed.")
+
+    # Function: import_batch
+    # Parameters: self, records (list of MenuRecord)
+    # Description: Writes one batch in a transaction: toppings first, so pizzas of the same batch can use them.
+    # Returns: None
+    def import_batch(self, records):
+        with transaction.atomic():
+            toppings = self.create_unique(Topping, [record for record in records if record.type == TOPPING])
+
+            pizzas = [record for record in records if record.type == PIZZA]
+            if not pizzas:
+                notify_menu_changed(topping_ids=[topping.pk for record, topping in toppings])
+                return
+            # Resolve every topping name used in this batch with a single lookup
+            topping_ids = lookup_names(Topping, {name for record in pizzas for name in record.toppings})
+            resolvable = []
+            for record in pizzas:
+                unknown = [name for name in record.toppings if name.lower() not in topping_ids]
+                if unknown:
+                    self.reject(record.line, "unknown topping(s): %s" % ', '.join(unknown))
+                else:
+                    resolvable.append(record)
+
+            created = self.create_unique(Pizza, resolvable)
+            # Link the new pizzas to their toppings with one bulk insert
+            recipes = [(pizza, {topping_ids[name.lower()] for name in record.toppings}) for record, pizza in created]
+            through = Pizza.toppings.through
+            through.objects.bulk_create([
+                through(pizza_id=pizza.pk, topping_id=topping_id)
+                for pizza, recipe in recipes
+                for topping_id in recipe
+            ])
+            # Store the recipe fingerprints with one bulk update
+            for pizza, recipe in recipes:
+                pizza.recipe_fingerprint = recipe_fingerprint(recipe)
+            Pizza.objects.bulk_update([pizza for pizza, recipe in recipes if pizza.recipe_fingerprint],
+                                      ['recipe_fingerprint'])
+            # bulk_create does not send model signals
+            notify_menu_changed(pizza_ids=[pizza.pk for record, pizza in created],
+                                topping_ids=[topping.pk for record, topping in toppings])
+
+    # Function: create_unique
+    # Parameters: self, model (Topping or Pizza), records (list of MenuRecord)
+    # Description: Inserts the records whose names are not taken yet, with one lookup and one bulk insert.
+    #              Names repeated within the batch or already in the database are rejected.
+    # Returns: list of (MenuRecord, created instance) pairs
+    def create_unique(self, model, records):
+        unique = {}
+        for record in records:
+            key = record.name.lower()
+            if key in unique:
+                self.reject(record.line, "duplicate of line %d" % unique[key].line)
+            else:
+                unique[key] = record
+        existing = lookup_names(model, [record.name for record in unique.values()])
+        fresh = []
+        for key, record in unique.items():
+            if key in existing:
+                self.reject(record.line, "a %s named %r already exists" % (record.type, record.name))
+            else:
+                fresh.append(record)
+        if not fresh:
+            return []
+
+        try:
+            with transaction.atomic():
+                instances = model.objects.bulk_create([model(name=record.name) for record in fresh])
+            created = list(zip(fresh, instances))
+        except IntegrityError:
+            # A clash the lookup could not see (a concurrent writer, or case folding that differs between
+            # Python and the database): fall back to inserting this batch one row at a time
+            created = []
+            for record in fresh:
+                try:
+                    with transaction.atomic():
+                        created.append((record, model.objects.create(name=record.name)))
+                except IntegrityError:
+                    self.reject(record.line, "a %s named %r already exists" % (record.type, record.name))
+        self.created[fresh[0].type] += len(created)
+        return created
+
+
+# Function: lookup_names
+# Parameters: model (Topping or Pizza), names (iterable of str)
+# Description: Finds the existing rows matching the given names regardless of case, in one query on the
+#              Lower('name') unique index.
+# Returns: dict mapping lowercased name to primary key
+def lookup_names(model, names):
+    names = list(names)
+    if not names:
+        return {}
+    rows = (model.objects.annotate(name_key=Lower('name'))
+            .filter(Q(name_key__in={name.lower() for name in names}) | Q(name__in=names))
+            .values_list('pk', 'name'))
+    return {name.lower(): pk for pk, name in rows}
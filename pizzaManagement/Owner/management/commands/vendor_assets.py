@@ -0,0 +1,51 @@
+import os
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Third-party assets served from static/vendor instead of a CDN: (path under static/vendor, pinned URL). Source
+# maps are fetched too, collectstatic rewrites the sourceMappingURL comments to the hashed map names.
+VENDOR_ASSETS = [
+    ('bootstrap/css/bootstrap.min.css',
+     'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css'),
+    ('bootstrap/css/bootstrap.min.css.map',
+     'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css.map'),
+    ('bootstrap/js/bootstrap.min.js', 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.min.js'),
+    ('bootstrap/js/bootstrap.min.js.map',
+     'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.min.js.map'),
+    ('popper/popper.min.js', 'https://cdn.jsdelivr.net/npm/@popperjs/core@2.11.6/dist/umd/popper.min.js'),
+    ('popper/popper.min.js.map', 'https://cdn.jsdelivr.net/npm/@popperjs/core@2.11.6/dist/umd/popper.min.js.map'),
+    ('jquery/jquery.min.js', 'https://code.jquery.com/jquery-3.6.4.min.js'),
+]
+
+
+# Class: Command
+# Description: manage.py vendor_assets - downloads the pinned third-party assets (Bootstrap, Popper, jQuery)
+#              into static/vendor, where they are collected, hashed and compressed with the rest of the static
+#              files. Files already there are kept unless --force is given. The templates link these assets
+#              with {% vendor_static %} (Owner.templatetags.vendor), which serves a file from static/vendor
+#              once it is there and falls back to its pinned URL until then: commit the downloaded files and
+#              restart the server to stop loading them from the CDN.
+class Command(BaseCommand):
+    help = "Download the pinned Bootstrap, Popper and jQuery files into static/vendor."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Download the files even if they exist.")
+
+    def handle(self, *args, **options):
+        root = os.path.join(settings.BASE_DIR, 'static', 'vendor')
+        for name, url in VENDOR_ASSETS:
+            path = os.path.join(root, name)
+            if os.path.exists(path) and not options['force']:
+                self.stdout.write("%s is already vendored." % name)
+                continue
+            try:
+                with urllib.request.urlopen(url, timeout=30) as response:
+                    data = response.read()
+            except OSError as error:
+                raise CommandError("Could not download %s: %s" % (url, error))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(data)
+            self.stdout.write(self.style.SUCCESS("Vendored %s (%d bytes)." % (name, len(data))))
@@ -0,0 +1,149 @@
+import csv
+import json
+from collections import namedtuple
+
+from .models import Pizza, Topping
+
+# Supported file formats for menu imports and exports (NDJSON is the same format as JSON Lines)
+CSV = 'csv'
+JSON_LINES = 'jsonl'
+NDJSON = 'ndjson'
+FORMATS = (CSV, JSON_LINES, NDJSON)
+
+# Content type of each format, for HTTP downloads
+CONTENT_TYPES = {
+    CSV: 'text/csv; charset=utf-8',
+    JSON_LINES: 'application/jsonl; charset=utf-8',
+    NDJSON: 'application/x-ndjson; charset=utf-8',
+}
+
+# Record types
+TOPPING = 'topping'
+PIZZA = 'pizza'
+
+# CSV layout: one row per record, pizza toppings joined with TOPPING_SEPARATOR
+CSV_FIELDS = ['type', 'name', 'toppings']
+TOPPING_SEPARATOR = ';'
+
+# Maximum length of a topping or pizza name (Topping.name / Pizza.name max_length)
+MAX_NAME_LENGTH = 100
+
+
+# Class: MenuRecord
+# Description: One topping or pizza read from a menu file. line is the 1-based position of the record
+#              in the file, toppings is a list of topping names (empty for toppings).
+MenuRecord = namedtuple('MenuRecord', ['line', 'type', 'name', 'toppings'])
+
+
+# Class: RecordError
+# Description: A record that could not be read or failed validation, reported back to the user.
+RecordError = namedtuple('RecordError', ['line', 'reason'])
+
+
+# Function: guess_format
+# Parameters: path (str) - file name of the menu file
+# Description: Infers the menu file format from its extension.
+# Returns: CSV or JSON_LINES, or None if the extension is unknown
+def guess_format(path):
+    path = str(path).lower()
+    if path.endswith('.csv'):
+        return CSV
+    if path.endswith(('.jsonl', '.ndjson', '.json')):
+        return JSON_LINES
+    return None
+
+
+# Function: _parse
+# Parameters: line (int), data (dict) - a raw record
+# Description: Validates a raw record using the same rules as Topping.clean() / Pizza.clean():
+#              names are stripped and may not be empty or longer than MAX_NAME_LENGTH.
+# Returns: MenuRecord or RecordError
+def _parse(line, data):
+    kind = str(data.get('type') or '').strip().lower()
+    if kind not in (TOPPING, PIZZA):
+        return RecordError(line, "type must be 'topping' or 'pizza'")
+    name = str(data.get('name') or '').strip()
+    if not name:
+        return RecordError(line, "%s name cannot be empty" % kind)
+    if len(name) > MAX_NAME_LENGTH:
+        return RecordError(line, "%s name is longer than %d characters" % (kind, MAX_NAME_LENGTH))
+
+    toppings = data.get('toppings') or []
+    if isinstance(toppings, str):
+        toppings = toppings.split(TOPPING_SEPARATOR)
+    if not isinstance(toppings, list):
+        return RecordError(line, "toppings must be a list of names")
+    toppings = [str(topping).strip() for topping in toppings if str(topping).strip()]
+    if kind == PIZZA and not toppings:
+        return RecordError(line, "pizza needs at least one topping")
+    return MenuRecord(line, kind, name, toppings if kind == PIZZA else [])
+
+
+# Function: read_records
+# Parameters:
+#   - stream: text file object to read from
+#   - fmt: CSV or JSON_LINES
+# Description: Lazily reads a menu file one record at a time, so files of any size are read with
+#              constant memory. Malformed records are yielded as RecordError instead of raising.
+# Returns: generator of MenuRecord / RecordError
+def read_records(stream, fmt):
+    if fmt == CSV:
+        reader = csv.DictReader(stream)
+        for data in reader:
+            # reader.line_num counts physical lines, including the header
+            yield _parse(reader.line_num, data)
+    elif fmt in (JSON_LINES, NDJSON):
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                data = json.loads(text)
+            except ValueError:
+                yield RecordError(line, "invalid JSON")
+                continue
+            if not isinstance(data, dict):
+                yield RecordError(line, "record must be a JSON object")
+                continue
+            yield _parse(line, data)
+    else:
+        raise ValueError("Unknown menu format: %r" % fmt)
+
+
+# Function: iter_menu_records
+# Parameters: chunk_size (int) - number of rows fetched from the database at a time
+# Description: Lazily reads the whole catalog, toppings first and then pizzas, as plain dicts in the
+#              import format. Rows are streamed with chunked iterator() reads and each chunk of pizzas
+#              gets its toppings with one prefetch query, so memory use does not depend on menu size.
+# Returns: generator of dicts
+def iter_menu_records(chunk_size=2000):
+    for name in Topping.objects.values_list('name', flat=True).iterator(chunk_size=chunk_size):
+        yield {'type': TOPPING, 'name': name, 'toppings': []}
+    for pizza in Pizza.objects.with_toppings().iterator(chunk_size=chunk_size):
+        yield {'type': PIZZA, 'name': pizza.name, 'toppings': [topping.name for topping in pizza.toppings.all()]}
+
+
+# Class: _Echo
+# Description: File-like object whose write() returns the written value instead of storing it, so
+#              csv.writer can encode one row at a time for streaming.
+class _Echo:
+    def write(self, value):
+        return value
+
+
+# Function: encode_records
+# Parameters:
+#   - records: iterable of dicts in the import format
+#   - fmt: CSV, JSON_LINES or NDJSON
+# Description: Encodes records one line at a time in the given format, readable back by read_records().
+# Returns: generator of str
+def encode_records(records, fmt):
+    if fmt == CSV:
+        writer = csv.writer(_Echo())
+        yield writer.writerow(CSV_FIELDS)
+        for record in records:
+            yield writer.writerow([record['type'], record['name'], TOPPING_SEPARATOR.join(record['toppings'])])
+    elif fmt in (JSON_LINES, NDJSON):
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+    else:
+        raise ValueError("Unknown menu format: %r" % fmt)
@@ -0,0 +1,88 @@
+# Generated by Django 4.2.10 on 2026-10-18 12:56
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.functions.text
+
+# Maximum length of the names (CharField max_length)
+MAX_NAME_LENGTH = 100
+
+
+def _duplicate_groups(model, using):
+    # Rows grouped by the lowercase name the new constraints are on, lowest id first, for names held by several
+    rows = model.objects.using(using).annotate(key=django.db.models.functions.text.Lower('name'))
+    keys = rows.values('key').annotate(count=Count('pk')).filter(count__gt=1).values_list('key', flat=True)
+    for key in keys:
+        yield list(rows.filter(key=key).order_by('pk'))
+
+
+def merge_case_duplicates(apps, schema_editor):
+    # Names differing only in case were allowed until now, the constraints below would reject them
+    using = schema_editor.connection.alias
+    Topping = apps.get_model('Owner', 'Topping')
+    Pizza = apps.get_model('Owner', 'Pizza')
+    through = Pizza.toppings.through
+
+    # Toppings are the same ingredient: keep the oldest, give its pizzas the others' links, delete the others
+    for kept, *merged in _duplicate_groups(Topping, using):
+        merged_ids = [topping.pk for topping in merged]
+        links = through.objects.using(using).filter(topping_id__in=merged_ids)
+        having = set(through.objects.using(using).filter(topping_id=kept.pk).values_list('pizza_id', flat=True))
+        missing = set(links.values_list('pizza_id', flat=True)) - having
+        through.objects.using(using).bulk_create([through(pizza_id=pk, topping_id=kept.pk) for pk in missing])
+        links.delete()
+        Topping.objects.using(using).filter(pk__in=merged_ids).delete()
+
+    # Pizzas may be different recipes: keep the oldest name, number the others, e.g. "Margherita (2)"
+    for kept, *renamed in _duplicate_groups(Pizza, using):
+        number = 1
+        for pizza in renamed:
+            while True:
+                number += 1
+                suffix = ' (%d)' % number
+                name = pizza.name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+                if not Pizza.objects.using(using).filter(name__iexact=name).exists():
+                    break
+            pizza.name = name
+            pizza.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Owner', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_case_duplicates, migrations.RunPython.noop),
+        migrations.AlterModelOptions(
+            name='pizza',
+            options={'ordering': [django.db.models.functions.text.Lower('name')]},
+        ),
+        migrations.AlterModelOptions(
+            name='topping',
+            options={'ordering': [django.db.models.functions.text.Lower('name')]},
+        ),
+        migrations.AlterField(
+            model_name='pizza',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='topping',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='pizza',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'),
+                                               name='unique_pizza_name_ci',
+                                               violation_error_message='A pizza with this name already exists.'),
+        ),
+        migrations.AddConstraint(
+            model_name='topping',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'),
+                                               name='unique_topping_name_ci',
+                                               violation_error_message='A topping with this name already exists.'),
+        ),
+    ]
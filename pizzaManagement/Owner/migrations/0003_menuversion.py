@@ -0,0 +1,29 @@
+# Generated by Django 4.2.10 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_menu_version(apps, schema_editor):
+    # The single row MenuVersion.bump() increments
+    MenuVersion = apps.get_model('Owner', 'MenuVersion')
+    MenuVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Owner', '0002_case_insensitive_unique_names'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MenuVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(create_menu_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.10 on 2026-10-18 14:10
+
+from django.db import migrations
+
+# Roles and the usernames of the original single accounts holding them (see Owner.roles)
+ROLE_USERNAMES = {'Chef': 'Chef', 'Owner': 'Owner'}
+
+
+def create_role_groups(apps, schema_editor):
+    # One group per role; the existing Chef and Owner accounts join their group
+    Group = apps.get_model('auth', 'Group')
+    User = apps.get_model('auth', 'User')
+    for role, username in ROLE_USERNAMES.items():
+        group = Group.objects.get_or_create(name=role)[0]
+        group.user_set.add(*User.objects.filter(username=username))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('Owner', '0004_pizza_recipe_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_role_groups, migrations.RunPython.noop),
+    ]
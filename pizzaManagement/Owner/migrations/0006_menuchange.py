@@ -0,0 +1,22 @@
+# Generated by Django 4.2.10 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Owner', '0005_role_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MenuChange',
+            fields=[
+                ('sequence', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('topping', 'Topping'), ('pizza', 'Pizza')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.10 on 2026-10-18 14:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_user_versions(apps, schema_editor):
+    # Users without a version are never cached (see Owner.roles.get_cached_user)
+    User = apps.get_model('auth', 'User')
+    UserVersion = apps.get_model('Owner', 'UserVersion')
+    UserVersion.objects.bulk_create([UserVersion(user_id=pk) for pk in User.objects.values_list('pk', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('Owner', '0006_menuchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True,
+                                              serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_user_versions, migrations.RunPython.noop),
+    ]
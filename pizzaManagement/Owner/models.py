@@ -1,16 +1,29 @@
-from django.db import models
+import hashlib
+
+from django.conf import settings
+from django.db import connections, models, router
 from django.core.exceptions import ValidationError
 from django.db.models.functions import Lower
+from django.utils import timezone
+
+# Number of pizza ids per query when refreshing many recipe fingerprints (SQLite parameter limit)
+FINGERPRINT_BATCH_SIZE = 900
 
 
 # Class: Topping
 # Description: Model representing a pizza topping.
 class Topping(models.Model):
-    # Name of the topping, should be unique
-    name = models.CharField(max_length=100, unique=True, blank=False, null=False, db_index=True)
+    # Name of the topping, unique regardless of case (see Meta.constraints)
+    name = models.CharField(max_length=100, blank=False, null=False)
 
     class Meta:
         ordering = [Lower('name')]  # Case-insensitive ordering
+        constraints = [
+            # Functional unique index on the normalized name: enforces case-insensitive uniqueness
+            # in the database (race-free) and backs the lookups and ordering on Lower('name')
+            models.UniqueConstraint(Lower('name'), name='unique_topping_name_ci',
+                                    violation_error_message="A topping with this name already exists."),
+        ]
 
     def clean(self):
         if self.name:
@@ -22,6 +35,16 @@ class Topping(models.Model):
         # Returns the name of the topping
         return self.name
 
+    def validate_constraints(self, exclude=None):
+        # Set by UniqueNameModelForm: the database rejects duplicate names on save, without a query beforehand
+        if getattr(self, 'name_checked', False):
+            exclude = {*(exclude or ()), 'name'}
+        # The only constraint is on the name, so report violations against the name field
+        try:
+            super().validate_constraints(exclude=exclude)
+        except ValidationError as e:
+            raise ValidationError({'name': e.messages})
+
     def clean(self):
         # Check if the name is not None
         if self.name:
@@ -32,20 +55,116 @@ class Topping(models.Model):
                 raise ValidationError("Topping name cannot be empty.")
 
 
+# Function: recipe_fingerprint
+# Parameters: topping_ids (iterable of int)
+# Description: Fingerprint of a topping set: the SHA-1 of its sorted topping ids, so two pizzas with the same
+#              toppings have the same fingerprint whatever the order the toppings were added in.
+# Returns: str (40 hex characters), '' for a pizza without toppings
+def recipe_fingerprint(topping_ids):
+    ids = sorted(set(int(pk) for pk in topping_ids))
+    if not ids:
+        return ''
+    return hashlib.sha1(','.join(map(str, ids)).encode()).hexdigest()
+
+
+# Function: refresh_recipe_fingerprints
+# Parameters: pizza_ids (iterable of int)
+# Description: Refreshes the fingerprints of any number of pizzas (see PizzaQuerySet.refresh_recipe_fingerprints),
+#              FINGERPRINT_BATCH_SIZE ids per query.
+# Returns: int - number of pizzas whose fingerprint changed
+def refresh_recipe_fingerprints(pizza_ids):
+    pizza_ids = sorted(pizza_ids)
+    changed = 0
+    for start in range(0, len(pizza_ids), FINGERPRINT_BATCH_SIZE):
+        batch = pizza_ids[start:start + FINGERPRINT_BATCH_SIZE]
+        changed += Pizza.objects.filter(pk__in=batch).refresh_recipe_fingerprints()
+    return changed
+
+
+# Class: PizzaQuerySet
+# Description: Shared read path for the pizza menu. Every view that lists pizzas together with their
+#              toppings should go through with_toppings() so the number of queries stays constant
+#              no matter how many pizzas are on the menu.
+class PizzaQuerySet(models.QuerySet):
+    # Function: with_toppings
+    # Parameters: self
+    # Description: Prefetches the toppings of every pizza in the queryset in a single extra query
+    #              instead of one query per pizza (pizza.toppings.all in templates).
+    # Returns: PizzaQuerySet
+    def with_toppings(self):
+        return self.prefetch_related('toppings')
+
+    # Function: same_recipe
+    # Parameters: self, topping_ids (iterable of int)
+    # Description: Pizzas having exactly the given toppings, found with one lookup on the fingerprint index.
+    # Returns: PizzaQuerySet, empty for an empty topping set
+    def same_recipe(self, topping_ids):
+        fingerprint = recipe_fingerprint(topping_ids)
+        if not fingerprint:
+            return self.none()
+        return self.filter(recipe_fingerprint=fingerprint)
+
+    # Function: refresh_recipe_fingerprints
+    # Parameters: self
+    # Description: Recomputes the stored fingerprint of the pizzas in the queryset from their current
+    #              toppings (one query for the toppings, one prepared UPDATE run for the changed
+    #              fingerprints: bulk_update's CASE expressions take seconds for thousands of pizzas).
+    #              Sends no post_save, the fingerprint does not change how a pizza is displayed.
+    # Returns: int - number of pizzas whose fingerprint changed
+    def refresh_recipe_fingerprints(self):
+        pizzas = dict(self.order_by().values_list('pk', 'recipe_fingerprint'))
+        if not pizzas:
+            return 0
+        toppings = {pk: [] for pk in pizzas}
+        links = Pizza.toppings.through.objects.filter(pizza_id__in=pizzas).values_list('pizza_id', 'topping_id')
+        for pizza_id, topping_id in links:
+            toppings[pizza_id].append(topping_id)
+        changed = [(fingerprint, pk) for pk, fingerprint in
+                   ((pk, recipe_fingerprint(toppings[pk])) for pk in pizzas) if fingerprint != pizzas[pk]]
+        if changed:
+            connection = connections[router.db_for_write(Pizza)]
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.executemany('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                    quote(Pizza._meta.db_table), quote('recipe_fingerprint'), quote(Pizza._meta.pk.column)), changed)
+        return len(changed)
+
+
 # Class: Pizza
 # Description: Model representing a pizza which includes toppings.
 class Pizza(models.Model):
-    # Name of the pizza, should be unique
-    name = models.CharField(max_length=100, unique=True, blank=False, null=False, db_index=True)
+    # Name of the pizza, unique regardless of case (see Meta.constraints)
+    name = models.CharField(max_length=100, blank=False, null=False)
     toppings = models.ManyToManyField(Topping)  # Many-to-many relationship with Topping model
+    # Fingerprint of the topping set (see recipe_fingerprint), kept up to date by the m2m_changed receiver
+    # in signals.py. Indexed, so pizzas with identical toppings are found with a single lookup.
+    recipe_fingerprint = models.CharField(max_length=40, blank=True, default='', db_index=True, editable=False)
+
+    # Custom manager exposing the shared menu read path
+    objects = PizzaQuerySet.as_manager()
 
     class Meta:
         ordering = [Lower('name')]  # Case-insensitive ordering
+        constraints = [
+            # Functional unique index on the normalized name (see Topping.Meta.constraints)
+            models.UniqueConstraint(Lower('name'), name='unique_pizza_name_ci',
+                                    violation_error_message="A pizza with this name already exists."),
+        ]
 
     def __str__(self):
         # Returns the name of the pizza
         return self.name
 
+    def validate_constraints(self, exclude=None):
+        # Set by UniqueNameModelForm: the database rejects duplicate names on save, without a query beforehand
+        if getattr(self, 'name_checked', False):
+            exclude = {*(exclude or ()), 'name'}
+        # The only constraint is on the name, so report violations against the name field
+        try:
+            super().validate_constraints(exclude=exclude)
+        except ValidationError as e:
+            raise ValidationError({'name': e.messages})
+
     def clean(self):
         # Check if the name is not None
         if self.name:
@@ -54,3 +173,84 @@ class Pizza(models.Model):
             # Check if the pizza name is empty after stripping whitespace
             if not self.name:
                 raise ValidationError("Pizza name cannot be empty.")
+
+
+# Class: MenuVersion
+# Description: Single row table holding a counter that increases on every change of the menu (toppings,
+#              pizzas and their toppings). Dashboards derive their ETag from it, so an unchanged page can
+#              be answered with a 304 after one primary key lookup instead of reading the menu tables.
+class MenuVersion(models.Model):
+    # Primary key of the single row
+    SINGLETON_ID = 1
+
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return 'Menu version %d' % self.version
+
+    # Function: current
+    # Parameters: cls
+    # Description: Reads the current menu version with a single primary key lookup.
+    # Returns: (version, updated_at) tuple, (0, None) before the first change
+    @classmethod
+    def current(cls):
+        row = cls.objects.filter(pk=cls.SINGLETON_ID).values_list('version', 'updated_at').first()
+        return row or (0, None)
+
+    # Function: acurrent
+    # Parameters: cls
+    # Description: Async version of current(), for async views.
+    # Returns: (version, updated_at) tuple, (0, None) before the first change
+    @classmethod
+    async def acurrent(cls):
+        row = await cls.objects.filter(pk=cls.SINGLETON_ID).values_list('version', 'updated_at').afirst()
+        return row or (0, None)
+
+    # Function: bump
+    # Parameters: cls
+    # Description: Atomically increments the menu version. Call inside the transaction of the change.
+    # Returns: The new version (int)
+    @classmethod
+    def bump(cls):
+        now = timezone.now()
+        if not cls.objects.filter(pk=cls.SINGLETON_ID).update(version=models.F('version') + 1, updated_at=now):
+            # First change ever (or the row was removed): create the row
+            cls.objects.get_or_create(pk=cls.SINGLETON_ID, defaults={'version': 0, 'updated_at': now})
+            cls.objects.filter(pk=cls.SINGLETON_ID).update(version=models.F('version') + 1, updated_at=now)
+        return cls.objects.values_list('version', flat=True).get(pk=cls.SINGLETON_ID)
+
+
+# Class: MenuChange
+# Description: Append-only log of the writes to the topping, pizza and Pizza.toppings tables, for clients
+#              syncing the menu incrementally (see Owner.change_log). Rows are written by database triggers in
+#              the transaction of the write itself, so every change is logged, whatever wrote it, and a rolled
+#              back change never is. The sequence number only grows: a client that read up to sequence N gets
+#              everything after it from the rows with a larger one.
+class MenuChange(models.Model):
+    # Kinds of logged objects
+    TOPPING = 'topping'
+    PIZZA = 'pizza'
+
+    # Position in the log
+    sequence = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=10, choices=[(TOPPING, 'Topping'), (PIZZA, 'Pizza')])
+    # Id of the topping or pizza; a pizza is logged when its name or its toppings change
+    object_id = models.BigIntegerField()
+    # Tombstone: the object was deleted
+    deleted = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '%d: %s %d%s' % (self.sequence, self.kind, self.object_id, ' deleted' if self.deleted else '')
+
+
+# Class: UserVersion
+# Description: Counter increasing on every change to a user, its groups or a role group (see Owner.roles).
+#              Users cached by a server process are checked against it on every request, so a change made
+#              in one process is seen by all of them on their next request.
+class UserVersion(models.Model):
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return 'User %s version %d' % (self.user_id, self.version)
@@ -0,0 +1,124 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models.functions import Lower
+
+# Default number of rows per page when MENU_PAGE_SIZE is not configured
+DEFAULT_PAGE_SIZE = 50
+
+
+# Class: KeysetPage
+# Description: One page of a keyset (cursor) paginated listing. Cursors encode the case-insensitive
+#              name of the first/last row of the page, so fetching the next or previous page is a range
+#              scan on the Lower('name') unique index instead of an OFFSET over a full table sort.
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, prev_cursor=None):
+        # Rows on this page, in case-insensitive name order
+        self.object_list = object_list
+        # Cursor to pass as ?after= to get the following page (None on the last page)
+        self.next_cursor = next_cursor
+        # Cursor to pass as ?before= to get the preceding page (None on the first page)
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+# Function: encode_cursor
+# Parameters: key (str) - the lowercased name of a row
+# Description: Encodes a sort key into an opaque, URL safe cursor.
+# Returns: str
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# Function: decode_cursor
+# Parameters: cursor (str) - a cursor produced by encode_cursor
+# Description: Decodes a cursor back into its sort key. Malformed cursors are ignored.
+# Returns: The sort key, or None if the cursor is missing or invalid.
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        # Restore the padding stripped by encode_cursor
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+# Function: _page_queryset
+# Parameters: queryset, after, before, page_size - see paginate_by_name
+# Description: Builds the single LIMIT query fetching one page (plus one row to detect a following page).
+# Returns: (queryset, page_size, after_key, backward)
+def _page_queryset(queryset, after, before, page_size):
+    if page_size is None:
+        page_size = getattr(settings, 'MENU_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    after_key = decode_cursor(after)
+    before_key = decode_cursor(before)
+    # Annotate the sort key so the cursor values come from the database's own LOWER()
+    queryset = queryset.annotate(name_key=Lower('name'))
+
+    if before_key is not None and after_key is None:
+        # Backward navigation: scan down from the cursor
+        return queryset.filter(name_key__lt=before_key).order_by('-name_key')[:page_size + 1], page_size, None, True
+    # Forward navigation (or the first page)
+    if after_key is not None:
+        queryset = queryset.filter(name_key__gt=after_key)
+    return queryset.order_by('name_key')[:page_size + 1], page_size, after_key, False
+
+
+# Function: _build_page
+# Parameters:
+#   - rows: the rows fetched by the query of _page_queryset
+#   - page_size, after_key, backward: as returned by _page_queryset
+# Description: Trims the extra row and computes the cursors of the neighbouring pages.
+# Returns: KeysetPage
+def _build_page(rows, page_size, after_key, backward):
+    if backward:
+        # Flip the rows of a backward scan back into order
+        has_previous = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_next = True
+    else:
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_previous = after_key is not None
+
+    next_cursor = encode_cursor(rows[-1].name_key) if rows and has_next else None
+    prev_cursor = encode_cursor(rows[0].name_key) if rows and has_previous else None
+    return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+# Function: paginate_by_name
+# Parameters:
+#   - queryset: Topping or Pizza queryset to paginate
+#   - after: cursor of the row preceding the requested page (forward navigation)
+#   - before: cursor of the row following the requested page (backward navigation)
+#   - page_size: number of rows per page, defaults to settings.MENU_PAGE_SIZE
+# Description: Returns one page of the queryset ordered by Lower('name'). Each page is fetched with a
+#              single LIMIT query on the indexed sort key, costing O(page size) regardless of table size.
+# Returns: KeysetPage
+def paginate_by_name(queryset, after=None, before=None, page_size=None):
+    queryset, page_size, after_key, backward = _page_queryset(queryset, after, before, page_size)
+    return _build_page(list(queryset), page_size, after_key, backward)
+
+
+# Function: apaginate_by_name
+# Parameters: see paginate_by_name
+# Description: Async version of paginate_by_name(), fetching the page through the async ORM interface.
+# Returns: KeysetPage
+async def apaginate_by_name(queryset, after=None, before=None, page_size=None):
+    queryset, page_size, after_key, backward = _page_queryset(queryset, after, before, page_size)
+    return _build_page([row async for row in queryset], page_size, after_key, backward)
@@ -0,0 +1,152 @@
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import router
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+from .models import UserVersion
+
+# Roles, each backed by the auth Group of the same name. A store can have any number of chefs and owners.
+CHEF = 'Chef'
+OWNER = 'Owner'
+ROLES = (CHEF, OWNER)
+
+# Default lifetime in seconds of a cached user and its roles (checked against its version anyway)
+DEFAULT_TIMEOUT = 60 * 60
+
+
+# Function: user_key
+# Parameters: user_id, session_hash (str)
+# Description: Cache key of the user and roles cached for a session hash. Including the session hash means a
+#              password change never finds an old entry.
+# Returns: str
+def user_key(user_id, session_hash):
+    return 'auth:user:%s:%s' % (user_id, session_hash)
+
+
+# Function: user_roles
+# Parameters: user (User or AnonymousUser)
+# Description: Names of the roles of a user: the roles loaded with a cached user, otherwise one query.
+# Returns: frozenset of role names
+def user_roles(user):
+    if not user.is_authenticated:
+        return frozenset()
+    roles = getattr(user, '_menu_roles', None)
+    if roles is None:
+        roles = user._menu_roles = frozenset(user.groups.filter(name__in=ROLES).values_list('name', flat=True))
+    return roles
+
+
+# Function: has_role
+# Parameters: request (HttpRequest), role (CHEF or OWNER)
+# Description: Checks the user of the request is authenticated and has the role.
+# Returns: bool
+def has_role(request, role):
+    return role in user_roles(request.user)
+
+
+# Function: invalidate_users
+# Parameters: user_ids (iterable of int)
+# Description: Increases the versions of the given users in the transaction of the change, so the users
+#              cached by every server process are reloaded on their next request once it commits.
+# Returns: None
+def invalidate_users(user_ids):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    versions = UserVersion.objects.using(router.db_for_write(UserVersion))
+    versions.bulk_create([UserVersion(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+    versions.filter(user_id__in=user_ids).update(version=F('version') + 1)
+
+
+# Function: user_version
+# Parameters: user_id
+# Description: Current version of a user, read from the primary database (replicas may lag behind).
+# Returns: int, None if the user has none (deleted)
+def user_version(user_id):
+    return (UserVersion.objects.using(router.db_for_write(UserVersion)).filter(user_id=user_id)
+            .values_list('version', flat=True).first())
+
+
+# Function: get_cached_user
+# Parameters: request (HttpRequest)
+# Description: Loads the user of the session like django.contrib.auth.get_user(), reusing the user and
+#              roles cached for the session hash while the user's version in the database is unchanged: an
+#              authenticated request then costs one primary key lookup instead of the user and group queries.
+#              The cache may be local to the process, the version is what every process agrees on.
+# Returns: User or AnonymousUser
+def get_cached_user(request):
+    session = request.session
+    user_id = session.get(auth.SESSION_KEY)
+    session_hash = session.get(auth.HASH_SESSION_KEY)
+    backend_path = session.get(auth.BACKEND_SESSION_KEY)
+    if user_id is None or not session_hash or backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return auth.get_user(request)
+
+    key = user_key(user_id, session_hash)
+    # Read the version first: a change committed while loading the user only causes another miss
+    version = user_version(user_id)
+    entry = cache.get(key)
+    if entry is not None and version is not None and entry['version'] == version:
+        user = entry['user']
+        user._menu_roles = entry['roles']
+        return user
+
+    # Loads the user and verifies the session hash, logging the session out if it does not match
+    user = auth.get_user(request)
+    if user.is_authenticated and version is not None:
+        roles = user_roles(user)
+        cache.set(key, {'version': version, 'user': user, 'roles': roles},
+                  getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+    return user
+
+
+# Class: CachedAuthenticationMiddleware
+# Description: Drop-in replacement of django.contrib.auth's AuthenticationMiddleware that loads request.user
+#              with get_cached_user().
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    def process_request(self, request):
+        super().process_request(request)
+
+        def get_user():
+            if not hasattr(request, '_cached_user'):
+                request._cached_user = get_cached_user(request)
+            return request._cached_user
+        request.user = SimpleLazyObject(get_user)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, raw=False, **kwargs):
+    # Password, activation and permission changes; a new user gets its version row
+    if not raw:
+        invalidate_users([instance.pk])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # group.user_set.clear(): remember the members before the links are removed
+        instance._member_ids = list(instance.user_set.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # user.groups.add/remove/clear/set
+        invalidate_users([instance.pk])
+    elif action == 'post_clear':
+        invalidate_users(getattr(instance, '_member_ids', ()))
+    else:
+        # group.user_set.add/remove: pk_set holds the user ids
+        invalidate_users(pk_set or ())
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def group_changed(sender, instance, **kwargs):
+    # A renamed or deleted group changes the roles of all its members
+    if instance.pk is not None:
+        invalidate_users(instance.user_set.values_list('pk', flat=True))
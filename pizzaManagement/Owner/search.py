@@ -0,0 +1,334 @@
+import json
+import re
+import unicodedata
+
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.models import Q
+
+from .models import Pizza, Topping
+from .topping_index import filter_in
+
+# SQLite FTS5 tables indexing topping names, and pizza names together with the names of their toppings.
+# Row ids are the Topping / Pizza primary keys.
+TOPPING_INDEX = 'menu_search_topping'
+PIZZA_INDEX = 'menu_search_pizza'
+
+# Default and maximum number of results returned by a search
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Relative weight of the name and toppings columns when ranking pizzas (bm25)
+PIZZA_NAME_WEIGHT = 10.0
+PIZZA_TOPPINGS_WEIGHT = 1.0
+
+# A term with no indexed word starting with it is replaced by the indexed words within this many edits;
+# words of at least LONG_TERM_LENGTH characters may have two typos
+MAX_EDITS = 1
+LONG_TERM_LENGTH = 8
+# Maximum number of indexed words compared with a misspelled term
+MAX_TYPO_CANDIDATES = 2000
+
+# Aliases of the databases the search index is known to exist in
+_available = set()
+
+
+# Function: _tables
+# Parameters: None
+# Description: Table names used by the index SQL.
+# Returns: dict
+def _tables():
+    return {
+        'topping_index': TOPPING_INDEX,
+        'pizza_index': PIZZA_INDEX,
+        'topping': Topping._meta.db_table,
+        'pizza': Pizza._meta.db_table,
+        'through': Pizza.toppings.through._meta.db_table,
+    }
+
+
+# Space separated names of the toppings of the pizza whose id is given by the {pizza} expression
+PIZZA_TOPPINGS_SQL = (
+    "COALESCE((SELECT group_concat(t.name, ' ') FROM {through} pt JOIN {topping} t ON t.id = pt.topping_id "
+    "WHERE pt.pizza_id = {pizza}), '')"
+)
+
+# Index tables, created if missing. unicode61 folds case and diacritics; prefix indexes make short
+# prefix queries cheap. The fts5vocab tables list the indexed words, for typo correction.
+CREATE_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {topping_index} USING fts5("
+    "name, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {pizza_index} USING fts5("
+    "name, toppings, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {topping_index}_vocab USING fts5vocab({topping_index}, 'row')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {pizza_index}_vocab USING fts5vocab({pizza_index}, 'row')",
+]
+
+# Triggers keeping the index in sync with every write, including bulk_create, set-based deletes and raw SQL
+TRIGGERS = {
+    'menu_search_topping_ai': "AFTER INSERT ON {topping} BEGIN "
+                              "INSERT INTO {topping_index}(rowid, name) VALUES (NEW.id, NEW.name); END",
+    'menu_search_topping_au': "AFTER UPDATE OF name ON {topping} BEGIN "
+                              "UPDATE {topping_index} SET name = NEW.name WHERE rowid = NEW.id; "
+                              "UPDATE {pizza_index} SET toppings = "
+                              + PIZZA_TOPPINGS_SQL.replace('{pizza}', '{pizza_index}.rowid')
+                              + " WHERE rowid IN (SELECT pizza_id FROM {through} WHERE topping_id = NEW.id); END",
+    'menu_search_topping_ad': "AFTER DELETE ON {topping} BEGIN "
+                              "DELETE FROM {topping_index} WHERE rowid = OLD.id; END",
+    'menu_search_pizza_ai': "AFTER INSERT ON {pizza} BEGIN "
+                            "INSERT INTO {pizza_index}(rowid, name, toppings) VALUES (NEW.id, NEW.name, ''); END",
+    'menu_search_pizza_au': "AFTER UPDATE OF name ON {pizza} BEGIN "
+                            "UPDATE {pizza_index} SET name = NEW.name WHERE rowid = NEW.id; END",
+    'menu_search_pizza_ad': "AFTER DELETE ON {pizza} BEGIN "
+                            "DELETE FROM {pizza_index} WHERE rowid = OLD.id; END",
+    'menu_search_pizza_toppings_ai': "AFTER INSERT ON {through} BEGIN "
+                                     "UPDATE {pizza_index} SET toppings = "
+                                     + PIZZA_TOPPINGS_SQL.replace('{pizza}', 'NEW.pizza_id')
+                                     + " WHERE rowid = NEW.pizza_id; END",
+    'menu_search_pizza_toppings_ad': "AFTER DELETE ON {through} BEGIN "
+                                     "UPDATE {pizza_index} SET toppings = "
+                                     + PIZZA_TOPPINGS_SQL.replace('{pizza}', 'OLD.pizza_id')
+                                     + " WHERE rowid = OLD.pizza_id; END",
+}
+
+
+# Function: rebuild_search_index
+# Parameters: using (str) - database alias
+# Description: Refills both index tables from the topping, pizza and Pizza.toppings tables.
+# Returns: None
+def rebuild_search_index(using=DEFAULT_DB_ALIAS):
+    tables = _tables()
+    with connections[using].cursor() as cursor:
+        cursor.execute("DELETE FROM {topping_index}".format(**tables))
+        cursor.execute("INSERT INTO {topping_index}(rowid, name) SELECT id, name FROM {topping}".format(**tables))
+        cursor.execute("DELETE FROM {pizza_index}".format(**tables))
+        cursor.execute(("INSERT INTO {pizza_index}(rowid, name, toppings) SELECT p.id, p.name, "
+                        + PIZZA_TOPPINGS_SQL.replace('{pizza}', 'p.id') + " FROM {pizza} p").format(**tables))
+
+
+# Function: ensure_search_index
+# Parameters: using (str) - database alias
+# Description: Creates the index tables and triggers if they are missing and (re)builds the index when
+#              any trigger had to be created. Runs after every migrate: SQLite migrations that rebuild a
+#              table drop its triggers, which are restored here. Only SQLite builds with FTS5 are indexed;
+#              other databases fall back to icontains searches.
+# Returns: True if the index is available
+def ensure_search_index(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    tables = _tables()
+    try:
+        with connection.cursor() as cursor:
+            for sql in CREATE_INDEX_SQL:
+                cursor.execute(sql.format(**tables))
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+            existing = {row[0] for row in cursor.fetchall()}
+            missing = [name for name in TRIGGERS if name not in existing]
+            for name in missing:
+                cursor.execute(("CREATE TRIGGER %s " % name) + TRIGGERS[name].format(**tables))
+            # Rank pizzas matching their name above pizzas matching one of their toppings
+            cursor.execute("INSERT INTO {pizza_index}({pizza_index}, rank) VALUES ('rank', 'bm25(%s, %s)')".format(
+                **tables) % (PIZZA_NAME_WEIGHT, PIZZA_TOPPINGS_WEIGHT))
+    except OperationalError:
+        # SQLite built without FTS5
+        return False
+    if missing:
+        rebuild_search_index(using)
+    _available.add(using)
+    return True
+
+
+# Function: install_search_index
+# Parameters: sender (AppConfig), using (str) - database alias, kwargs
+# Description: post_migrate receiver creating or repairing the search index of the migrated database.
+# Returns: None
+def install_search_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    ensure_search_index(using)
+
+
+# Function: search_index_available
+# Parameters: using (str) - database alias
+# Description: Checks whether the FTS5 index exists in the database.
+# Returns: bool
+def search_index_available(using=DEFAULT_DB_ALIAS):
+    if using not in _available:
+        connection = connections[using]
+        if connection.vendor == 'sqlite' and TOPPING_INDEX in connection.introspection.table_names():
+            _available.add(using)
+    return using in _available
+
+
+# Function: tokenize
+# Parameters: query (str) - text typed by the user
+# Description: Splits a search query into words the way the unicode61 tokenizer does: case and
+#              diacritics are folded and anything but letters and digits separates words.
+# Returns: list of str
+def tokenize(query):
+    folded = unicodedata.normalize('NFKD', str(query).lower())
+    folded = ''.join(char for char in folded if not unicodedata.combining(char))
+    return re.findall(r'[^\W_]+', folded)
+
+
+# Function: edit_distance
+# Parameters: a (str), b (str), limit (int) - largest distance of interest
+# Description: Damerau-Levenshtein (optimal string alignment) distance between two words, giving up as
+#              soon as it exceeds limit.
+# Returns: int, limit + 1 if the distance is larger than limit
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+# Function: _corrections
+# Parameters: cursor, vocab (str) - fts5vocab table, term (str)
+# Description: Finds the indexed words a misspelled term may stand for. Candidates share the term's
+#              first letter and are read with a range scan of the vocabulary.
+# Returns: list of str (empty if the term is a prefix of an indexed word)
+def _corrections(cursor, vocab, term):
+    # Prefix of an indexed word: no correction needed
+    cursor.execute("SELECT 1 FROM %s WHERE term >= %%s AND term < %%s LIMIT 1" % vocab, [term, term + '\uffff'])
+    if cursor.fetchone():
+        return []
+    limit = 2 * MAX_EDITS if len(term) >= LONG_TERM_LENGTH else MAX_EDITS
+    cursor.execute("SELECT term FROM %s WHERE term >= %%s AND term < %%s AND length(term) BETWEEN %%s AND %%s "
+                   "LIMIT %%s" % vocab,
+                   [term[0], term[0] + '\uffff', len(term) - limit, len(term) + limit, MAX_TYPO_CANDIDATES])
+    return [candidate for (candidate,) in cursor.fetchall() if edit_distance(term, candidate, limit) <= limit]
+
+
+# Function: _match_expression
+# Parameters: cursor, vocab (str), terms (list of str)
+# Description: Builds the FTS5 MATCH expression of a query: every term must match, either as the prefix
+#              of a word or, if no word starts with it, as one of its corrections.
+# Returns: str
+def _match_expression(cursor, vocab, terms):
+    clauses = []
+    for term in terms:
+        corrections = _corrections(cursor, vocab, term)
+        if corrections:
+            clauses.append('(%s)' % ' OR '.join('"%s"' % word for word in corrections))
+        else:
+            clauses.append('"%s"*' % term)
+    return ' AND '.join(clauses)
+
+
+# Function: _ranked_ids
+# Parameters:
+#   - cursor
+#   - index (str): FTS5 table
+#   - expression (str): MATCH expression
+#   - limit (int): maximum number of rows
+#   - rowids (str): JSON array of the row ids to search among, None for all rows
+# Description: Runs a MATCH query and returns the best ranked rows of all its matches. FTS5 ranks every match
+#              but only keeps the best limit rows while sorting.
+# Returns: list of row ids
+def _ranked_ids(cursor, index, expression, limit, rowids=None):
+    sql, params = "SELECT rowid FROM %s WHERE %s MATCH %%s" % (index, index), [expression]
+    if rowids is not None:
+        sql += " AND rowid IN (SELECT value FROM json_each(%s))"
+        params.append(rowids)
+    cursor.execute(sql + " ORDER BY rank LIMIT %s", params + [limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+# Function: _search_ids
+# Parameters:
+#   - index (str): FTS5 table
+#   - query (str): text typed by the user
+#   - limit (int): maximum number of results
+#   - using (str): database alias
+#   - first_column (str): column whose matches are listed before matches of other columns
+#   - rowids (iterable of int): row ids to search among, None for all rows
+# Description: Runs a ranked search on an index table.
+# Returns: list of matching row ids, best match first
+def _search_ids(index, query, limit, using, first_column=None, rowids=None):
+    terms = tokenize(query)
+    if not terms:
+        return []
+    if rowids is not None:
+        # Sent as a single parameter, whatever the number of rows (SQLite parameter limit)
+        rowids = json.dumps(list(rowids))
+    with connections[using].cursor() as cursor:
+        expression = _match_expression(cursor, index + '_vocab', terms)
+        if first_column is None:
+            return _ranked_ids(cursor, index, expression, limit, rowids)
+        ids = _ranked_ids(cursor, index, '%s : (%s)' % (first_column, expression), limit, rowids)
+        if len(ids) < limit:
+            # Fill up with rows matching in the other columns
+            ids += [pk for pk in _ranked_ids(cursor, index, expression, limit + len(ids), rowids) if pk not in ids]
+        return ids[:limit]
+
+
+# Function: _clamp_limit
+# Parameters: limit - requested number of results
+# Description: Bounds the number of results of a search.
+# Returns: int
+def _clamp_limit(limit):
+    try:
+        return max(1, min(int(limit), MAX_LIMIT))
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+
+
+# Function: search_toppings
+# Parameters:
+#   - query (str): words to look for, the last ones may be incomplete or misspelled
+#   - limit (int): maximum number of results
+#   - using (str): database alias
+# Description: Finds toppings whose name contains words starting with every word of the query, best
+#              matches first.
+# Returns: list of Topping
+def search_toppings(query, limit=DEFAULT_LIMIT, using=DEFAULT_DB_ALIAS):
+    limit = _clamp_limit(limit)
+    if not search_index_available(using):
+        # No index: unranked substring search
+        terms = tokenize(query)
+        if not terms:
+            return []
+        toppings = Topping.objects.using(using)
+        for term in terms:
+            toppings = toppings.filter(name__icontains=term)
+        return list(toppings[:limit])
+    ids = _search_ids(TOPPING_INDEX, query, limit, using)
+    toppings = Topping.objects.using(using).in_bulk(ids)
+    return [toppings[pk] for pk in ids if pk in toppings]
+
+
+# Function: search_pizzas
+# Parameters:
+#   - query (str): words to look for in the pizza name or in the names of its toppings
+#   - limit (int): maximum number of results
+#   - using (str): database alias
+#   - pizza_ids (iterable of int): pizzas to search among, e.g. those matching a topping filter; None for all
+# Description: Finds pizzas by name or by the names of their toppings, pizzas matching on their name first.
+#              The pizza_ids restriction is applied by the search query itself, before the limit.
+#              The toppings of the results are prefetched.
+# Returns: list of Pizza
+def search_pizzas(query, limit=DEFAULT_LIMIT, using=DEFAULT_DB_ALIAS, pizza_ids=None):
+    limit = _clamp_limit(limit)
+    pizzas = Pizza.objects.using(using).with_toppings()
+    if not search_index_available(using):
+        # No index: unranked substring search on pizza and topping names
+        terms = tokenize(query)
+        if not terms:
+            return []
+        if pizza_ids is not None:
+            pizzas = filter_in(pizzas, 'pk', pizza_ids)
+        for term in terms:
+            pizzas = pizzas.filter(Q(name__icontains=term) | Q(toppings__name__icontains=term))
+        return list(pizzas.distinct()[:limit])
+    ids = _search_ids(PIZZA_INDEX, query, limit, using, first_column='name', rowids=pizza_ids)
+    pizzas = pizzas.in_bulk(ids)
+    return [pizzas[pk] for pk in ids if pk in pizzas]
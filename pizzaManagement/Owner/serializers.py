@@ -0,0 +1,21 @@
+# Plain dict representations of the menu models, shared by the JSON API and the menu exports.
+
+
+# Function: serialize_topping
+# Parameters: topping (Topping)
+# Description: Converts a topping into a JSON serializable dict.
+# Returns: dict
+def serialize_topping(topping):
+    return {'id': topping.id, 'name': topping.name}
+
+
+# Function: serialize_pizza
+# Parameters: pizza (Pizza) - should come from Pizza.objects.with_toppings() to avoid a query per pizza
+# Description: Converts a pizza and its toppings into a JSON serializable dict.
+# Returns: dict
+def serialize_pizza(pizza):
+    return {
+        'id': pizza.id,
+        'name': pizza.name,
+        'toppings': [serialize_topping(topping) for topping in pizza.toppings.all()],
+    }
@@ -0,0 +1,76 @@
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse
+from pizzaManagement.database import retry_on_lock
+
+from .api import ApiError
+
+
+# Function: aget_object_or_404
+# Parameters:
+#   - queryset: queryset to look the object up in
+#   - kwargs: lookup arguments, e.g. pk=1
+# Description: Async version of django.shortcuts.get_object_or_404() for async views.
+# Returns: The object, raises Http404 if it does not exist.
+async def aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404("No %s matches the given query." % queryset.model._meta.object_name)
+
+
+# Function: adelete
+# Parameters: obj (Model instance)
+# Description: Async version of obj.delete() for async views, retried if the database is locked by another
+#              writer (Model.delete() runs the delete and its signal handlers in one transaction).
+# Returns: The result of obj.delete()
+async def adelete(obj):
+    return await sync_to_async(retry_on_lock(obj.delete))()
+
+
+# Function: wants_fragment
+# Parameters: request (HttpRequest)
+# Description: Checks the request comes from a dashboard script (jQuery and the dashboards' fetch() calls send
+#              X-Requested-With), which only needs the changed row or card, or a JSON status, instead of a
+#              redirect to the full page.
+# Returns: bool
+def wants_fragment(request):
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+# Function: fragment_response
+# Parameters: fragment (str) - rendered row or card, status (int)
+# Description: Answers a fragment request with the HTML of the changed row or card.
+# Returns: HttpResponse
+def fragment_response(fragment, status=200):
+    return HttpResponse(fragment, status=status)
+
+
+# Function: fragment_error
+# Parameters: message (str), form (Form) - optional bound form that failed validation
+# Description: Answers a fragment request that could not be applied with a JSON error, like the API.
+# Returns: JsonResponse
+def fragment_error(message, form=None):
+    errors = {field: list(messages) for field, messages in form.errors.items()} if form is not None else None
+    return ApiError(message, errors=errors).response()
+
+
+# Function: astream
+# Parameters:
+#   - iterable: iterable of str that may query the database, e.g. a generator of encoded records
+#   - batch_size: number of items read per thread switch
+# Description: Async iterator for a StreamingHttpResponse served under ASGI. Django reads a sync iterator there
+#              with sync_to_async(list), building the whole body before the first byte is sent, so this reads
+#              batch_size items at a time in the thread ORM calls run in and yields each batch joined.
+# Returns: async generator of str
+async def astream(iterable, batch_size=500):
+    iterator = iter(iterable)
+    read = sync_to_async(lambda: list(islice(iterator, batch_size)))
+    try:
+        while batch := await read():
+            yield ''.join(batch)
+    finally:
+        # Closes the database cursor of a generator left unfinished
+        if hasattr(iterator, 'close'):
+            await sync_to_async(iterator.close)()
@@ -0,0 +1,129 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from .models import MenuVersion, Pizza, Topping, refresh_recipe_fingerprints
+
+# Default maximum number of pizza or topping ids sent with menu_changed, overridden by
+# MENU_INVALIDATION_LIMIT. Past it, receivers drop everything at once instead of item by item.
+DEFAULT_INVALIDATION_LIMIT = 1000
+
+# Sent whenever toppings or pizzas change, with the ids of everything whose rendering is affected:
+#   - pizza_ids: pizzas that were created, renamed, deleted or whose toppings changed
+#   - topping_ids: toppings that were created, renamed or deleted
+#   - version: the new MenuVersion after the change
+# pizza_ids or topping_ids is None when more than MENU_INVALIDATION_LIMIT changed: every pizza (or topping)
+# must then be treated as changed.
+# Model signals are translated into this signal below. Bulk operations that bypass model signals
+# (bulk_create, set-based deletes) must call notify_menu_changed() themselves, and set or refresh the
+# recipe fingerprint of the pizzas whose toppings they write.
+menu_changed = Signal()
+
+# Changes gathered by collect_menu_changes in the current thread: [pizza ids, topping ids], None outside of it
+_collected = threading.local()
+
+
+# Function: notify_menu_changed
+# Parameters:
+#   - pizza_ids: iterable of affected pizza ids
+#   - topping_ids: iterable of affected topping ids
+# Description: Bumps the persisted menu version and announces the change to every menu_changed receiver.
+#              The bump runs in the caller's transaction, so it is rolled back together with the change.
+#              Id sets over MENU_INVALIDATION_LIMIT are sent as None (everything changed), so a change
+#              touching thousands of pizzas costs the receivers one global invalidation.
+# Returns: The new menu version, or None if nothing changed (or the change is collected, see below)
+def notify_menu_changed(pizza_ids=(), topping_ids=()):
+    pizza_ids, topping_ids = set(pizza_ids), set(topping_ids)
+    changes = getattr(_collected, 'changes', None)
+    if changes is not None:
+        # Sent once at the end of collect_menu_changes
+        changes[0] |= pizza_ids
+        changes[1] |= topping_ids
+        return None
+    if not (pizza_ids or topping_ids):
+        return None
+    limit = getattr(settings, 'MENU_INVALIDATION_LIMIT', DEFAULT_INVALIDATION_LIMIT)
+    if len(pizza_ids) > limit:
+        pizza_ids = None
+    if len(topping_ids) > limit:
+        topping_ids = None
+    version = MenuVersion.bump()
+    menu_changed.send(sender=Pizza, pizza_ids=pizza_ids, topping_ids=topping_ids, version=version)
+    return version
+
+
+# Function: collect_menu_changes
+# Parameters: none
+# Description: Context manager merging the notify_menu_changed calls made inside it, by a bulk write and the
+#              model signals it triggers, into one change: the menu version is bumped and menu_changed sent
+#              once when the block ends, instead of once per call. Nothing is sent if the block raises.
+#              Use it inside the transaction of the write; nested blocks join the outer one.
+# Returns: context manager
+@contextmanager
+def collect_menu_changes():
+    if getattr(_collected, 'changes', None) is not None:
+        yield
+        return
+    _collected.changes = changes = [set(), set()]
+    try:
+        yield
+    finally:
+        _collected.changes = None
+    notify_menu_changed(pizza_ids=changes[0], topping_ids=changes[1])
+
+
+# Function: _pizzas_using
+# Parameters: topping_id (int)
+# Description: Looks up the pizzas that have the given topping.
+# Returns: set of pizza ids
+def _pizzas_using(topping_id):
+    return set(Pizza.toppings.through.objects.filter(topping_id=topping_id).values_list('pizza_id', flat=True))
+
+
+@receiver(post_save, sender=Topping)
+def topping_saved(sender, instance, created, **kwargs):
+    # A new topping is not on any pizza yet; a renamed one changes every pizza that uses it
+    notify_menu_changed(pizza_ids=() if created else _pizzas_using(instance.pk), topping_ids=[instance.pk])
+
+
+@receiver(pre_delete, sender=Topping)
+def topping_deleting(sender, instance, **kwargs):
+    # Remember the pizzas using the topping before the deletion removes the links
+    instance._affected_pizza_ids = _pizzas_using(instance.pk)
+
+
+@receiver(post_delete, sender=Topping)
+def topping_deleted(sender, instance, **kwargs):
+    pizza_ids = getattr(instance, '_affected_pizza_ids', ())
+    # The deletion removed the topping from these pizzas without sending m2m_changed
+    refresh_recipe_fingerprints(pizza_ids)
+    notify_menu_changed(pizza_ids=pizza_ids, topping_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Pizza)
+@receiver(post_delete, sender=Pizza)
+def pizza_saved_or_deleted(sender, instance, **kwargs):
+    notify_menu_changed(pizza_ids=[instance.pk])
+
+
+@receiver(m2m_changed, sender=Pizza.toppings.through)
+def pizza_toppings_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # topping.pizza_set.clear(): remember the pizzas before the links are removed
+        instance._affected_pizza_ids = _pizzas_using(instance.pk)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        # pizza.toppings.add/remove/clear/set
+        pizza_ids = [instance.pk]
+    elif action == 'post_clear':
+        pizza_ids = getattr(instance, '_affected_pizza_ids', ())
+    else:
+        # topping.pizza_set.add/remove: pk_set holds the pizza ids
+        pizza_ids = pk_set or ()
+    # Keep the recipe fingerprints in step with the toppings
+    refresh_recipe_fingerprints(pizza_ids)
+    notify_menu_changed(pizza_ids=pizza_ids)
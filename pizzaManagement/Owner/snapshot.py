@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .change_log import change_log_available, latest_sequence
+from .models import MenuVersion, Pizza, Topping
+from .signals import menu_changed
+
+try:
+    import msgpack
+except ImportError:
+    # Optional: without it only the JSON document is written
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Default seconds between a menu change and the snapshot rebuild, overridden by MENU_SNAPSHOT_DELAY. Changes
+# committed meanwhile are included in the same rebuild.
+DEFAULT_DELAY = 2.0
+
+# Layout version of the snapshot document, bumped on incompatible changes
+SNAPSHOT_FORMAT = 1
+
+# Snapshot encodings: file name and content type of each
+JSON = 'json'
+MSGPACK = 'msgpack'
+FILE_NAMES = {JSON: 'menu.json', MSGPACK: 'menu.msgpack'}
+CONTENT_TYPES = {JSON: 'application/json', MSGPACK: 'application/msgpack'}
+
+# The version is the first key of the JSON document, so it can be read without parsing the rest
+_JSON_VERSION = re.compile(rb'^\{"version":(\d+)')
+
+
+# Function: build_snapshot
+# Parameters: None
+# Description: Reads the whole catalog from the primary database in one transaction (so it matches the
+#              version it records) with three queries, whatever the menu size. The document is compact:
+#              toppings are [id, name] pairs and pizzas [id, name, [topping ids]], both ordered by name. It
+#              records the change log position too, for clients to follow the changes from /menu/changes/.
+# Returns: dict with version, format, sequence (None without a change log), generated_at, toppings and pizzas
+def build_snapshot():
+    database = router.db_for_write(Pizza)
+    with transaction.atomic(using=database):
+        version = (MenuVersion.objects.using(database).filter(pk=MenuVersion.SINGLETON_ID)
+                   .values_list('version', flat=True).first() or 0)
+        sequence = latest_sequence(database) if change_log_available(database) else None
+        toppings = list(Topping.objects.using(database).order_by('name').values_list('pk', 'name'))
+        recipes = {}
+        for pizza_id, topping_id in (Pizza.toppings.through.objects.using(database).order_by('topping_id')
+                                     .values_list('pizza_id', 'topping_id').iterator(chunk_size=10000)):
+            recipes.setdefault(pizza_id, []).append(topping_id)
+        pizzas = [[pk, name, recipes.get(pk, [])]
+                  for pk, name in Pizza.objects.using(database).order_by('name').values_list('pk', 'name')]
+    return {
+        'version': version,
+        'format': SNAPSHOT_FORMAT,
+        'sequence': sequence,
+        'generated_at': timezone.now().isoformat(),
+        'toppings': [list(topping) for topping in toppings],
+        'pizzas': pizzas,
+    }
+
+
+# Function: encode_snapshot
+# Parameters: snapshot (dict) - result of build_snapshot()
+# Description: Encodes the snapshot in every available encoding.
+# Returns: dict mapping JSON / MSGPACK to bytes, without MSGPACK if the msgpack package is missing
+def encode_snapshot(snapshot):
+    encoded = {JSON: json.dumps(snapshot, separators=(',', ':'), ensure_ascii=False).encode('utf-8')}
+    if msgpack is not None:
+        encoded[MSGPACK] = msgpack.packb(snapshot)
+    return encoded
+
+
+# Function: _written_version
+# Parameters: path (str) - JSON snapshot file
+# Description: Reads the version of a snapshot already on disk from the start of the file.
+# Returns: int, or None if there is no readable snapshot
+def _written_version(path):
+    try:
+        with open(path, 'rb') as file:
+            match = _JSON_VERSION.match(file.read(64))
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+# Function: _write_atomic
+# Parameters: path (str), data (bytes)
+# Description: Replaces a file in one step: the data is written and flushed to a temporary file in the same
+#              directory, which is then renamed over the file. Readers see the old or the new file, never
+#              a partial one.
+# Returns: None
+def _write_atomic(path, data):
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp creates the file readable by its owner only; a web server in front may serve it too
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+# Class: SnapshotWriter
+# Description: Keeps the menu snapshot files in MENU_SNAPSHOT_DIR up to date. Changes are debounced: the first
+#              committed change schedules a rebuild MENU_SNAPSHOT_DELAY seconds later, on a timer thread, and
+#              the changes committed until then are picked up by the same rebuild. Only a published snapshot
+#              (one built by build_menu_snapshot or by a first request) is kept up to date.
+class SnapshotWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Pending rebuild, None if there is none
+        self._timer = None
+
+    # Function: path
+    # Parameters: self, encoding (JSON or MSGPACK)
+    # Description: Location of the snapshot file of an encoding.
+    # Returns: str
+    def path(self, encoding=JSON):
+        return os.path.join(str(settings.MENU_SNAPSHOT_DIR), FILE_NAMES[encoding])
+
+    # Function: published
+    # Parameters: self
+    # Description: Checks a snapshot has been written, so it must follow the menu changes.
+    # Returns: bool
+    def published(self):
+        return os.path.exists(self.path())
+
+    # Function: pending
+    # Parameters: self
+    # Description: Checks a rebuild is scheduled.
+    # Returns: bool
+    @property
+    def pending(self):
+        return self._timer is not None
+
+    # Function: write
+    # Parameters: self
+    # Description: Builds the snapshot and replaces the files of every encoding. If another process already
+    #              wrote a newer version meanwhile, nothing is replaced.
+    # Returns: (version written, dict mapping each encoding to its size in bytes), sizes empty if skipped
+    def write(self):
+        snapshot = build_snapshot()
+        os.makedirs(str(settings.MENU_SNAPSHOT_DIR), exist_ok=True)
+        written = _written_version(self.path())
+        if written is not None and written > snapshot['version']:
+            return snapshot['version'], {}
+        encoded = encode_snapshot(snapshot)
+        # The MessagePack file first: once the JSON one is replaced, the snapshot counts as written
+        for encoding in (MSGPACK, JSON):
+            if encoding in encoded:
+                _write_atomic(self.path(encoding), encoded[encoding])
+            elif os.path.exists(self.path(encoding)):
+                # Left by a previous build, it would no longer match
+                os.remove(self.path(encoding))
+        return snapshot['version'], {encoding: len(data) for encoding, data in encoded.items()}
+
+    # Function: schedule
+    # Parameters: self
+    # Description: Schedules a rebuild, unless one is pending already; safe to call from any thread.
+    # Returns: None
+    def schedule(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(getattr(settings, 'MENU_SNAPSHOT_DELAY', DEFAULT_DELAY), self._rebuild)
+            # A rebuild still pending when the server stops is dropped; build_menu_snapshot catches up
+            self._timer.daemon = True
+            self._timer.start()
+
+    # Function: cancel
+    # Parameters: self
+    # Description: Drops the pending rebuild, if any.
+    # Returns: None
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _rebuild(self):
+        with self._lock:
+            # Cleared first: a change committed while building schedules another rebuild
+            self._timer = None
+        try:
+            self.write()
+        except Exception:
+            logger.exception("Could not rebuild the menu snapshot")
+        finally:
+            # The timer thread's own connections
+            connections.close_all()
+
+
+# Snapshot writer of this process
+snapshot_writer = SnapshotWriter()
+
+
+# Function: read_snapshot
+# Parameters: encoding (JSON or MSGPACK)
+# Description: Reads a snapshot file, without any database access.
+# Returns: (bytes, ETag) or None if the file does not exist
+def read_snapshot(encoding=JSON):
+    try:
+        with open(snapshot_writer.path(encoding), 'rb') as file:
+            stat = os.fstat(file.fileno())
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    # Every rebuild replaces the file, which changes its modification time
+    return data, '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+@receiver(menu_changed)
+def refresh_menu_snapshot(sender, **kwargs):
+    # Nothing to keep up to date until a snapshot is published
+    if not snapshot_writer.published():
+        return
+    # Scheduled once committed, so the rebuild reads the change; a rolled back change schedules nothing
+    transaction.on_commit(snapshot_writer.schedule)
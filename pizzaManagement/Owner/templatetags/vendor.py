@@ -0,0 +1,34 @@
+from functools import lru_cache
+
+from django import template
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+
+from ..management.commands.vendor_assets import VENDOR_ASSETS
+
+register = template.Library()
+
+# Pinned CDN URL of every vendored asset, by its path under static/vendor
+CDN_URLS = dict(VENDOR_ASSETS)
+
+
+# Function: is_vendored
+# Parameters: name (str) - path under static/vendor
+# Description: Checks whether the asset is in static/vendor (looked up once per process).
+# Returns: bool
+@lru_cache(maxsize=None)
+def is_vendored(name):
+    return finders.find('vendor/' + name) is not None
+
+
+# Function: vendor_static
+# Parameters: name (str) - path under static/vendor, one of VENDOR_ASSETS
+# Description: Template tag linking a third-party asset: {% vendor_static 'bootstrap/css/bootstrap.min.css' %}
+#              is the {% static %} URL of the file (hashed when DEBUG is off) once it is in static/vendor, see
+#              manage.py vendor_assets, and its pinned CDN URL until then.
+# Returns: str
+@register.simple_tag
+def vendor_static(name):
+    if is_vendored(name):
+        return static('vendor/' + name)
+    return CDN_URLS[name]
@@ -1,10 +1,39 @@
+import asyncio
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.test import TestCase
-from .models import Pizza, Topping
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from .models import MenuChange, MenuVersion, Pizza, Topping, recipe_fingerprint
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
+from django.contrib.sessions.models import Session
+from Chef.views import render_pizza_cards
+from . import change_log, fragment_cache, roles, search, views
+from .change_log import changes_since, latest_sequence
+from .bulk_edit import merge_toppings
+from .deletion import delete_toppings, deletion_impact
+from .benchmark import ENDPOINTS, benchmark_endpoint, compare_results, generate_menu
 from .forms import ToppingForm
+from .live import CHANGE, RELOAD, Broadcaster, broadcaster
+from .menu_io import iter_menu_records
+from .roles import CHEF, OWNER
+from .pagination import decode_cursor, encode_cursor, paginate_by_name
+from .search import ensure_search_index, search_pizzas, search_toppings
+from .signals import notify_menu_changed
+from .snapshot import build_snapshot, msgpack as snapshot_msgpack, snapshot_writer
+from .topping_index import topping_index
 
 
 # ----------------------------- OWNER DASHBOARD TESTING --------------------------- #
@@ -20,6 +49,7 @@ class OwnerDashboardIntegrationTest(TestCase):
         cls.owner_username = 'Owner'
         cls.owner_password = 'SupremeSlicesOwner'
         cls.owner = User.objects.create_user(username=cls.owner_username, password=cls.owner_password)
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
 
     # Test if the Owner Dashboard view returns a 200 OK status code
     def test_owner_dashboard_view(self):
@@ -106,6 +136,1159 @@ class OwnerDashboardIntegrationTest(TestCase):
         self.assertFormError(response, 'form', 'name', 'This field is required.')
 
 
+# ----------------------------- PAGINATION TESTING ------------------------------ #
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Mixed case names to check the ordering is case-insensitive
+        for name in ['basil', 'Cheese', 'anchovies', 'Ham', 'garlic', 'Olives', 'mushrooms']:
+            Topping.objects.create(name=name)
+
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    # Helper returning the names on a page
+    def names(self, page):
+        return [topping.name for topping in page]
+
+    # Test walking forward and backward through the pages
+    def test_forward_and_backward(self):
+        first = paginate_by_name(Topping.objects.all(), page_size=3)
+        self.assertEqual(self.names(first), ['anchovies', 'basil', 'Cheese'])
+        self.assertFalse(first.has_previous)
+        self.assertTrue(first.has_next)
+
+        second = paginate_by_name(Topping.objects.all(), after=first.next_cursor, page_size=3)
+        self.assertEqual(self.names(second), ['garlic', 'Ham', 'mushrooms'])
+
+        last = paginate_by_name(Topping.objects.all(), after=second.next_cursor, page_size=3)
+        self.assertEqual(self.names(last), ['Olives'])
+        self.assertFalse(last.has_next)
+
+        # Going back from the last page returns the second page again
+        back = paginate_by_name(Topping.objects.all(), before=last.prev_cursor, page_size=3)
+        self.assertEqual(self.names(back), self.names(second))
+        self.assertTrue(back.has_previous)
+        back = paginate_by_name(Topping.objects.all(), before=back.prev_cursor, page_size=3)
+        self.assertEqual(self.names(back), self.names(first))
+        self.assertFalse(back.has_previous)
+
+    # Test that each page is a single query
+    def test_page_is_single_query(self):
+        first = paginate_by_name(Topping.objects.all(), page_size=2)
+        with self.assertNumQueries(1):
+            paginate_by_name(Topping.objects.all(), after=first.next_cursor, page_size=2)
+
+    # Test cursor encoding and malformed cursors
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor('🍄 mushrooms')), '🍄 mushrooms')
+        self.assertIsNone(decode_cursor('not a cursor!'))
+        page = paginate_by_name(Topping.objects.all(), after='not a cursor!', page_size=3)
+        self.assertEqual(self.names(page), ['anchovies', 'basil', 'Cheese'])
+
+    # Test that the dashboard renders a page with a link to the next one
+    @override_settings(MENU_PAGE_SIZE=5)
+    def test_dashboard_pages(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('topping_list'))
+        self.assertEqual(len(response.context['toppings']), 5)
+        self.assertNotContains(response, 'Olives')
+        response = self.client.get(reverse('topping_list'), {'after': response.context['page'].next_cursor})
+        self.assertEqual(self.names(response.context['toppings']), ['mushrooms', 'Olives'])
+
+
+# ------------------------------------ API TESTING ------------------------------------ #
+class ToppingApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.mushrooms = Topping.objects.create(name='Mushrooms')
+
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    # Helper posting a bulk payload as JSON
+    def bulk(self, payload):
+        return self.client.post(reverse('api_toppings_bulk'), payload, content_type='application/json')
+
+    # Test the list and detail endpoints
+    def test_list_and_detail(self):
+        response = self.client.get(reverse('api_toppings'))
+        self.assertEqual(response.json()['results'], [
+            {'id': self.mushrooms.id, 'name': 'Mushrooms'},
+            {'id': self.pepperoni.id, 'name': 'Pepperoni'},
+        ])
+        response = self.client.get(reverse('api_topping_detail', args=[self.pepperoni.id]))
+        self.assertEqual(response.json(), {'id': self.pepperoni.id, 'name': 'Pepperoni'})
+        response = self.client.get(reverse('api_topping_detail', args=[9999]))
+        self.assertEqual(response.status_code, 404)
+
+    # Test creating, updating and deleting in one request
+    def test_bulk_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk({
+                'create': [{'name': 'Olive %d' % i} for i in range(100)],
+                'update': [{'id': self.pepperoni.id, 'name': ' Spicy Pepperoni '}],
+                'delete': [self.mushrooms.id],
+            })
+        self.assertEqual(response.status_code, 200)
+        # The names are checked with one query for the whole batch, not one per item
+        self.assertLess(len(queries), 30)
+        self.assertEqual(len(response.json()['created']), 100)
+        self.assertEqual(response.json()['updated'], [{'id': self.pepperoni.id, 'name': 'Spicy Pepperoni'}])
+        self.assertEqual(response.json()['deleted'], [self.mushrooms.id])
+        self.assertEqual(Topping.objects.count(), 101)
+        self.assertFalse(Topping.objects.filter(pk=self.mushrooms.id).exists())
+
+    # Test that one invalid item rolls back the whole request
+    def test_bulk_write_is_atomic(self):
+        response = self.bulk({
+            'create': [{'name': 'Olives'}, {'name': 'pepperoni'}, {'name': 'OLIVES'}],
+            'delete': [self.mushrooms.id],
+        })
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']['create']
+        self.assertEqual(errors['1'], {'name': ['A topping with this name already exists.']})
+        self.assertEqual(errors['2'], {'name': ['A topping with this name already exists.']})
+        self.assertNotIn('0', errors)
+        # Nothing was written, including the delete
+        self.assertEqual(Topping.objects.count(), 2)
+
+    # Test that a deleted name can be reused in the same request
+    def test_bulk_write_reuses_deleted_name(self):
+        response = self.bulk({'create': [{'name': 'mushrooms'}], 'delete': [self.mushrooms.id]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Topping.objects.values_list('name', flat=True)), ['mushrooms', 'Pepperoni'])
+
+    # Test malformed requests
+    def test_bulk_write_bad_requests(self):
+        self.assertEqual(self.client.post(reverse('api_toppings_bulk'), 'not json',
+                                          content_type='application/json').status_code, 400)
+        self.assertEqual(self.bulk({'create': 'Olives'}).status_code, 400)
+        self.assertEqual(self.bulk({'delete': [9999]}).status_code, 400)
+        # Ids that are not integers are all listed, before anything is looked up
+        response = self.bulk({'delete': [[1], {'a': 1}, True, self.mushrooms.id],
+                              'update': [{'id': [1], 'name': 'Olives'}, {'name': 'Capers'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['errors']['delete']), {'0', '1', '2'})
+        self.assertEqual(response.json()['errors']['update']['1'], {'id': ['Must be an integer id.']})
+        self.assertTrue(Topping.objects.filter(pk=self.mushrooms.id).exists())
+        with override_settings(API_BULK_LIMIT=2):
+            self.assertEqual(self.bulk({'create': [{'name': 'A'}, {'name': 'B'}, {'name': 'C'}]}).status_code, 413)
+        self.assertEqual(self.client.get(reverse('api_toppings_bulk')).status_code, 405)
+
+    # Test the API requires the Owner role
+    def test_api_requires_owner(self):
+        self.client.force_login(User.objects.create_user(username='not_an_owner', password='test123'))
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 403)
+        self.assertEqual(self.bulk({'delete': [self.pepperoni.id]}).status_code, 403)
+        self.assertTrue(Topping.objects.filter(pk=self.pepperoni.id).exists())
+
+
+# ----------------------------------- IMPORT TESTING ---------------------------------- #
+class ImportMenuCommandTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Topping.objects.create(name='Pepperoni')
+
+    # Helper writing a menu file and importing it
+    def import_menu(self, suffix, content, *args):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'menu' + suffix)
+        with open(path, 'w', encoding='utf-8') as menu_file:
+            menu_file.write(content)
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_menu', path, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    # Test importing a CSV file
+    def test_import_csv(self):
+        stdout, stderr = self.import_menu('.csv', (
+            'type,name,toppings\n'
+            'topping, Mushrooms ,\n'
+            'topping,olives,\n'
+            'pizza,Veggie,mushrooms;Olives\n'
+            'pizza,Pepperoni Pizza,PEPPERONI\n'
+        ))
+        self.assertIn('Imported 2 toppings and 2 pizzas from 4 rows', stdout)
+        self.assertEqual(stderr, '')
+        veggie = Pizza.objects.get(name='Veggie')
+        self.assertEqual([topping.name for topping in veggie.toppings.all()], ['Mushrooms', 'olives'])
+        self.assertEqual(Pizza.objects.get(name='Pepperoni Pizza').toppings.get().name, 'Pepperoni')
+
+    # Test that invalid and duplicate rows are rejected and reported
+    def test_import_rejects(self):
+        stdout, stderr = self.import_menu('.jsonl', '\n'.join([
+            '{"type": "topping", "name": "pepperoni"}',
+            '{"type": "topping", "name": "Ham"}',
+            '{"type": "topping", "name": " ham "}',
+            '{"type": "topping", "name": "   "}',
+            '{"type": "pizza", "name": "Hawaiian", "toppings": ["Ham", "Pineapple"]}',
+            '{"type": "pizza", "name": "Plain", "toppings": []}',
+            '{"type": "salad", "name": "Caesar"}',
+            'not json',
+        ]))
+        self.assertIn('Imported 1 toppings and 0 pizzas from 8 rows', stdout)
+        self.assertIn('7 rejected', stdout)
+        self.assertIn("Line 1 rejected: a topping named 'pepperoni' already exists", stderr)
+        self.assertIn('Line 3 rejected: duplicate of line 2', stderr)
+        self.assertIn('Line 5 rejected: unknown topping(s): Pineapple', stderr)
+        self.assertEqual(sorted(Topping.objects.values_list('name', flat=True)), ['Ham', 'Pepperoni'])
+
+    # Test that each batch costs a constant number of queries
+    def test_import_queries_per_batch(self):
+        rows = ['{"type": "topping", "name": "Topping %d"}' % i for i in range(50)]
+        rows += ['{"type": "pizza", "name": "Pizza %d", "toppings": ["Topping %d", "Pepperoni"]}' % (i, i)
+                 for i in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            self.import_menu('.jsonl', '\n'.join(rows), '--batch-size', '100')
+        # Ignore savepoints and the menu version bump of each batch
+        statements = [q['sql'] for q in queries
+                      if 'SAVEPOINT' not in q['sql'] and 'Owner_menuversion' not in q['sql']]
+        # Topping lookup + insert, topping resolution, pizza lookup + insert, through insert, fingerprint update
+        self.assertEqual(len(statements), 7)
+        self.assertEqual(Pizza.toppings.through.objects.count(), 100)
+
+
+# ----------------------------------- EXPORT TESTING ---------------------------------- #
+class ExportMenuTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.toppings = [Topping.objects.create(name=name) for name in ['Pepperoni', 'Ham', 'Pineapple']]
+        for i in range(10):
+            pizza = Pizza.objects.create(name='Pizza %02d' % i)
+            pizza.toppings.set(cls.toppings[:i % 3 + 1])
+
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    # Test the streamed CSV download
+    def test_export_csv_endpoint(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('export_menu'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="menu.csv"')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[:2], ['type,name,toppings', 'topping,Ham,'])
+        self.assertIn('pizza,Pizza 02,Ham;Pepperoni;Pineapple', lines)
+        self.assertEqual(len(lines), 1 + 3 + 10)
+
+    # Test the NDJSON download and the endpoint permissions
+    def test_export_ndjson_endpoint(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('export_menu'), {'format': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(records[3], {'type': 'pizza', 'name': 'Pizza 00', 'toppings': ['Pepperoni']})
+        self.assertEqual(self.client.get(reverse('export_menu'), {'format': 'xml'}).status_code, 400)
+
+        self.client.force_login(User.objects.create_user(username='not_an_owner', password='test123'))
+        self.assertEqual(self.client.get(reverse('export_menu')).status_code, 403)
+
+    # Test that pizzas are read in chunks with one topping query per chunk, not one per pizza
+    def test_export_queries_per_chunk(self):
+        with self.assertNumQueries(1 + 1 + 3):
+            records = list(iter_menu_records(chunk_size=4))
+        self.assertEqual(len(records), 13)
+
+    # Test that an export can be imported back
+    def test_export_import_round_trip(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'menu.jsonl')
+        call_command('export_menu', '--output', path)
+        exported = [(pizza.name, [topping.name for topping in pizza.toppings.all()])
+                    for pizza in Pizza.objects.with_toppings()]
+
+        Pizza.objects.all().delete()
+        Topping.objects.all().delete()
+        call_command('import_menu', path, stdout=StringIO())
+        imported = [(pizza.name, [topping.name for topping in pizza.toppings.all()])
+                    for pizza in Pizza.objects.with_toppings()]
+        self.assertEqual(imported, exported)
+
+
+# Class: ExportMenuAsgiTest
+# Description: Runs the export through the ASGI handler, which reads the rows in its own thread (so the data
+#              is committed rather than kept in a test transaction).
+class ExportMenuAsgiTest(TransactionTestCase):
+    # Test that the first chunk is sent before the catalog has been read
+    def test_streamed_under_asgi(self):
+        Topping.objects.bulk_create([Topping(name='Topping %04d' % i) for i in range(1200)])
+        client = Client()
+        user = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        user.groups.add(Group.objects.get_or_create(name=OWNER)[0])
+        client.force_login(user)
+        read = []
+
+        def records():
+            for record in iter_menu_records():
+                read.append(record)
+                yield record
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': reverse('export_menu'), 'raw_path': b'', 'root_path': '',
+            'query_string': b'', 'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+            'headers': [(b'host', b'testserver'), (b'cookie', client.cookies.output(header='', sep=';').encode())],
+        }
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        sent, read_before_first_chunk = [], []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and not read_before_first_chunk:
+                read_before_first_chunk.append(len(read))
+            sent.append(message)
+        with mock.patch.object(views, 'iter_menu_records', records):
+            async_to_sync(ASGIHandler())(scope, receive, send)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertLess(read_before_first_chunk[0], 1200)
+        body = b''.join(message.get('body', b'') for message in sent[1:]).decode()
+        self.assertEqual(body.splitlines()[:2], ['type,name,toppings', 'topping,Topping 0000,'])
+        self.assertEqual(len(body.splitlines()), 1 + 1200)
+
+
+# ------------------------------- FRAGMENT CACHE TESTING ------------------------------ #
+class FragmentCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.ham = Topping.objects.create(name='Ham')
+        cls.pepperoni_pizza = Pizza.objects.create(name='Pepperoni Pizza')
+        cls.pepperoni_pizza.toppings.set([cls.pepperoni])
+        cls.ham_pizza = Pizza.objects.create(name='Ham Pizza')
+        cls.ham_pizza.toppings.set([cls.ham])
+
+        # Create a Chef user
+        cls.chef = User.objects.create_user(username='Chef', password='SupremeSlicesChef')
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
+
+    def setUp(self):
+        cache.clear()
+
+    # Helper rendering the cards of both pizzas
+    def render_cards(self):
+        return render_pizza_cards(list(Pizza.objects.all()))
+
+    # Helper returning the cached fragment version of a pizza card
+    def card_version(self, pizza):
+        return cache.get(fragment_cache.version_key(fragment_cache.PIZZA_CARD, pizza.pk))
+
+    # Test that cached cards are reused without touching the database
+    def test_cards_are_cached(self):
+        first = self.render_cards()
+        self.assertIn('Pepperoni', first[1])
+        # Rendering again needs no topping queries, only the MenuVersion check
+        pizzas = list(Pizza.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(render_pizza_cards(pizzas), first)
+        # None at all when the caller already read the MenuVersion
+        menu_version = MenuVersion.current()
+        with self.assertNumQueries(0):
+            self.assertEqual(render_pizza_cards(pizzas, menu_version), first)
+        self.assertEqual(fragment_cache.stats(), {'hits': 4, 'misses': 2, 'hit_rate': 4 / 6})
+
+    # Test that a change made by another process, only seen in the database MenuVersion, drops every card,
+    # while a change committed by this process keeps the cards it does not affect
+    def test_menu_version_check(self):
+        self.render_cards()
+        ham_version = self.card_version(self.ham_pizza)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pepperoni_pizza.toppings.add(self.ham)
+        self.render_cards()
+        self.assertEqual(self.card_version(self.ham_pizza), ham_version)
+        # Another process renamed the ham: its cache never heard of it
+        Topping.objects.filter(pk=self.ham.pk).update(name='Smoked Ham')
+        MenuVersion.bump()
+        cards = self.render_cards()
+        self.assertIn('Smoked Ham', cards[0])
+        self.assertIn('Smoked Ham', cards[1])
+
+    # Test that renaming a topping only invalidates the cards of the pizzas using it
+    def test_topping_rename_invalidates_affected_cards(self):
+        self.render_cards()
+        ham_version = self.card_version(self.ham_pizza)
+        self.pepperoni.name = 'Spicy Pepperoni'
+        self.pepperoni.save()
+        self.assertIsNone(self.card_version(self.pepperoni_pizza))
+        self.assertEqual(self.card_version(self.ham_pizza), ham_version)
+        self.assertIn('Spicy Pepperoni', self.render_cards()[1])
+
+    # Test that topping changes and topping deletion invalidate the affected cards
+    def test_m2m_and_delete_invalidate_cards(self):
+        self.render_cards()
+        self.ham_pizza.toppings.add(self.pepperoni)
+        self.assertIsNone(self.card_version(self.ham_pizza))
+        self.render_cards()
+        self.ham.delete()
+        self.assertIsNone(self.card_version(self.ham_pizza))
+        self.assertIsNotNone(self.card_version(self.pepperoni_pizza))
+        self.assertNotIn('Ham</li>', self.render_cards()[0])
+
+    # Test that the dashboard shows fresh cards and that cards hold no CSRF token
+    def test_dashboard_uses_fresh_cards(self):
+        self.client.force_login(self.chef)
+        self.client.get(reverse('chef_dashboard'))
+        self.ham.name = 'Smoked Ham'
+        self.ham.save()
+        response = self.client.get(reverse('chef_dashboard'))
+        self.assertContains(response, '<li class="topping">Smoked Ham</li>', html=True)
+        self.assertNotIn('csrfmiddlewaretoken', ''.join(response.context['pizza_cards']))
+        self.assertContains(response, 'csrfmiddlewaretoken', count=2)
+
+
+# ---------------------------------- TOPPING DELETION TESTING ---------------------------------- #
+class ToppingDeletionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cheese = Topping.objects.create(name='Cheese')
+        cls.ham = Topping.objects.create(name='Ham')
+        cls.margherita = Pizza.objects.create(name='Margherita')
+        cls.margherita.toppings.set([cls.cheese])
+        cls.ham_pizza = Pizza.objects.create(name='Ham and Cheese')
+        cls.ham_pizza.toppings.set([cls.cheese, cls.ham])
+        cls.plain_ham = Pizza.objects.create(name='Plain Ham')
+        cls.plain_ham.toppings.set([cls.ham])
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    # Test that the preview counts the affected pizzas with a fixed number of aggregate queries
+    def test_impact_preview(self):
+        with self.assertNumQueries(3):
+            impact = deletion_impact([self.cheese.pk])
+        self.assertEqual(impact, {'toppings': 1, 'pizzas': 2, 'links': 2, 'emptied': 1,
+                                  'sample': ['Ham and Cheese', 'Margherita']})
+        response = self.client.get(reverse('api_topping_impact', args=[self.ham.pk]))
+        self.assertEqual(response.json()['pizzas'], 2)
+        self.assertEqual(self.client.get(reverse('api_topping_impact', args=[0])).status_code, 404)
+
+    # Test that deleting a topping removes its links in one statement and keeps the recipes consistent
+    def test_set_based_delete(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('delete_topping', args=[self.cheese.pk]))
+        self.assertRedirects(response, reverse('topping_list'), fetch_redirect_response=False)
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 2)
+        self.assertFalse(Topping.objects.filter(pk=self.cheese.pk).exists())
+        self.assertEqual(list(self.ham_pizza.toppings.all()), [self.ham])
+        # Both remaining recipes are now the same, and the emptied pizza has no fingerprint
+        self.ham_pizza.refresh_from_db()
+        self.margherita.refresh_from_db()
+        self.assertEqual(self.ham_pizza.recipe_fingerprint, recipe_fingerprint([self.ham.pk]))
+        self.assertEqual(self.margherita.recipe_fingerprint, '')
+        self.assertEqual(len(topping_index.match(all_of=[self.ham.pk])), 2)
+
+    # Test that a change over MENU_INVALIDATION_LIMIT invalidates every fragment at once
+    @override_settings(MENU_INVALIDATION_LIMIT=1)
+    def test_invalidation_limit(self):
+        render_pizza_cards([self.plain_ham])
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_toppings([self.cheese.pk])
+        # plain_ham does not use the cheese, its card is still dropped with the others
+        render_pizza_cards([self.plain_ham])
+        self.assertEqual(fragment_cache.stats()['misses'], 2)
+
+
+# ---------------------------------- TOPPING MERGE TESTING ------------------------------------ #
+class ToppingMergeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.mushroom = Topping.objects.create(name='Mushroom')
+        cls.mushrooms = Topping.objects.create(name='Mushrooms')
+        cls.funghi = Topping.objects.create(name='Funghi')
+        cls.cheese = Topping.objects.create(name='Cheese')
+        cls.classic = Pizza.objects.create(name='Classic')
+        cls.classic.toppings.set([cls.mushroom, cls.cheese])
+        cls.both = Pizza.objects.create(name='Both')
+        cls.both.toppings.set([cls.mushroom, cls.mushrooms])
+        cls.legacy = Pizza.objects.create(name='Legacy')
+        cls.legacy.toppings.set([cls.mushrooms, cls.cheese])
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    def setUp(self):
+        # The index is shared by every test, start from this test's menu
+        topping_index.rebuild()
+        self.client.force_login(self.owner)
+
+    # Helper posting a merge payload as JSON
+    def merge(self, payload):
+        return self.client.post(reverse('api_toppings_merge'), payload, content_type='application/json')
+
+    # Test that the duplicates' pizzas are remapped with set-based statements and the canonical topping renamed
+    def test_merge(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.merge({'into': self.mushroom.pk, 'toppings': [self.mushrooms.pk, self.funghi.pk],
+                                   'name': 'Mushrooms'})
+        self.assertEqual(response.json(), {'topping': self.mushroom.pk, 'merged': 2, 'pizzas': 2, 'added': 1,
+                                           'removed': 2, 'duplicates': [['Classic', 'Legacy']]})
+        writes = [query['sql'].split()[0] for query in queries if query['sql'].startswith(('INSERT', 'DELETE'))]
+        self.assertEqual(writes, ['INSERT', 'DELETE', 'DELETE'])
+        self.assertEqual(list(Topping.objects.values_list('name', flat=True)), ['Cheese', 'Mushrooms'])
+        self.assertEqual(list(self.both.toppings.all()), [self.mushroom])
+        self.legacy.refresh_from_db()
+        self.assertEqual(self.legacy.recipe_fingerprint, recipe_fingerprint([self.mushroom.pk, self.cheese.pk]))
+        self.assertEqual(len(topping_index.match(all_of=[self.mushroom.pk])), 3)
+
+    # Test that an invalid request changes nothing
+    def test_merge_rejected(self):
+        response = self.merge({'into': self.mushroom.pk, 'toppings': [self.mushrooms.pk], 'name': 'cheese'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('name', response.json()['errors'])
+        response = self.merge({'into': self.mushroom.pk, 'toppings': [0]})
+        self.assertEqual(response.status_code, 404)
+        # Nothing left to merge once the target is taken out
+        response = self.merge({'into': self.mushroom.pk, 'toppings': [self.mushroom.pk]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(merge_toppings(self.mushroom.pk, [self.mushroom.pk])['merged'], 0)
+        self.assertEqual(Topping.objects.count(), 4)
+        self.assertEqual(list(self.legacy.toppings.all()), [self.cheese, self.mushrooms])
+
+
+# ---------------------------------- FRAGMENT RESPONSE TESTING ------------------------------- #
+class ToppingFragmentTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+        # Dashboard scripts send X-Requested-With, as jQuery does
+        self.headers = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+    # Test that adding a topping answers with its row only, without listing the other toppings
+    def test_add(self):
+        for index in range(20):
+            Topping.objects.create(name='Topping %d' % index)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('add_topping'), {'name': 'Olives'}, **self.headers)
+        self.assertEqual(response.status_code, 201)
+        olives = Topping.objects.get(name='Olives')
+        self.assertContains(response, 'data-menu-id="%d"' % olives.pk, status_code=201)
+        self.assertNotContains(response, 'Pepperoni', status_code=201)
+        # Only the uniqueness check reads the toppings, the topping list is not queried nor rendered
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT "Owner_topping"."id"')])
+        response = self.client.post(reverse('add_topping'), {'name': 'olives'}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "This topping already exists!")
+
+    # Test that updating answers with the new row and deleting with a JSON status
+    def test_update_and_delete(self):
+        response = self.client.post(reverse('update_topping', args=[self.pepperoni.pk]), {'name': 'Salami'},
+                                    **self.headers)
+        self.assertContains(response, 'Salami')
+        self.assertNotContains(response, '<html')
+        response = self.client.post(reverse('update_topping', args=[self.pepperoni.pk]), {'name': ''},
+                                    **self.headers)
+        self.assertIn('name', response.json()['errors'])
+        response = self.client.post(reverse('delete_topping', args=[self.pepperoni.pk]), **self.headers)
+        self.assertEqual(response.json(), {'deleted': self.pepperoni.pk, 'pizzas': 0})
+        self.assertFalse(Topping.objects.exists())
+
+
+# ---------------------------------- LIVE UPDATES TESTING ------------------------------------ #
+class LiveMenuTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    # Helper renaming the pepperoni and running the commit callbacks
+    def rename(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pepperoni.name = name
+            self.pepperoni.save()
+
+    # Test that a change reaches a connected dashboard with the new fragment of the changed topping
+    async def test_stream(self):
+        await sync_to_async(self.async_client.force_login)(self.owner)
+        response = await self.async_client.get(reverse('menu_events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = asyncio.Queue()
+
+        async def consume():
+            async for chunk in response.streaming_content:
+                await chunks.put(chunk)
+        client = asyncio.ensure_future(consume())
+        try:
+            self.assertEqual(await asyncio.wait_for(chunks.get(), 5), b'retry: 3000\n\n')
+            await sync_to_async(self.rename)('Salami')
+            event = (await asyncio.wait_for(chunks.get(), 5)).decode()
+        finally:
+            # As StreamDisconnectMiddleware does when the client goes away
+            client.cancel()
+            await asyncio.gather(client, return_exceptions=True)
+        self.assertEqual(broadcaster.subscribers, 0)
+        version, kind, data = [line.split(': ', 1)[1] for line in event.strip().split('\n')]
+        self.assertEqual((int(version), kind), (await MenuVersion.acurrent())[0:1] + (CHANGE,))
+        topping = json.loads(data)['toppings'][str(self.pepperoni.pk)]
+        self.assertEqual(topping['name'], 'Salami')
+        self.assertIn('data-menu-id="%d"' % self.pepperoni.pk, topping['html'])
+
+    # Test that a reconnecting client gets the events it missed, or a reload if some are unknown
+    async def test_resume(self):
+        events = Broadcaster(history=2)
+        for version in (1, 2, 3):
+            events.publish(version, CHANGE, '{"v": %d}' % version)
+        self.assertEqual([event[0] for event in events.missed(1, 3)], [2, 3])
+        self.assertIsNone(events.missed(0, 3))
+        version = await sync_to_async(MenuVersion.bump)()
+        stream = events.stream(last_version=0)
+        try:
+            await anext(stream)
+            self.assertEqual(await anext(stream), 'id: %d\nevent: %s\ndata: {}\n\n' % (version, RELOAD))
+        finally:
+            await stream.aclose()
+        self.assertEqual(events.subscribers, 0)
+
+    # Test that a version published out of order, or not published in this process, turns into a reload
+    async def test_gap_reloads(self):
+        events = Broadcaster()
+        current, _ = await MenuVersion.acurrent()
+        stream = events.stream()
+        try:
+            await anext(stream)
+            events.publish(current + 1, CHANGE, '{"v": 1}')
+            self.assertEqual(await anext(stream), 'id: %d\nevent: %s\ndata: {"v": 1}\n\n' % (current + 1, CHANGE))
+            # current + 2 is published after current + 3, by a slower thread
+            events.publish(current + 3, CHANGE, '{"v": 3}')
+            events.publish(current + 2, CHANGE, '{"v": 2}')
+            events.publish(current + 4, CHANGE, '{"v": 4}')
+            self.assertEqual(await anext(stream), 'id: %d\nevent: %s\ndata: {}\n\n' % (current + 3, RELOAD))
+            self.assertEqual(await anext(stream), 'id: %d\nevent: %s\ndata: {"v": 4}\n\n' % (current + 4, CHANGE))
+            # current + 5 was made by another process, current + 6 here: the check sees no newer version
+            events.publish(current + 6, CHANGE, '{"v": 6}')
+            self.assertEqual(await anext(stream), 'id: %d\nevent: %s\ndata: {}\n\n' % (current + 6, RELOAD))
+        finally:
+            await stream.aclose()
+
+    # Test that only dashboard users get the stream, and that WSGI servers tell the browser not to reconnect
+    def test_access(self):
+        self.assertEqual(self.client.get(reverse('menu_events')).status_code, 403)
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('menu_events')).status_code, 204)
+        self.assertEqual(broadcaster.subscribers, 0)
+
+
+# ---------------------------------- MENU SNAPSHOT TESTING ---------------------------------- #
+class MenuSnapshotTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cheese = Topping.objects.create(name='Cheese')
+        cls.basil = Topping.objects.create(name='Basil')
+        cls.margherita = Pizza.objects.create(name='Margherita')
+        cls.margherita.toppings.set([cls.cheese, cls.basil])
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot_settings = override_settings(MENU_SNAPSHOT_DIR=directory.name)
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+        self.addCleanup(snapshot_writer.cancel)
+        self.directory = directory.name
+
+    # Test that the snapshot holds the whole catalog and its version, written without temporary files left
+    def test_write(self):
+        version, sizes = snapshot_writer.write()
+        self.assertEqual(version, MenuVersion.current()[0])
+        with open(snapshot_writer.path(), 'rb') as file:
+            snapshot = json.loads(file.read())
+        self.assertEqual(sizes['json'], os.path.getsize(snapshot_writer.path()))
+        self.assertEqual(snapshot['version'], version)
+        self.assertEqual(snapshot['toppings'], [[self.basil.pk, 'Basil'], [self.cheese.pk, 'Cheese']])
+        self.assertEqual(snapshot['pizzas'], [[self.margherita.pk, 'Margherita', sorted([self.cheese.pk,
+                                                                                        self.basil.pk])]])
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted('menu.' + encoding for encoding in sizes))
+        # An older build never replaces a newer snapshot written by another process
+        MenuVersion.objects.update(version=version - 1)
+        self.assertEqual(snapshot_writer.write(), (version - 1, {}))
+
+    # Test that the snapshot is served without database access, and revalidated with its ETag
+    def test_serve(self):
+        url = reverse('menu_snapshot')
+        # The first request builds the missing snapshot
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['pizzas'][0][1], 'Margherita')
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            etag = response['ETag']
+            for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=if_none_match).status_code, 304)
+            # Neither a fragment of the tag nor a list without it matches
+            for if_none_match in (etag[1:-2], '"other"', '"%s-gzip"' % etag.strip('"')):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=if_none_match).status_code, 200)
+            msgpack_response = self.client.get(url, {'format': 'msgpack'})
+        self.assertEqual(msgpack_response.status_code, 200 if snapshot_msgpack else 404)
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.post(url).status_code, 405)
+
+    # Test that committed changes schedule a single debounced rebuild, once a snapshot is published
+    def test_refresh(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Topping.objects.create(name='Olives')
+        self.assertFalse(snapshot_writer.pending)
+        snapshot_writer.write()
+        with override_settings(MENU_SNAPSHOT_DELAY=60), self.captureOnCommitCallbacks(execute=True):
+            Topping.objects.create(name='Onions')
+            Pizza.objects.create(name='Marinara')
+        self.assertTrue(snapshot_writer.pending)
+        timer = snapshot_writer._timer
+        snapshot_writer.schedule()
+        self.assertIs(snapshot_writer._timer, timer)
+
+
+# ---------------------------------- CHANGE LOG TESTING ---------------------------------- #
+class ChangeLogTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cheese = Topping.objects.create(name='Cheese')
+        cls.basil = Topping.objects.create(name='Basil')
+        cls.margherita = Pizza.objects.create(name='Margherita')
+        cls.margherita.toppings.set([cls.cheese, cls.basil])
+
+    # Test that every kind of write is logged, and merged into the current state of each changed object
+    def test_changes_since(self):
+        since = latest_sequence()
+        olives = Topping.objects.create(name='Olives')
+        self.cheese.name = 'Mozzarella'
+        self.cheese.save()
+        marinara = Pizza.objects.create(name='Marinara')
+        marinara.toppings.set([self.basil, olives])
+        margherita_id = self.margherita.pk
+        self.margherita.delete()
+        changes = changes_since(since)
+        self.assertFalse(changes['reset'])
+        self.assertFalse(changes['more'])
+        self.assertEqual(changes['next'], latest_sequence())
+        self.assertEqual(changes['toppings'], {'updated': [[self.cheese.pk, 'Mozzarella'], [olives.pk, 'Olives']],
+                                               'deleted': []})
+        # Renaming a topping does not change the pizzas listing its id; the deleted pizza is a tombstone
+        self.assertEqual(changes['pizzas'], {'updated': [[marinara.pk, 'Marinara', sorted([self.basil.pk,
+                                                                                          olives.pk])]],
+                                             'deleted': [margherita_id]})
+        self.assertEqual(changes_since(changes['next'])['pizzas'], {'updated': [], 'deleted': []})
+
+    # Test that set-based writes are logged, and rolled back writes are not
+    def test_bulk_and_rollback(self):
+        since = latest_sequence()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Topping.objects.create(name='Olives')
+            Topping.objects.create(name='olives')
+        self.assertEqual(latest_sequence(), since)
+        delete_toppings([self.basil.pk])
+        changes = changes_since(since)
+        self.assertEqual(changes['toppings']['deleted'], [self.basil.pk])
+        self.assertEqual(changes['pizzas']['updated'], [[self.margherita.pk, 'Margherita', [self.cheese.pk]]])
+
+    # Test that clients page through long logs, and are reset when their position is not in the log
+    def test_paging_and_reset(self):
+        since = latest_sequence()
+        Topping.objects.bulk_create([Topping(name='Topping %d' % index) for index in range(5)])
+        first = changes_since(since, limit=3)
+        self.assertTrue(first['more'])
+        self.assertEqual(len(first['toppings']['updated']), 3)
+        rest = changes_since(first['next'], limit=3)
+        self.assertFalse(rest['more'])
+        self.assertEqual(len(rest['toppings']['updated']), 2)
+        self.assertTrue(changes_since(latest_sequence() + 1)['reset'])
+        # Pruned entries cannot be replayed
+        MenuChange.objects.filter(sequence__lte=since + 1).delete()
+        self.assertTrue(changes_since(since)['reset'])
+        self.assertFalse(changes_since(since + 1)['reset'])
+
+    # Test that a menu written before the log existed is logged once, so a first sync from 0 gets all of it
+    def test_existing_menu_is_seeded(self):
+        table = MenuChange._meta.db_table
+        with connection.cursor() as cursor:
+            # A database migrated from before the log: no triggers, no log
+            for name in change_log.TRIGGERS:
+                cursor.execute('DROP TRIGGER %s' % name)
+            cursor.execute('DELETE FROM %s' % table)
+            cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [table])
+        self.assertEqual(changes_since(0)['toppings']['updated'], [])
+        change_log.ensure_change_log()
+        changes = changes_since(0)
+        self.assertFalse(changes['reset'])
+        self.assertEqual(changes['toppings']['updated'], [[self.cheese.pk, 'Cheese'], [self.basil.pk, 'Basil']])
+        self.assertEqual(changes['pizzas']['updated'],
+                         [[self.margherita.pk, 'Margherita', sorted([self.cheese.pk, self.basil.pk])]])
+
+    # Test that the log keeps about MENU_CHANGE_LOG_RETENTION rows, and clients behind them are reset
+    def test_retention(self):
+        since = latest_sequence()
+        with override_settings(MENU_CHANGE_LOG_RETENTION=10):
+            change_log.ensure_change_log()
+            Topping.objects.bulk_create([Topping(name='Topping %d' % index) for index in range(30)])
+        self.assertLessEqual(MenuChange.objects.count(), 11)
+        self.assertTrue(changes_since(since)['reset'])
+        self.assertFalse(changes_since(latest_sequence() - 5)['reset'])
+
+    # Test the public endpoint and the snapshot position terminals start from
+    def test_endpoint(self):
+        since = latest_sequence()
+        Topping.objects.create(name='Olives')
+        response = self.client.get(reverse('menu_changes'), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['toppings']['updated'][0][1], 'Olives')
+        self.assertEqual(self.client.get(reverse('menu_changes'), {'since': '-1'}).status_code, 400)
+        self.assertEqual(build_snapshot()['sequence'], latest_sequence())
+
+
+# ---------------------------------- CONDITIONAL GET TESTING ---------------------------------- #
+class MenuVersionConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    # Test that every menu change bumps the version, including bulk paths
+    def test_changes_bump_version(self):
+        version = MenuVersion.current()[0]
+        Topping.objects.create(name='Ham')
+        self.assertEqual(MenuVersion.current()[0], version + 1)
+        notify_menu_changed(topping_ids=[self.pepperoni.pk])
+        self.assertEqual(MenuVersion.current()[0], version + 2)
+        # Nothing changed, nothing bumped
+        self.assertIsNone(notify_menu_changed())
+        self.assertEqual(MenuVersion.current()[0], version + 2)
+
+    # Test that an unchanged dashboard is answered with 304 after a single menu version lookup
+    def test_dashboard_not_modified(self):
+        response = self.client.get(reverse('owner_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('owner_dashboard'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        tables = ' '.join(q['sql'] for q in queries)
+        self.assertNotIn('Owner_topping', tables)
+        self.assertNotIn('Owner_pizza', tables)
+
+    # Test that a menu change invalidates the ETag
+    def test_change_invalidates_etag(self):
+        etag = self.client.get(reverse('topping_list'))['ETag']
+        self.client.post(reverse('add_topping'), {'name': 'Olives'})
+        response = self.client.get(reverse('topping_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Olives')
+        self.assertNotEqual(response['ETag'], etag)
+
+    # Test that the ETag differs per page of the listing
+    def test_etag_depends_on_page(self):
+        first = self.client.get(reverse('owner_dashboard'))['ETag']
+        other = self.client.get(reverse('owner_dashboard') + '?after=' + encode_cursor('a'))['ETag']
+        self.assertNotEqual(first, other)
+
+
+# ---------------------------------- ASYNC VIEW TESTING ---------------------------------- #
+class AsyncViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    # Test that the decorators keep async views as coroutine functions and sync views as plain functions
+    def test_decorators_preserve_coroutines(self):
+        for view in (views.owner_dashboard, views.topping_list, views.add_topping,
+                     views.delete_topping, views.update_topping):
+            self.assertTrue(asyncio.iscoroutinefunction(view), view)
+        self.assertFalse(asyncio.iscoroutinefunction(views.export_menu))
+
+    # Test the async dashboard and CRUD views end to end through the async client
+    async def test_async_client_crud(self):
+        response = await self.async_client.get(reverse('owner_dashboard'))
+        self.assertEqual(response.status_code, 403)
+
+        await sync_to_async(self.async_client.force_login)(self.owner)
+        response = await self.async_client.get(reverse('owner_dashboard'))
+        self.assertContains(response, 'Pepperoni')
+
+        response = await self.async_client.post(reverse('add_topping'), {'name': 'Olives'})
+        self.assertRedirects(response, reverse('topping_list'), fetch_redirect_response=False)
+        olives = await Topping.objects.aget(name='Olives')
+
+        await self.async_client.post(reverse('update_topping', args=[olives.pk]), {'name': 'Black Olives'})
+        await self.async_client.post(reverse('delete_topping', args=[self.pepperoni.pk]))
+        names = [name async for name in Topping.objects.values_list('name', flat=True)]
+        self.assertEqual(names, ['Black Olives'])
+
+        response = await self.async_client.post(reverse('delete_topping', args=[self.pepperoni.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+# ---------------------------------- SEARCH TESTING ---------------------------------- #
+class MenuSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.jalapeno = Topping.objects.create(name='Jalapeño Peppers')
+        cls.mozzarella = Topping.objects.create(name='Mozzarella')
+        cls.spicy = Pizza.objects.create(name='Spicy Devil')
+        cls.spicy.toppings.set([cls.pepperoni, cls.jalapeno])
+        cls.pepperoni_pizza = Pizza.objects.create(name='Pepperoni Classic')
+        cls.pepperoni_pizza.toppings.set([cls.mozzarella])
+
+        # Create an Owner user
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+
+    # Helper returning the names of search results
+    def names(self, results):
+        return [obj.name for obj in results]
+
+    # Test prefix matching, case and diacritics folding
+    def test_prefix_search(self):
+        self.assertEqual(self.names(search_toppings('pep')), ['Pepperoni', 'Jalapeño Peppers'])
+        self.assertEqual(self.names(search_toppings('JALAPENO pe')), ['Jalapeño Peppers'])
+        self.assertEqual(search_toppings(''), [])
+        self.assertEqual(search_toppings('"*'), [])
+
+    # Test that misspelled words are matched
+    def test_typo_tolerance(self):
+        self.assertEqual(self.names(search_toppings('mozarella')), ['Mozzarella'])
+        self.assertEqual(self.names(search_toppings('peperoni')), ['Pepperoni'])
+        self.assertEqual(search_toppings('xylophone'), [])
+
+    # Test that broad queries rank every match, not only the first rows found
+    def test_ranks_all_matches(self):
+        Topping.objects.bulk_create([Topping(name='Basil Blend Number %d' % i) for i in range(1500)])
+        best = Topping.objects.create(name='Basil')
+        self.assertEqual(search_toppings('basil', limit=1), [best])
+
+    # Test that pizzas are found by topping names, name matches first
+    def test_pizza_search_by_topping(self):
+        self.assertEqual(self.names(search_pizzas('jalapeno')), ['Spicy Devil'])
+        self.assertEqual(self.names(search_pizzas('pepperoni')), ['Pepperoni Classic', 'Spicy Devil'])
+        self.assertEqual(self.names(search_pizzas('mozzarella pepperoni')), ['Pepperoni Classic'])
+
+    # Test that a pizza id restriction (e.g. a topping filter) is applied before the limit
+    def test_pizza_search_restricted(self):
+        pizzas = Pizza.objects.bulk_create([Pizza(name='Pepperoni Special %d' % i) for i in range(30)])
+        self.assertEqual(self.names(search_pizzas('pepperoni', limit=5, pizza_ids=[self.spicy.pk])), ['Spicy Devil'])
+        restricted = search_pizzas('pepperoni', limit=5, pizza_ids=[pizza.pk for pizza in pizzas[25:]])
+        self.assertEqual(sorted(pizza.pk for pizza in restricted), [pizza.pk for pizza in pizzas[25:]])
+        self.assertEqual(search_pizzas('pepperoni', pizza_ids=[]), [])
+
+    # Test that the index follows renames, deletes, topping changes and bulk writes
+    def test_index_stays_in_sync(self):
+        self.mozzarella.name = 'Buffalo Mozzarella'
+        self.mozzarella.save()
+        self.assertEqual(self.names(search_pizzas('buffalo')), ['Pepperoni Classic'])
+        self.spicy.toppings.remove(self.jalapeno)
+        self.assertEqual(search_pizzas('jalapeno'), [])
+        self.pepperoni.delete()
+        self.assertEqual(self.names(search_toppings('pepperoni')), [])
+        Topping.objects.bulk_create([Topping(name='Basil')])
+        self.assertEqual(self.names(search_toppings('bas')), ['Basil'])
+
+    # Test that a missing trigger (e.g. after a table rebuild) is restored together with the index
+    def test_ensure_search_index_repairs(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER menu_search_topping_ai")
+        Topping.objects.create(name='Oregano')
+        self.assertEqual(search_toppings('oregano'), [])
+        self.assertTrue(ensure_search_index())
+        self.assertEqual(self.names(search_toppings('oregano')), ['Oregano'])
+
+    # Test the dashboard search and the search API
+    def test_dashboard_and_api_search(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('owner_dashboard'), {'q': 'mozz'})
+        self.assertEqual(self.names(response.context['toppings']), ['Mozzarella'])
+        response = self.client.get(reverse('api_toppings_search'), {'q': 'pep', 'limit': 1})
+        self.assertEqual(response.json(), {'results': [{'id': self.pepperoni.pk, 'name': 'Pepperoni'}]})
+
+
+# ---------------------------------- TOPPING INDEX TESTING ---------------------------------- #
+class ToppingIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pepperoni = Topping.objects.create(name='Pepperoni')
+        cls.mushrooms = Topping.objects.create(name='Mushrooms')
+        cls.anchovies = Topping.objects.create(name='Anchovies')
+        cls.classic = Pizza.objects.create(name='Classic')
+        cls.classic.toppings.set([cls.pepperoni, cls.mushrooms])
+        cls.salty = Pizza.objects.create(name='Salty')
+        cls.salty.toppings.set([cls.pepperoni, cls.mushrooms, cls.anchovies])
+        cls.veggie = Pizza.objects.create(name='Veggie')
+        cls.veggie.toppings.set([cls.mushrooms])
+
+        # Create a Chef user
+        cls.chef = User.objects.create_user(username='Chef', password='SupremeSlicesChef')
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
+
+    def setUp(self):
+        # The process wide index follows menu_changed, start it from this test's data
+        self.index = topping_index
+        self.index.rebuild()
+
+    # Helper returning the names of the matching pizzas
+    def names(self, match):
+        return sorted(Pizza.objects.filter(pk__in=match.ids()).values_list('name', flat=True))
+
+    # Test AND / OR / NOT queries
+    def test_match(self):
+        match = self.index.match(all_of=[self.pepperoni.pk, self.mushrooms.pk], none_of=[self.anchovies.pk])
+        self.assertEqual(self.names(match), ['Classic'])
+        self.assertIn(self.classic.pk, match)
+        self.assertNotIn(self.salty.pk, match)
+        self.assertEqual(len(self.index.match(any_of=[self.anchovies.pk, self.pepperoni.pk])), 2)
+        self.assertEqual(len(self.index.match()), 3)
+        self.assertFalse(self.index.match(all_of=[self.anchovies.pk, 999]))
+
+    # Test that committed changes are applied incrementally, one version at a time
+    def test_incremental_updates(self):
+        self.index.match()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.veggie.toppings.add(self.pepperoni)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.salty.delete()
+        # No rebuild needed: the index already reflects the database version
+        with self.assertNumQueries(1):
+            match = self.index.match(all_of=[self.pepperoni.pk])
+        self.assertEqual(self.names(match), ['Classic', 'Veggie'])
+
+    # Test that a change the index did not see triggers a rebuild
+    def test_missed_change_rebuilds(self):
+        self.index.match()
+        # on_commit callbacks are discarded, as for a change made by another process
+        self.classic.toppings.remove(self.pepperoni)
+        self.assertEqual(self.names(self.index.match(all_of=[self.pepperoni.pk])), ['Salty'])
+
+    # Test the Chef dashboard filter
+    def test_dashboard_filter(self):
+        self.client.force_login(self.chef)
+        response = self.client.get(reverse('chef_dashboard'), {'with': self.mushrooms.pk, 'without': self.anchovies.pk})
+        self.assertEqual([pizza.name for pizza in response.context['pizzas']], ['Classic', 'Veggie'])
+
+
+# ---------------------------------- BENCHMARK TESTING ---------------------------------- #
+class BenchmarkTest(TestCase):
+    # Test the synthetic menu sizes, recipes and fingerprints
+    def test_generate_menu(self):
+        menu = generate_menu(20, 50, seed=1, mean_toppings=3, max_toppings=5)
+        self.assertEqual((Topping.objects.count(), Pizza.objects.count()), (20, 50))
+        sizes = [len(pizza.toppings.all()) for pizza in Pizza.objects.with_toppings()]
+        self.assertTrue(all(1 <= size <= 5 for size in sizes))
+        # Every recipe is distinct and fingerprinted
+        self.assertEqual(len(set(Pizza.objects.values_list('recipe_fingerprint', flat=True))), 50)
+        # The most popular topping is on more pizzas than the least popular one
+        popular, rare = menu.topping_ids[0], menu.topping_ids[-1]
+        self.assertGreater(Pizza.objects.filter(toppings=popular).count(), Pizza.objects.filter(toppings=rare).count())
+
+    # Test benchmarking an endpoint and comparing two runs
+    def test_benchmark_endpoint(self):
+        menu = generate_menu(10, 10)
+        client = self.client
+        user = User.objects.create_user(username='Chef')
+        user.groups.add(Group.objects.get_or_create(name=CHEF)[0])
+        client.force_login(user)
+        endpoint = next(endpoint for endpoint in ENDPOINTS if endpoint.name == 'create_pizza')
+        result = benchmark_endpoint(endpoint, client, menu, requests=3, warmup=1, profiled=1)
+        self.assertEqual((result['requests'], result['errors']), (3, 0))
+        self.assertGreater(result['queries'], 0)
+        self.assertEqual(Pizza.objects.count(), 15)
+
+        run = {'scales': {'10': {'endpoints': {'create_pizza': result}}}}
+        slower = dict(result, p95_ms=result['p95_ms'] * 2 + 5, queries=result['queries'] + 1)
+        self.assertEqual(compare_results(run, run), [])
+        self.assertEqual(len(compare_results(run, {'scales': {'10': {'endpoints': {'create_pizza': slower}}}})), 2)
+
+
+# ------------------------------------ ROLE TESTING ------------------------------------ #
+class RoleTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Roles come from groups, whatever the username
+        cls.owner = User.objects.create_user(username='alice', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+        cls.chef = User.objects.create_user(username='bob', password='SupremeSlicesChef')
+        cls.chef.groups.add(Group.objects.get(name=CHEF))
+
+    # Test that any member of a role group gets the role, and the login redirect follows it
+    def test_group_roles(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('owner_dashboard')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('chef_dashboard')).status_code, 403)
+        self.client.logout()
+        response = self.client.post(reverse('home'), {'username': 'bob', 'password': 'SupremeSlicesChef'})
+        self.assertRedirects(response, reverse('chef_dashboard'), fetch_redirect_response=False)
+
+    # Test that authorization only checks the user's version once the user is cached
+    def test_cached_authorization(self):
+        self.client.force_login(self.owner)
+        self.client.get(reverse('api_toppings'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('api_toppings'))
+        self.assertEqual(len([query for query in queries if 'Owner_userversion' in query['sql']]), 1)
+        self.assertNotIn('auth_', ' '.join(query['sql'] for query in queries))
+
+    # Test that a change made by another server process, whose cache is not this one's, is seen at once
+    def test_change_from_another_process(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 200)
+        entry = cache.get(roles.user_key(self.owner.pk, self.owner.get_session_auth_hash()))
+        self.assertIsNotNone(entry)
+        # The other process leaves this cache untouched: only the database changes
+        with mock.patch.object(roles, 'cache', LocMemCache('other', {})):
+            self.owner.groups.clear()
+        self.assertIsNotNone(cache.get(roles.user_key(self.owner.pk, self.owner.get_session_auth_hash())))
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 403)
+        # A session ended elsewhere is ended here too
+        self.owner.groups.add(Group.objects.get(name=OWNER))
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 200)
+        Session.objects.all().delete()
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 403)
+
+    # Test that a username alone grants no role
+    def test_username_grants_no_role(self):
+        self.client.force_login(User.objects.create_user(username='Owner', password='SupremeSlicesOwner'))
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 403)
+
+    # Test that a role change is seen on the next request
+    def test_role_change_invalidates(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner.groups.clear()
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 403)
+        with self.captureOnCommitCallbacks(execute=True):
+            Group.objects.get(name=OWNER).user_set.add(self.owner)
+        self.assertEqual(self.client.get(reverse('api_toppings')).status_code, 200)
+
+
 # --------------------------------- MODEL TESTING ------------------------------- #
 # Tests for Pizza model
 class PizzaModelTest(TestCase):
@@ -160,10 +1343,13 @@ class PizzaModelTest(TestCase):
     # Ensure that the unique constraint on name is case-insensitive
     def test_name_with_unique_constraint_case_insensitive(self):
         # Create a pizza with a name in lowercase
-        Pizza.objects.create(name='pepperoni')
+        Pizza.objects.create(name='margherita')
         # Attempt to create another pizza with the same name but different case
-        with self.assertRaises(IntegrityError):
-            Pizza.objects.create(name='Pepperoni')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Pizza.objects.create(name='Margherita')
+        # The existing 'Pepperoni' pizza also blocks its lowercase variant
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Pizza.objects.create(name='pepperoni')
 
     # Test creating a pizza with valid data
     def test_valid_pizza_creation(self):
@@ -271,9 +1457,41 @@ class ToppingFormTest(TestCase):
         Topping.objects.create(name='Olives')
         form_data = {'name': 'Olives'}  # Trying to create a duplicate topping
         form = ToppingForm(data=form_data)
-        self.assertFalse(form.is_valid())
+        # The database rejects the duplicate on save
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save_unique())
         self.assertTrue('name' in form.errors)
 
+    # Test that duplicates differing only by case are rejected
+    def test_duplicate_name_case_insensitive(self):
+        Topping.objects.create(name='Olives')
+        form = ToppingForm(data={'name': ' OLIVES '})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save_unique())
+        self.assertEqual(form.errors['name'], ['A topping with this name already exists.'])
+
+    # Test that a create costs a single insert, without a uniqueness lookup
+    def test_create_query_count(self):
+        form = ToppingForm(data={'name': 'Olives'})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(form.is_valid())
+            self.assertIsNotNone(form.save_unique())
+        # Ignore the savepoint statements issued by the test transaction and the menu version bump
+        statements = [q['sql'] for q in queries
+                      if 'SAVEPOINT' not in q['sql'] and 'Owner_menuversion' not in q['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('INSERT'))
+
+    # Test that a duplicate racing past validation is turned into a form error
+    def test_save_unique_reports_race(self):
+        form = ToppingForm(data={'name': 'Olives'})
+        self.assertTrue(form.is_valid())
+        # Another request inserts the same name after validation
+        Topping.objects.create(name='olives')
+        self.assertIsNone(form.save_unique())
+        self.assertEqual(form.errors['name'], ['A topping with this name already exists.'])
+        self.assertEqual(Topping.objects.filter(name__iexact='olives').count(), 1)
+
     # Test for updating existing topping to ensure model doesn't think it's a new unique topping
     def test_unique_name_validation(self):
         # Create a topping with a unique name
@@ -287,6 +1505,48 @@ class ToppingFormTest(TestCase):
         self.assertTrue(form.is_valid())
 
 
+# Class: CaseInsensitiveNameMigrationTest
+# Description: Runs migration 0002 on names that differ only in case, which it must merge or rename before
+#              adding the case-insensitive unique constraints.
+class CaseInsensitiveNameMigrationTest(TransactionTestCase):
+    before = [('Owner', '0001_initial')]
+    after = [('Owner', '0002_case_insensitive_unique_names')]
+
+    def tearDown(self):
+        call_command('migrate', verbosity=0)
+
+    # Helper migrating the database and returning the historical models at that state
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    # Test that duplicate toppings are merged into the oldest and duplicate pizzas numbered
+    def test_merges_toppings_and_renames_pizzas(self):
+        # The search and change log triggers refer to the latest schema (migrate restores them afterwards)
+        with connection.cursor() as cursor:
+            for name in [*search.TRIGGERS, *change_log.TRIGGERS]:
+                cursor.execute('DROP TRIGGER IF EXISTS %s' % name)
+        apps = self.migrate(self.before)
+        OldTopping, OldPizza = apps.get_model('Owner', 'Topping'), apps.get_model('Owner', 'Pizza')
+        mushroom, ham = OldTopping.objects.create(name='Mushroom'), OldTopping.objects.create(name='Ham')
+        duplicates = [OldTopping.objects.create(name=name) for name in ('MUSHROOM', 'mushroom')]
+        first, second = OldPizza.objects.create(name='Margherita'), OldPizza.objects.create(name='MARGHERITA')
+        OldPizza.objects.create(name='Margherita (2)')
+        first.toppings.set([mushroom, duplicates[0]])
+        second.toppings.set([duplicates[1], ham])
+
+        apps = self.migrate(self.after)
+        Topping, Pizza = apps.get_model('Owner', 'Topping'), apps.get_model('Owner', 'Pizza')
+        self.assertEqual(sorted(Topping.objects.values_list('name', flat=True)), ['Ham', 'Mushroom'])
+        self.assertEqual(sorted(Pizza.objects.values_list('name', flat=True)),
+                         ['MARGHERITA (3)', 'Margherita', 'Margherita (2)'])
+        self.assertEqual(set(Pizza.objects.get(pk=first.pk).toppings.values_list('pk', flat=True)), {mushroom.pk})
+        self.assertEqual(set(Pizza.objects.get(pk=second.pk).toppings.values_list('pk', flat=True)),
+                         {mushroom.pk, ham.pk})
+
+
 # ---------------------------- AUTHENTICATION TESTING ---------------------------- #
 # Tests for Owner Login
 class LoginTestCase(TestCase):
@@ -296,6 +1556,7 @@ class LoginTestCase(TestCase):
         cls.owner_username = 'Owner'
         cls.owner_password = 'SupremeSlicesOwner'
         cls.owner = User.objects.create_user(username=cls.owner_username, password=cls.owner_password)
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
 
     def test_valid_owner_login(self):
         # Attempt to log in as Owner with correct credentials
@@ -0,0 +1,250 @@
+import json
+import threading
+from collections import defaultdict
+from functools import partial
+
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+
+from .models import MenuVersion, Pizza
+from .signals import menu_changed
+
+# Number of ids per query when reloading the toppings of changed pizzas (SQLite parameter limit)
+REFRESH_BATCH_SIZE = 900
+
+
+# Positions of the set bits of every byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+# Function: _to_bits
+# Parameters: ids (iterable of int)
+# Description: Builds the bitset (bit i set for id i) of a set of ids in one pass.
+# Returns: int
+def _to_bits(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for pk in ids:
+        buffer[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+# Class: PizzaMatch
+# Description: The pizzas matching a topping query, as a bitset of pizza ids. Counting and membership
+#              tests work on the bitset directly; ids() lists the matching ids.
+class PizzaMatch:
+    def __init__(self, bits):
+        self.bits = bits
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, pizza_id):
+        return pizza_id >= 0 and (self.bits >> pizza_id) & 1 == 1
+
+    # Function: ids
+    # Parameters: self
+    # Description: Lists the matching pizza ids.
+    # Returns: list of int, in ascending order
+    def ids(self):
+        # Walk the bitset a byte at a time, least significant byte first
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        return [offset + bit for offset, byte in zip(range(0, len(data) * 8, 8), data) if byte
+                for bit in _BYTE_BITS[byte]]
+
+
+# Class: ToppingIndex
+# Description: In-process inverted index from topping id to the pizzas using it, answering
+#              "pizzas with all of / any of / none of these toppings" with a few bitset operations.
+#              Postings are kept as sets of pizza ids; the bitset of a topping is built the first time a
+#              query uses it, so memory only grows with the toppings actually queried.
+#              The index follows menu_changed: after each commit the changed pizzas are reloaded. It
+#              records the MenuVersion it reflects, and is rebuilt when the database version moves in a
+#              way it has not seen (a change made by another process, or a read rolled back since).
+class ToppingIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # topping id -> set of pizza ids
+        self._postings = {}
+        # pizza id -> frozenset of topping ids
+        self._pizza_toppings = {}
+        # topping id -> bitset of pizza ids, built on first use
+        self._bits = {}
+        # Bitset of every pizza id, built on first use
+        self._all_bits = None
+        # MenuVersion the index reflects, None until built
+        self._version = None
+        # MenuVersion.updated_at of that version (None if not known yet). Version numbers can be reused
+        # after a rollback, the timestamp tells such versions apart.
+        self._updated_at = None
+
+    # Function: rebuild
+    # Parameters: self
+    # Description: Loads the whole index from Pizza and Pizza.toppings.through.
+    # Returns: None
+    def rebuild(self):
+        with self._lock:
+            # Read the version first: a change committed during the load only causes another rebuild
+            version, updated_at = MenuVersion.current()
+            pizza_toppings = {pk: set() for pk in Pizza.objects.order_by().values_list('pk', flat=True).iterator()}
+            postings = defaultdict(set)
+            links = Pizza.toppings.through.objects.order_by().values_list('pizza_id', 'topping_id')
+            for pizza_id, topping_id in links.iterator(chunk_size=10000):
+                if pizza_id in pizza_toppings:
+                    pizza_toppings[pizza_id].add(topping_id)
+                    postings[topping_id].add(pizza_id)
+            self._pizza_toppings = {pk: frozenset(toppings) for pk, toppings in pizza_toppings.items()}
+            self._postings = dict(postings)
+            self._bits = {}
+            self._all_bits = None
+            self._version = version
+            self._updated_at = updated_at
+
+    # Function: _refresh
+    # Parameters: self, pizza_ids (iterable of int)
+    # Description: Reloads the toppings of the given pizzas, dropping the pizzas that no longer exist.
+    # Returns: None
+    def _refresh(self, pizza_ids):
+        pizza_ids = list(pizza_ids)
+        existing = set()
+        current = defaultdict(set)
+        for start in range(0, len(pizza_ids), REFRESH_BATCH_SIZE):
+            batch = pizza_ids[start:start + REFRESH_BATCH_SIZE]
+            existing.update(Pizza.objects.filter(pk__in=batch).values_list('pk', flat=True))
+            links = Pizza.toppings.through.objects.filter(pizza_id__in=batch).values_list('pizza_id', 'topping_id')
+            for pizza_id, topping_id in links:
+                current[pizza_id].add(topping_id)
+
+        for pizza_id in pizza_ids:
+            was_indexed = pizza_id in self._pizza_toppings
+            old = self._pizza_toppings.pop(pizza_id, frozenset())
+            new = frozenset(current[pizza_id]) if pizza_id in existing else frozenset()
+            for topping_id in old - new:
+                self._postings[topping_id].discard(pizza_id)
+                if not self._postings[topping_id]:
+                    del self._postings[topping_id]
+                self._bits.pop(topping_id, None)
+            for topping_id in new - old:
+                self._postings.setdefault(topping_id, set()).add(pizza_id)
+                self._bits.pop(topping_id, None)
+            if pizza_id in existing:
+                self._pizza_toppings[pizza_id] = new
+            if was_indexed != (pizza_id in existing):
+                # The pizza was created or deleted
+                self._all_bits = None
+
+    # Function: apply_change
+    # Parameters:
+    #   - self
+    #   - pizza_ids: ids of the pizzas that changed, None if too many changed to list (see menu_changed)
+    #   - version (int): MenuVersion after the change
+    # Description: Applies a committed menu change. Changes must arrive one version at a time, otherwise
+    #              the index missed one and is dropped, to be rebuilt by the next query.
+    # Returns: None
+    def apply_change(self, pizza_ids, version):
+        with self._lock:
+            if self._version is None:
+                return
+            if version is None or version != self._version + 1:
+                self._version = None
+                return
+            if pizza_ids is None:
+                # Too many pizzas changed to reload them one by one, rebuild on the next match
+                self._version = None
+                return
+            if pizza_ids:
+                self._refresh(pizza_ids)
+            self._version = version
+            self._updated_at = None
+
+    # Function: _topping_bits
+    # Parameters: self, topping_id (int)
+    # Description: Bitset of the pizzas using a topping.
+    # Returns: int
+    def _topping_bits(self, topping_id):
+        bits = self._bits.get(topping_id)
+        if bits is None:
+            bits = self._bits[topping_id] = _to_bits(self._postings.get(topping_id, ()))
+        return bits
+
+    # Function: match
+    # Parameters:
+    #   - self
+    #   - all_of: topping ids every matching pizza has
+    #   - any_of: topping ids of which a matching pizza has at least one (ignored if empty)
+    #   - none_of: topping ids no matching pizza has
+    #   - check (bool): compare the index with the database MenuVersion first (one primary key lookup)
+    # Description: Finds the pizzas with all toppings of all_of, one of any_of and none of none_of.
+    # Returns: PizzaMatch
+    def match(self, all_of=(), any_of=(), none_of=(), check=True):
+        with self._lock:
+            if self._version is None:
+                self.rebuild()
+            elif check:
+                version, updated_at = MenuVersion.current()
+                if version != self._version or self._updated_at not in (None, updated_at):
+                    self.rebuild()
+                else:
+                    self._updated_at = updated_at
+            if self._all_bits is None:
+                self._all_bits = _to_bits(self._pizza_toppings)
+            bits = self._all_bits
+            for topping_id in all_of:
+                bits &= self._topping_bits(topping_id)
+            if any_of:
+                union = 0
+                for topping_id in any_of:
+                    union |= self._topping_bits(topping_id)
+                bits &= union
+            for topping_id in none_of:
+                bits &= ~self._topping_bits(topping_id)
+            return PizzaMatch(bits)
+
+
+# The index of this process
+topping_index = ToppingIndex()
+
+
+# Function: parse_topping_filter
+# Parameters: params (QueryDict) - request.GET
+# Description: Reads a topping query from request parameters: ?with=<id> (repeatable) for required
+#              toppings, ?any=<id> for alternatives and ?without=<id> for excluded toppings.
+# Returns: (all_of, any_of, none_of) lists of topping ids
+def parse_topping_filter(params):
+    def ids(key):
+        return [int(value) for value in params.getlist(key) if value.isdigit()]
+    return ids('with'), ids('any'), ids('without')
+
+
+# Function: filter_in
+# Parameters: queryset, field (str), values (list of int or str)
+# Description: queryset.filter(<field>__in=values). On SQLite the values are sent as a single JSON parameter,
+#              whatever their number (a plain IN list fails past the SQLite parameter limit).
+# Returns: QuerySet
+def filter_in(queryset, field, values):
+    if connections[queryset.db].vendor == 'sqlite':
+        values = RawSQL('SELECT value FROM json_each(%s)', [json.dumps(list(values))])
+    return queryset.filter(**{field + '__in': values})
+
+
+# Function: pizza_queryset
+# Parameters:
+#   - match (PizzaMatch): result of ToppingIndex.match()
+#   - queryset: Pizza queryset to restrict, defaults to all pizzas
+# Description: Restricts a pizza queryset to the matching pizzas, so it can be ordered and paginated.
+# Returns: QuerySet
+def pizza_queryset(match, queryset=None):
+    queryset = Pizza.objects.all() if queryset is None else queryset
+    return filter_in(queryset, 'pk', match.ids())
+
+
+@receiver(menu_changed)
+def update_topping_index(sender, pizza_ids, version=None, **kwargs):
+    # Apply the change once it is committed; a rolled back change never reaches the index
+    transaction.on_commit(partial(topping_index.apply_change, None if pizza_ids is None else set(pizza_ids), version))
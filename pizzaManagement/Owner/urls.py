@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('dashboard/', views.owner_dashboard, name='owner_dashboard'),
@@ -7,4 +7,13 @@ urlpatterns = [
     path('topping/add/', views.add_topping, name='add_topping'),
     path('topping/<int:topping_id>/delete/', views.delete_topping, name='delete_topping'),
     path('topping/<int:topping_id>/update/', views.update_topping, name='update_topping'),
+    path('export/', views.export_menu, name='export_menu'),
+    # JSON API
+    path('api/toppings/', api.topping_collection, name='api_toppings'),
+    path('api/toppings/bulk/', api.topping_bulk, name='api_toppings_bulk'),
+    path('api/toppings/merge/', api.topping_merge, name='api_toppings_merge'),
+    path('api/toppings/search/', api.topping_search, name='api_toppings_search'),
+    path('api/toppings/<int:topping_id>/', api.topping_detail, name='api_topping_detail'),
+    path('api/toppings/<int:topping_id>/impact/', api.topping_deletion_impact, name='api_topping_impact'),
+    path('api/fragment-cache/', api.fragment_cache_stats, name='api_fragment_cache_stats'),
 ]
\ No newline at end of file
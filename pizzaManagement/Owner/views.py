@@ -1,8 +1,36 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed
+from django.http import HttpResponseNotFound, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect
+from django.utils.cache import get_conditional_response
+from pizzaManagement.database import retry_on_lock
+from .change_log import DEFAULT_LIMIT as CHANGES_LIMIT, change_log_available, changes_since
+from .deletion import delete_toppings
+from .fragment_cache import render_topping_rows
+from .live import broadcaster
 from .models import Topping
 from .forms import ToppingForm
-from django.contrib.auth.decorators import login_required
-from .decorators import owner_required
+from .menu_io import CONTENT_TYPES, CSV, FORMATS, encode_records, iter_menu_records
+from .pagination import KeysetPage, apaginate_by_name
+from .search import search_toppings
+from .snapshot import CONTENT_TYPES as SNAPSHOT_TYPES, JSON, MSGPACK, read_snapshot, snapshot_writer
+from .roles import user_roles
+from .shortcuts import aget_object_or_404, astream, fragment_error, fragment_response, wants_fragment
+from .decorators import menu_conditional, owner_required, read_menu_version
+
+
+# Function: topping_page
+# Parameters: request (HttpRequest)
+# Description: Gets the toppings to list: the results of the ?q= search if any, otherwise the page of
+#              toppings selected by the ?after= / ?before= cursors.
+# Returns: KeysetPage
+async def topping_page(request):
+    query = request.GET.get('q', '').strip()
+    if query:
+        return KeysetPage(await sync_to_async(search_toppings)(query))
+    return await apaginate_by_name(Topping.objects.all(), request.GET.get('after'), request.GET.get('before'))
+
 
 # Function: owner_dashboard
 # Parameters: request (HttpRequest)
@@ -10,8 +38,8 @@ from .decorators import owner_required
 #              Requires Owner authentication to access
 # Returns: HttpResponse
 @owner_required
-@login_required
-def owner_dashboard(request):
+@menu_conditional
+async def owner_dashboard(request):
     # Set error message to None by default
     error_message = None
     # Check if HTTP request method is POST
@@ -19,16 +47,12 @@ def owner_dashboard(request):
         # Create Topping form based on request
         form = ToppingForm(request.POST)
         # Check if form is valid
-        if form.is_valid():
-            # Check if topping name is duplicate
-            name = form.cleaned_data['name']
-            # If duplicate, set error message
-            if Topping.objects.filter(name__iexact=name).exists():
-                error_message = "This topping already exists!"
-            # Else, save form and redirect back to owner dashboard
-            else:
-                form.save()
+        if await sync_to_async(form.is_valid)():
+            # Save form and redirect back to owner dashboard (duplicates are rejected by the database)
+            if await sync_to_async(form.save_unique)():
                 return redirect('owner_dashboard')
+            # If duplicate, set error message
+            error_message = "This topping already exists!"
         else:
             # If form is invalid, set error message
             error_message = "This topping already exists!"
@@ -36,12 +60,15 @@ def owner_dashboard(request):
         # If not a POST request, initialize an empty form
         form = ToppingForm()
 
-    # Order toppings alphabetically by name
-    toppings = Topping.objects.order_by('name')
+    # Get the searched toppings, or the requested page of toppings ordered alphabetically by name
+    page = await topping_page(request)
+    # Cached rows are read (and missing ones rendered) off the event loop
+    topping_rows = await sync_to_async(render_topping_rows)(page.object_list, read_menu_version(request))
 
     # Render the owner_dashboard.html template with toppings, form, and error message
-    return render(request, 'owner_dashboard.html', {'toppings': toppings, 'form': form,
-                                                    'error_message': error_message})
+    return render(request, 'owner_dashboard.html', {'toppings': page.object_list, 'page': page,
+                                                    'topping_rows': topping_rows, 'query': request.GET.get('q', ''),
+                                                    'form': form, 'error_message': error_message})
 
 
 # Function: topping_list
@@ -49,11 +76,15 @@ def owner_dashboard(request):
 # Description: Renders a list of toppings ordered alphabetically by name.
 # Returns: HttpResponse
 @owner_required
-def topping_list(request):
-    # Order toppings alphabetically by name
-    toppings = Topping.objects.order_by('name')
+@menu_conditional
+async def topping_list(request):
+    # Get the searched toppings, or the requested page of toppings ordered alphabetically by name
+    page = await topping_page(request)
+    # Cached rows are read (and missing ones rendered) off the event loop
+    topping_rows = await sync_to_async(render_topping_rows)(page.object_list, read_menu_version(request))
     # Render the owner_dashboard.html template with available toppings
-    return render(request, 'owner_dashboard.html', {'toppings': toppings})
+    return render(request, 'owner_dashboard.html', {'toppings': page.object_list, 'page': page,
+                                                    'topping_rows': topping_rows, 'query': request.GET.get('q', '')})
 
 
 # Function: add_topping
@@ -62,9 +93,10 @@ def topping_list(request):
 #              If the form data is valid and the topping does not already exist,
 #              it saves the topping and redirects to the topping list page,
 #              otherwise, it displays an error message.
+#              Requests from the dashboard script get the new topping's row (201) or a JSON error instead.
 # Returns: HttpResponse
 @owner_required
-def add_topping(request):
+async def add_topping(request):
     # Initialize error_message as None
     error_message = None
     # Check if the request method is POST
@@ -72,29 +104,34 @@ def add_topping(request):
         # Create a form instance with the POST data
         form = ToppingForm(request.POST)
         # Check if the form is valid
-        if form.is_valid():
-            # Extract the name of the topping from the form data
-            name = form.cleaned_data['name']
-            # Check if a topping with the same name already exists
-            if Topping.objects.filter(name__iexact=name).exists():
-                # Set error_message if the topping already exists
-                error_message = "This topping already exists!"
-            else:
-                # Save the new topping and redirect to the topping list page
-                form.save()
+        if await sync_to_async(form.is_valid)():
+            # Save the new topping and redirect to the topping list page (or answer with its row)
+            topping = await sync_to_async(form.save_unique)()
+            if topping and wants_fragment(request):
+                rows = await sync_to_async(render_topping_rows)([topping])
+                return fragment_response(rows[0], status=201)
+            if topping:
                 return redirect('topping_list')
+            # Set error_message if the topping already exists
+            error_message = "This topping already exists!"
         else:
             # Set error_message if the form is invalid
             error_message = "This topping already exists!"
+        if wants_fragment(request):
+            return fragment_error(error_message, form)
     # If the request method is not POST, initialize an empty form
     else:
         form = ToppingForm()
 
-    # Order toppings alphabetically by name
-    toppings = Topping.objects.order_by('name')
+    # Get the first page of toppings, ordered alphabetically by name
+    page = await apaginate_by_name(Topping.objects.all())
+    # Cached rows are read (and missing ones rendered) off the event loop
+    topping_rows = await sync_to_async(render_topping_rows)(page.object_list)
 
     # Render the owner dashboard with the form, toppings, and error_message
-    return render(request, 'owner_dashboard.html', {'form': form, 'toppings': toppings, 'error_message': error_message})
+    return render(request, 'owner_dashboard.html', {'form': form, 'toppings': page.object_list, 'page': page,
+                                                    'topping_rows': topping_rows,
+                                                    'error_message': error_message})
 
 
 # Function: delete_topping
@@ -103,15 +140,18 @@ def add_topping(request):
 #              If the request method is POST, it deletes the topping and
 #              redirects to the topping list page. Otherwise, it renders
 #              the owner dashboard with information about the topping.
+#              Requests from the dashboard script get a JSON status instead of the redirect.
 # Returns: HttpResponse
 @owner_required
-def delete_topping(request, topping_id):
+async def delete_topping(request, topping_id):
     # Retrieve the topping object with the given topping_id or return a 404 error
-    topping = get_object_or_404(Topping, pk=topping_id)
+    topping = await aget_object_or_404(Topping.objects.all(), pk=topping_id)
     # Check if the request method is POST
     if request.method == 'POST':
-        # If POST, delete the topping and redirect to the topping list page
-        topping.delete()
+        # If POST, delete the topping (set-based, however many pizzas use it) and redirect to the topping list
+        deleted, pizza_ids = await sync_to_async(retry_on_lock(delete_toppings))([topping.pk])
+        if wants_fragment(request):
+            return JsonResponse({'deleted': topping_id, 'pizzas': len(pizza_ids)})
         return redirect('topping_list')
     # If not a POST request, render the owner dashboard with information about the topping
     return render(request, 'owner_dashboard.html', {'topping': topping})
@@ -124,22 +164,130 @@ def delete_topping(request, topping_id):
 #              topping with the form data and redirects to the
 #              topping list page. Otherwise, it renders the owner
 #              dashboard with the topping update form.
+#              Requests from the dashboard script get the updated row or a JSON error instead.
 # Returns: HttpResponse
 @owner_required
-def update_topping(request, topping_id):
+async def update_topping(request, topping_id):
     # Retrieve the topping object with the given topping_id or return a 404 error
-    topping = get_object_or_404(Topping, pk=topping_id)
+    topping = await aget_object_or_404(Topping.objects.all(), pk=topping_id)
     # Check if the request method is POST
     if request.method == 'POST':
         # If POST, create a form instance with the POST data and the instance of the topping
         form = ToppingForm(request.POST, instance=topping)
         # Check if the form is valid
-        if form.is_valid():
-            # If valid, save the form and redirect to the topping list page
-            form.save()
-            return redirect('topping_list')
+        if await sync_to_async(form.is_valid)():
+            # If valid, save the form and redirect to the topping list page (or answer with the new row)
+            if await sync_to_async(form.save_unique)():
+                if wants_fragment(request):
+                    rows = await sync_to_async(render_topping_rows)([topping])
+                    return fragment_response(rows[0])
+                return redirect('topping_list')
+        if wants_fragment(request):
+            return fragment_error("The topping could not be updated.", form)
     else:
         # If not a POST request, create a form instance with the instance of the topping
         form = ToppingForm(instance=topping)
     # Render the owner dashboard with the topping update form
-    return render(request, 'owner_dashboard.html', {'form': form, 'topping': topping})
\ No newline at end of file
+    return render(request, 'owner_dashboard.html', {'form': form, 'topping': topping})
+
+
+# Function: export_menu
+# Parameters: request (HttpRequest)
+# Description: Streams the full topping and pizza catalog as a CSV (default) or JSON Lines / NDJSON download,
+#              selected with ?format=. Rows are read and encoded in chunks while the response is sent, so the
+#              catalog is never loaded into memory at once. Under ASGI the chunks go through an async iterator
+#              (see astream), which Django sends as they are read.
+# Returns: StreamingHttpResponse
+@owner_required
+def export_menu(request):
+    # Check the requested format is supported
+    fmt = request.GET.get('format', CSV)
+    if fmt not in FORMATS:
+        return HttpResponseBadRequest("Unknown export format.")
+    # Stream the encoded records as they are read from the database
+    content = encode_records(iter_menu_records(), fmt)
+    if isinstance(request, ASGIRequest):
+        content = astream(content)
+    response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename="menu.%s"' % fmt
+    return response
+
+
+# Function: menu_events
+# Parameters: request (HttpRequest) - may carry the last menu version the page shows, as the Last-Event-ID
+#             header of a reconnecting EventSource or as ?since=
+# Description: Server-Sent Events stream of the menu changes, for the Chef and Owner dashboards to patch
+#              themselves without reloading. Each event carries the new fragments of the changed pizzas and
+#              toppings (see Owner.live). Served under ASGI only: under WSGI each open stream would hold a
+#              worker thread, so the 204 response tells the browser not to reconnect.
+# Returns: StreamingHttpResponse
+async def menu_events(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    # Any dashboard user may follow the menu
+    if not await sync_to_async(lambda: bool(user_roles(request.user)))():
+        return HttpResponseForbidden("You don't have permission to access this page.")
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    since = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    response = StreamingHttpResponse(broadcaster.stream(int(since) if since and since.isdigit() else None),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Proxies such as nginx must pass the events on as they come
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Function: menu_snapshot
+# Parameters: request (HttpRequest) - ?format=msgpack, or an Accept header naming application/msgpack, selects
+#             the MessagePack encoding instead of JSON
+# Description: Read-only catalog for menu boards and kiosks, served from the precomputed snapshot file (see
+#              Owner.snapshot) without any database access, so this traffic never reaches the database. It is
+#              public, and needs no session. The ETag lets clients poll with If-None-Match and get a 304 until
+#              the menu changes. Only the very first request, before any snapshot is written, builds it.
+# Returns: HttpResponse
+async def menu_snapshot(request):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    encoding = request.GET.get('format')
+    if encoding is None:
+        encoding = MSGPACK if 'msgpack' in request.headers.get('Accept', '') else JSON
+    if encoding not in SNAPSHOT_TYPES:
+        return HttpResponseBadRequest("Unknown snapshot format.")
+    snapshot = await sync_to_async(read_snapshot, thread_sensitive=False)(encoding)
+    if snapshot is None and not snapshot_writer.published():
+        await sync_to_async(snapshot_writer.write)()
+        snapshot = await sync_to_async(read_snapshot, thread_sensitive=False)(encoding)
+    if snapshot is None:
+        # The MessagePack encoding needs the msgpack package
+        return HttpResponseNotFound("The menu snapshot is not available in this format.")
+    data, etag = snapshot
+    # Answers If-None-Match like menu_conditional: weak validators and * included
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(data, content_type=SNAPSHOT_TYPES[encoding])
+    response['ETag'] = etag
+    # Cached, but checked again on every use: a rebuilt snapshot is picked up at once
+    response['Cache-Control'] = 'public, no-cache'
+    response['Vary'] = 'Accept'
+    return response
+
+
+# Function: menu_changes
+# Parameters: request (HttpRequest) - ?since=<sequence> is the last change the client applied (0 or absent for
+#             none), ?limit= the maximum number of log rows to read
+# Description: Incremental menu sync for store terminals: the toppings and pizzas changed since a position of
+#              the change log, with tombstones for the deleted ones (see Owner.change_log). The client stores
+#              "next" and asks again with it, at once while "more" is true. On "reset" it reloads the whole
+#              menu from /menu/snapshot/ and follows the changes from the snapshot's sequence. Public and
+#              read-only, like the snapshot.
+# Returns: JsonResponse
+async def menu_changes(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    since, limit = request.GET.get('since', '0'), request.GET.get('limit', str(CHANGES_LIMIT))
+    if not (since.isdigit() and limit.isdigit()):
+        return HttpResponseBadRequest("since and limit must be non-negative integers.")
+    if not await sync_to_async(change_log_available)():
+        return HttpResponseNotFound("The menu change log is not available on this database.")
+    return JsonResponse(await sync_to_async(changes_since)(int(since), int(limit)))
@@ -12,5 +12,13 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pizzaManagement.settings')
+# No persistent database connections under ASGI (see pizzaManagement.database)
+os.environ.setdefault('DJANGO_ASGI', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.urls import reverse  # noqa: E402 (needs the settings configured above)
+from .middleware import StreamDisconnectMiddleware  # noqa: E402
+
+# Close the menu event streams of the clients that went away
+application = StreamDisconnectMiddleware(django_application, [reverse('menu_events')])
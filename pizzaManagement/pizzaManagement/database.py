@@ -0,0 +1,116 @@
+import copy
+import functools
+import itertools
+import random
+import time
+
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.backends.signals import connection_created
+
+# SQLite configurations selected with DATABASE_PROFILE in the settings:
+#   - CONN_MAX_AGE: seconds a connection is kept open between requests (0 reconnects on every request). Only
+#     WSGI reuses it: under ASGI every request runs its sync code in a new thread, so it opens a new
+#     connection anyway, and with CONN_MAX_AGE > 0 leaves it open until the thread is collected. The
+#     connections of every profile are therefore not persistent under ASGI (see sqlite_database).
+#   - OPTIONS.timeout: seconds SQLite waits for a lock held by another connection before failing
+#   - PRAGMAS: applied on every new connection (see configure_sqlite)
+#   - LOCK_RETRIES: times a write failing with "database is locked" is retried (see retry_on_lock)
+DATABASE_PROFILES = {
+    # Django's stock SQLite setup: rollback journal, a connection per request, no retry
+    'default': {
+        'CONN_MAX_AGE': 0,
+        'CONN_HEALTH_CHECKS': False,
+        'OPTIONS': {},
+        'PRAGMAS': {},
+        'LOCK_RETRIES': 0,
+    },
+    # Concurrent readers and writers. In WAL mode readers never block the writer (nor the writer readers),
+    # and synchronous=NORMAL only syncs at checkpoints: a power loss may lose the last commits, never
+    # corrupt the database. Connections persist for 10 minutes under WSGI, so the pragmas are applied once
+    # per connection rather than on every request.
+    'production': {
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20},
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            # Page cache per connection: negative values are in KiB (64 MiB)
+            'cache_size': -64000,
+            # Read the database file through a 256 MiB memory map instead of read() calls
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        'LOCK_RETRIES': 5,
+    },
+}
+
+# Delay before the first retry of a locked write in seconds, doubled on every retry up to the maximum
+LOCK_RETRY_DELAY = 0.02
+LOCK_RETRY_MAX_DELAY = 1.0
+
+
+# Function: sqlite_database
+# Parameters:
+#   - name (str or Path): database file
+#   - profile (str): key of DATABASE_PROFILES
+#   - asgi (bool): the project is served by an ASGI server, connections are then never persistent
+# Description: Entry of settings.DATABASES for a SQLite database configured with the given profile.
+# Returns: dict
+def sqlite_database(name, profile='production', asgi=False):
+    if profile not in DATABASE_PROFILES:
+        raise ValueError("Unknown database profile %r, expected one of: %s." % (
+            profile, ', '.join(DATABASE_PROFILES)))
+    database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name, **copy.deepcopy(DATABASE_PROFILES[profile])}
+    if asgi:
+        database.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False)
+    return database
+
+
+# Function: configure_sqlite
+# Parameters: connection (DatabaseWrapper), see django.db.backends.signals.connection_created
+# Description: Applies the PRAGMAS of the database settings to a new SQLite connection.
+# Returns: None
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = connection.settings_dict.get('PRAGMAS') or {}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            # journal_mode=WAL is stored in the database file, in-memory databases keep their "memory" journal
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+connection_created.connect(configure_sqlite, dispatch_uid='configure_sqlite')
+
+
+# Function: is_locked
+# Parameters: error (Exception)
+# Description: Checks the error is SQLite giving up on a lock held by another connection.
+# Returns: bool
+def is_locked(error):
+    return isinstance(error, OperationalError) and 'locked' in str(error)
+
+
+# Function: retry_on_lock
+# Parameters: func (function) - writes to the database, in its own transaction
+# Description: Decorator retrying func, with exponential backoff, when it fails because the database is
+#              locked, up to LOCK_RETRIES times. SQLite fails a deferred transaction that reads, then tries
+#              to write while another connection writes, at once instead of waiting for the busy timeout:
+#              only running the whole transaction again gets it through. Inside an outer transaction the
+#              error is raised, that transaction must be retried as a whole.
+# Returns: function
+def retry_on_lock(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        connection = connections[DEFAULT_DB_ALIAS]
+        retries = connection.settings_dict.get('LOCK_RETRIES', 0)
+        for attempt in itertools.count():
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                if attempt >= retries or connection.in_atomic_block or not is_locked(error):
+                    raise
+            # Random jitter keeps the writers that collided from retrying in step
+            time.sleep(min(LOCK_RETRY_DELAY * 2 ** attempt, LOCK_RETRY_MAX_DELAY) * random.uniform(0.5, 1.5))
+    return wrapper
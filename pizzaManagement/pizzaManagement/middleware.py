@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import mimetypes
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import MiddlewareNotUsed, SuspiciousFileOperation
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified
+from django.template.backends.django import Template
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+
+from .storage import ENCODINGS
+
+# Per-request log line (INFO) and flagged requests (WARNING)
+logger = logging.getLogger('pizzaManagement.requests')
+
+# Metrics of the request being handled in the current context. Context variables follow the request into
+# the threads sync_to_async runs ORM calls and template rendering in.
+_current = ContextVar('request_metrics', default=None)
+
+# Cache lifetime of the files with a content hash in their name: they never change, a new version has a new name
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Files without a hash in their name (e.g. referenced from outside the templates) are revalidated on each use
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+# Default settings, overridden by REQUEST_TIMING_ENABLED / REQUEST_QUERY_BUDGET / REQUEST_REPEATED_QUERY_THRESHOLD
+DEFAULT_QUERY_BUDGET = 20
+DEFAULT_REPEATED_QUERY_THRESHOLD = 5
+
+
+# Class: RequestMetrics
+# Description: SQL and template figures collected while handling one request. Queries are counted by their
+#              SQL text (parameters excluded), so the same statement run for every row shows up as repeated.
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        self.template_time = 0.0
+        # Nesting depth of template renders, only the outermost render is timed
+        self.rendering = 0
+
+    # Function: repeated
+    # Parameters: self, threshold (int)
+    # Description: Statements run at least threshold times, the signature of an N+1 query.
+    # Returns: list of (sql, count), most repeated first
+    def repeated(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+# Function: _record_query
+# Parameters: see django.db.backends.base.base.BaseDatabaseWrapper.execute_wrapper
+# Description: Database execute wrapper timing every statement run while a request is being measured.
+# Returns: The result of the wrapped execute()
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - started
+        metrics.queries += 1
+        metrics.statements[sql] += 1
+
+
+# Function: _install_query_recorder
+# Parameters: connection (DatabaseWrapper)
+# Description: Adds the query recorder to a connection once (connections are reused between requests).
+# Returns: None
+def _install_query_recorder(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+# Function: _timed_render
+# Parameters: render (function) - django.template.backends.django.Template.render
+# Description: Wraps template rendering to add its duration to the current request's metrics.
+# Returns: function
+def _timed_render(render):
+    def timed_render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None or metrics.rendering:
+            return render(self, context, request)
+        metrics.rendering += 1
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - started
+            metrics.rendering -= 1
+    timed_render.timed = True
+    return timed_render
+
+
+# Class: RequestTimingMiddleware
+# Description: Measures every request: SQL query count and time, template render time and the time spent
+#              in the view (with the middleware below this one). The figures are sent in a Server-Timing
+#              header (shown by browser dev tools) and in one log line per request. Requests running more
+#              queries than REQUEST_QUERY_BUDGET, or the same statement REQUEST_REPEATED_QUERY_THRESHOLD times
+#              or more (N+1 queries), are logged as warnings. With REQUEST_TIMING_ENABLED = False the
+#              middleware removes itself from the chain and nothing is instrumented.
+class RequestTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_TIMING_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.query_budget = getattr(settings, 'REQUEST_QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+        self.repeated_threshold = getattr(settings, 'REQUEST_REPEATED_QUERY_THRESHOLD',
+                                          DEFAULT_REPEATED_QUERY_THRESHOLD)
+        # Record queries on the connections opened from now on, and on the already open ones
+        connection_created.connect(_install_query_recorder, dispatch_uid='request_timing')
+        for connection in connections.all(initialized_only=True):
+            _install_query_recorder(connection)
+        if not getattr(Template.render, 'timed', False):
+            Template.render = _timed_render(Template.render)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    # Function: finish
+    # Parameters:
+    #   - self
+    #   - request (HttpRequest), response (HttpResponse)
+    #   - metrics (RequestMetrics): figures collected while handling the request
+    #   - elapsed (float): seconds spent in the view and the middleware below this one
+    # Description: Adds the Server-Timing header and logs the request, as a warning if it was flagged.
+    # Returns: HttpResponse
+    def finish(self, request, response, metrics, elapsed):
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%.1f;desc="%d queries"' % (metrics.db_time * 1000, metrics.queries),
+            'tpl;dur=%.1f' % (metrics.template_time * 1000),
+            'view;dur=%.1f' % (elapsed * 1000),
+        ])
+
+        problems = []
+        if metrics.queries > self.query_budget:
+            problems.append("%d queries exceed the budget of %d" % (metrics.queries, self.query_budget))
+        repeated = metrics.repeated(self.repeated_threshold)
+        for sql, count in repeated:
+            problems.append("statement repeated %d times: %s" % (count, sql[:200]))
+
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'view_ms': round(elapsed * 1000, 1),
+            'db_ms': round(metrics.db_time * 1000, 1),
+            'queries': metrics.queries,
+            'repeated_queries': sum(count for sql, count in repeated),
+            'template_ms': round(metrics.template_time * 1000, 1),
+        }
+        message = ' '.join('%s=%s' % item for item in fields.items())
+        if problems:
+            logger.warning("%s flagged: %s", message, '; '.join(problems), extra={'request_metrics': fields})
+        else:
+            logger.info(message, extra={'request_metrics': fields})
+        return response
+
+
+# Class: StaticAssetMiddleware
+# Description: Serves the files collected in STATIC_ROOT when DEBUG is off (in development runserver serves
+#              them). Content-hashed files (see CompressedManifestStaticFilesStorage) are sent with a
+#              one-year immutable Cache-Control, so browsers reuse them without any request until the page
+#              links a new version. The pre-compressed .br or .gz variant is sent to the clients accepting it.
+#              Placed first in MIDDLEWARE, asset requests skip the rest of the chain.
+class StaticAssetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.root = str(settings.STATIC_ROOT)
+        self.prefix = settings.STATIC_URL
+        # Names of the hashed files, from the manifest written by collectstatic
+        self.immutable = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.is_asset(request):
+            return self.get_response(request)
+        return self.serve(request)
+
+    async def __acall__(self, request):
+        if not self.is_asset(request):
+            return await self.get_response(request)
+        # The file is read off the event loop
+        return await sync_to_async(self.serve)(request)
+
+    # Function: is_asset
+    # Parameters: self, request (HttpRequest)
+    # Description: Checks the request is for a static file.
+    # Returns: bool
+    def is_asset(self, request):
+        return request.method in ('GET', 'HEAD') and request.path.startswith(self.prefix)
+
+    # Function: serve
+    # Parameters: self, request (HttpRequest)
+    # Description: Sends a static file, or its pre-compressed variant the client accepts.
+    # Returns: HttpResponse
+    def serve(self, request):
+        name = request.path[len(self.prefix):]
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return HttpResponseNotFound()
+        if not os.path.isfile(path):
+            return HttpResponseNotFound()
+        modified = int(os.stat(path).st_mtime)
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        if since is not None and modified <= since:
+            response = HttpResponseNotModified()
+        else:
+            accepted = request.headers.get('Accept-Encoding', '')
+            encoding = next((encoding for encoding, suffix in ENCODINGS
+                             if encoding in accepted and os.path.isfile(path + suffix)), None)
+            with open(path + dict(ENCODINGS)[encoding] if encoding else path, 'rb') as file:
+                response = HttpResponse(file.read(), content_type=mimetypes.guess_type(name)[0]
+                                        or 'application/octet-stream')
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['Last-Modified'] = http_date(modified)
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if name in self.immutable else REVALIDATE_CACHE_CONTROL
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+
+# Class: StreamDisconnectMiddleware
+# Description: ASGI middleware (wrapped around the Django application in asgi.py) for endless streaming
+#              responses such as the menu event stream. Django does not notice a client going away while it
+#              streams, so a dropped connection would keep its stream running forever. For GET requests to
+#              the given path prefixes this waits for the client's http.disconnect message alongside the
+#              application, and cancels the application when it arrives, which closes the stream.
+class StreamDisconnectMiddleware:
+    def __init__(self, app, prefixes):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not scope['path'].startswith(self.prefixes):
+            return await self.app(scope, receive, send)
+        # Hand the (empty) body of the GET to the application, the next message is the disconnect
+        message = await receive()
+        if message['type'] != 'http.request' or message.get('more_body'):
+            return await self.app(scope, _replay(message, receive), send)
+        disconnected = asyncio.ensure_future(receive())
+        application = asyncio.ensure_future(self.app(scope, _replay(message, disconnected), send))
+        await asyncio.wait({application, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        if not application.done():
+            application.cancel()
+        else:
+            disconnected.cancel()
+        try:
+            await application
+        except asyncio.CancelledError:
+            pass
+
+
+# Function: _replay
+# Parameters: message (dict) - ASGI message already received, then receive (awaitable function or future)
+# Description: ASGI receive function returning the message first, then what receive returns.
+# Returns: async function
+def _replay(message, receive):
+    pending = [message]
+
+    async def replay():
+        if pending:
+            return pending.pop()
+        if asyncio.isfuture(receive):
+            return await receive
+        return await receive()
+    return replay
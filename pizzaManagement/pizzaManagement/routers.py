@@ -0,0 +1,139 @@
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Apps whose reads may be served by a replica: the menu (toppings, pizzas and the menu version). Users,
+# groups and sessions are always read from the primary, so logins and role changes apply at once.
+REPLICA_APPS = {'Owner'}
+
+# Methods that do not write: their requests may read from a replica
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+# Cookie pinning the reads of a client to the primary for a while after it wrote
+PIN_COOKIE = 'read_primary'
+# Default seconds a replica may lag behind the primary, overridden by DATABASE_REPLICA_LAG
+DEFAULT_REPLICA_LAG = 5
+
+# Whether the request handled in the current context reads from the primary. Context variables follow the
+# request into the threads sync_to_async runs ORM calls in.
+_read_primary = ContextVar('read_primary', default=False)
+
+
+# Function: replica_lag
+# Parameters: None
+# Description: Seconds a replica may lag behind the primary (DATABASE_REPLICA_LAG).
+# Returns: int
+def replica_lag():
+    return getattr(settings, 'DATABASE_REPLICA_LAG', DEFAULT_REPLICA_LAG)
+
+
+# Function: is_replica
+# Parameters: alias (str) - database alias
+# Description: Checks the alias is one of the read replicas (DATABASE_REPLICAS).
+# Returns: bool
+def is_replica(alias):
+    return alias in getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+# Class: PrimaryReplicaRouter
+# Description: Sends every write to the primary database and the menu reads to a random read replica,
+#              unless the current request reads from the primary (see ReadYourWritesMiddleware) or a
+#              transaction is open on the primary. The replicas are copies of the primary kept in sync
+#              outside Django: they are never migrated. Without replicas everything uses the primary.
+class PrimaryReplicaRouter:
+    def __init__(self, primary=DEFAULT_DB_ALIAS, replicas=None):
+        self.primary = primary
+        # None reads DATABASE_REPLICAS on every call, so tests can override it
+        self._replicas = replicas
+
+    # Function: replicas
+    # Parameters: self
+    # Description: Aliases of the read replicas.
+    # Returns: list of str
+    @property
+    def replicas(self):
+        if self._replicas is None:
+            return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+        return self._replicas
+
+    def db_for_read(self, model, **hints):
+        replicas = self.replicas
+        if (not replicas or model._meta.app_label not in REPLICA_APPS or _read_primary.get()
+                or connections[self.primary].in_atomic_block):
+            return self.primary
+        # Related objects are read from the database their instance came from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in replicas:
+            return instance._state.db
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Objects read from a replica are the same rows as on the primary
+        databases = {self.primary, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return None
+
+
+# Class: ReadYourWritesMiddleware
+# Description: Makes a client read its own writes. Requests writing (POST, PUT, PATCH, DELETE) read from the
+#              primary, and set a cookie making the reads of the same client use the primary for the next
+#              DATABASE_REPLICA_LAG seconds, e.g. the dashboard it is redirected to after a POST. Other
+#              clients may see the change up to DATABASE_REPLICA_LAG seconds later. Without
+#              DATABASE_REPLICAS the middleware removes itself from the chain.
+class ReadYourWritesMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'DATABASE_REPLICAS', None):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = _read_primary.set(self.reads_primary(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _read_primary.reset(token)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        token = _read_primary.set(self.reads_primary(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _read_primary.reset(token)
+        return self.pin(request, response)
+
+    # Function: reads_primary
+    # Parameters: self, request (HttpRequest)
+    # Description: Checks the request writes, or comes from a client that wrote recently.
+    # Returns: bool
+    def reads_primary(self, request):
+        return request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+
+    # Function: pin
+    # Parameters: self, request (HttpRequest), response (HttpResponse)
+    # Description: Pins the reads of a client that just wrote to the primary.
+    # Returns: HttpResponse
+    def pin(self, request, response):
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=replica_lag(), httponly=True, samesite='Lax')
+        return response
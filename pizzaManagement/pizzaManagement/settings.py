@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .database import sqlite_database
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -23,9 +26,11 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'django-insecure-8)d=)ef#yzon=&^tl8w&py=)alx%tit-1-b3#_hkq6c7als6pu'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# DJANGO_DEBUG=0 turns it off, together with the hashed and compressed static files below
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') != '0'
 
-ALLOWED_HOSTS = []
+# Space separated host names, required when DEBUG is off
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '').split()
 
 
 # Application definition
@@ -49,11 +54,18 @@ AUTHENTICATION_BACKENDS = [
 ]
 
 MIDDLEWARE = [
+    # Serves the collected static files when DEBUG is off, before any other middleware runs
+    'pizzaManagement.middleware.StaticAssetMiddleware',
+    # First, so the queries of every other middleware are measured too
+    'pizzaManagement.middleware.RequestTimingMiddleware',
+    # Before the sessions and the views: writes, and reads just after them, use the primary database
+    'pizzaManagement.routers.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # AuthenticationMiddleware that serves request.user and its roles from the cache
+    'Owner.roles.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -84,13 +96,73 @@ WSGI_APPLICATION = 'pizzaManagement.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# SQLite tuning (journal mode, pragmas, connection lifetime, lock retries), see
+# pizzaManagement.database.DATABASE_PROFILES: 'production' (default) or 'default' for Django's stock setup
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'production')
+
+# DJANGO_ASGI=1 (set by pizzaManagement.asgi) turns persistent connections off: under ASGI every request opens
+# its own connection, and a longer lifetime only leaves them open
+DATABASE_ASGI = os.environ.get('DJANGO_ASGI', '0') == '1'
+
 DATABASES = {
+    'default': sqlite_database(BASE_DIR / 'db.sqlite3', DATABASE_PROFILE, asgi=DATABASE_ASGI),
+}
+
+# Read replicas: copies of the database kept in sync outside Django (e.g. by Litestream or LiteFS), listed in
+# DATABASE_REPLICAS as file paths separated by os.pathsep. Menu reads are spread over them, see
+# pizzaManagement.routers. DATABASE_REPLICA_LAG is how many seconds a replica may be behind: a client reads
+# from the primary for that long after it wrote, and fragments rendered from a replica are cached as long.
+DATABASE_REPLICAS = []
+for index, path in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(os.pathsep)), 1):
+    DATABASES['replica%d' % index] = dict(sqlite_database(path, DATABASE_PROFILE, asgi=DATABASE_ASGI),
+                                          TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica%d' % index)
+DATABASE_REPLICA_LAG = 5
+
+DATABASE_ROUTERS = ['pizzaManagement.routers.PrimaryReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
+# Sessions stay in the database: the cache is local to each server process, so a logout in one of them would
+# not end a cached session in the others
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+# Lifetime in seconds of the users and roles cached by Owner.roles (checked against the user's version in the
+# database on every request)
+
+AUTH_USER_CACHE_TIMEOUT = 60 * 60
+
+# Lifetime in seconds of the cached pizza cards and topping rows (invalidated on every change)
+
+MENU_FRAGMENT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Changes touching more pizzas or toppings than this (e.g. deleting a topping used on thousands of pizzas)
+# invalidate all the cached fragments and the topping index at once instead of item by item
+MENU_INVALIDATION_LIMIT = 1000
+
+# Live dashboard updates (Server-Sent Events, see Owner.live): seconds between keep-alive comments on idle
+# streams, and the largest change whose fragments are pushed to the dashboards (past it they show a reload banner)
+MENU_EVENTS_KEEPALIVE = 15
+MENU_EVENTS_FRAGMENT_LIMIT = 50
+
+# Menu snapshot (see Owner.snapshot): directory of the precomputed catalog files served at /menu/snapshot/, and
+# seconds between a menu change and their rebuild (changes committed meanwhile share the rebuild)
+MENU_SNAPSHOT_DIR = os.environ.get('MENU_SNAPSHOT_DIR', BASE_DIR / 'snapshots')
+MENU_SNAPSHOT_DELAY = 2.0
+
+# Number of menu change log entries kept for incremental sync (see Owner.change_log): older ones are pruned,
+# and terminals that fell further behind reload the snapshot
+MENU_CHANGE_LOG_RETENTION = 100000
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -132,6 +204,39 @@ STATICFILES_DIRS = [
     BASE_DIR / "static"
 ]
 
+# Where collectstatic gathers the files served when DEBUG is off
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# Without DEBUG, collectstatic stores every file under a content-hashed name with .br / .gz variants, and the
+# templates link the hashed names (run collectstatic on each deploy)
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': ('django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+                    else 'pizzaManagement.storage.CompressedManifestStaticFilesStorage'),
+    },
+}
+
+# Menu listings
+# Number of pizzas / toppings shown per page on the dashboards (keyset pagination)
+
+MENU_PAGE_SIZE = 50
+
+# Maximum number of items a single JSON API bulk request may create, update or delete
+
+API_BULK_LIMIT = 500
+
+# Request instrumentation (pizzaManagement.middleware.RequestTimingMiddleware): Server-Timing header and one
+# log line per request on the 'pizzaManagement.requests' logger. Set REQUEST_TIMING_ENABLED = False to remove it.
+# Requests running more queries than the budget, or the same statement at least the repeated query threshold
+# times (N+1 queries), are logged as warnings
+
+REQUEST_TIMING_ENABLED = True
+REQUEST_QUERY_BUDGET = 20
+REQUEST_REPEATED_QUERY_THRESHOLD = 5
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -0,0 +1,65 @@
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it only gzip variants are built
+    brotli = None
+
+# Extensions of the text assets worth compressing (images and fonts are compressed already)
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.svg', '.json', '.txt', '.html', '.xml')
+
+# Content encodings of the pre-compressed variants, by file suffix, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+# Function: compress
+# Parameters: data (bytes), encoding ('br' or 'gzip')
+# Description: Compresses an asset once at build time, with the slowest and smallest settings. The gzip
+#              output does not embed a timestamp, so rebuilding unchanged files gives identical variants.
+# Returns: bytes, or None if the encoding is not available
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        return brotli.compress(data, quality=11)
+    return None
+
+
+# Class: CompressedManifestStaticFilesStorage
+# Description: Static files storage used by collectstatic when DEBUG is off. Files are stored under
+#              content-hashed names listed in a manifest (ManifestStaticFilesStorage), so they can be cached
+#              forever, and every compressible file also gets .br (when the brotli package is installed) and
+#              .gz variants next to it, served by StaticAssetMiddleware without compressing per request.
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Function: post_process
+    # Parameters: self, paths (dict), dry_run (bool), options
+    # Description: Hashes the collected files, then writes the compressed variants of the hashed files.
+    # Returns: iterator of (original name, stored name, processed) as in ManifestStaticFilesStorage
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self.compress_file(name)
+
+    # Function: compress_file
+    # Parameters: self, name (str) - stored name of the file
+    # Description: Writes the compressed variants of a file, only those smaller than the file itself.
+    # Returns: None
+    def compress_file(self, name):
+        path = self.path(name)
+        with open(path, 'rb') as file:
+            data = file.read()
+        for encoding, suffix in ENCODINGS:
+            compressed = compress(data, encoding)
+            if compressed is not None and len(compressed) < len(data):
+                with open(path + suffix, 'wb') as file:
+                    file.write(compressed)
+            elif os.path.exists(path + suffix):
+                # A variant left by a previous build would no longer match
+                os.remove(path + suffix)
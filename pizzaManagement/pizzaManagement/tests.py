@@ -0,0 +1,325 @@
+import asyncio
+import gzip
+import os
+import re
+import sqlite3
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from Owner.models import Topping
+from Owner.roles import OWNER
+from Owner.templatetags import vendor
+from .database import DATABASE_PROFILES, retry_on_lock, sqlite_database
+from .middleware import RequestTimingMiddleware, StaticAssetMiddleware, StreamDisconnectMiddleware
+from .routers import PIN_COOKIE, PrimaryReplicaRouter
+
+
+# ---------------------------------- REQUEST TIMING TESTING ---------------------------------- #
+class RequestTimingMiddlewareTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+        for name in ('Pepperoni', 'Mushrooms', 'Onions'):
+            Topping.objects.create(name=name)
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    # Helper parsing the Server-Timing header into {metric: (duration, description)}
+    def timings(self, response):
+        metrics = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            params = dict(param.split('=', 1) for param in params)
+            metrics[name] = (float(params['dur']), params.get('desc'))
+        return metrics
+
+    # Test the Server-Timing header and the log line of an async dashboard
+    def test_server_timing(self):
+        with self.assertLogs('pizzaManagement.requests', 'INFO') as logs:
+            response = self.client.get(reverse('owner_dashboard'))
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {'db', 'tpl', 'view'})
+        # Queries run by the async view in sync_to_async threads are counted
+        self.assertRegex(timings['db'][1], r'"[1-9]\d* queries"')
+        self.assertGreater(timings['tpl'][0], 0)
+        self.assertGreaterEqual(timings['view'][0], timings['tpl'][0])
+        record = logs.records[0]
+        self.assertEqual(record.levelname, 'INFO')
+        self.assertEqual(record.request_metrics['path'], reverse('owner_dashboard'))
+
+    # Test that requests over the query budget or repeating a statement are flagged
+    @override_settings(REQUEST_QUERY_BUDGET=2, REQUEST_REPEATED_QUERY_THRESHOLD=3)
+    def test_flagged_requests(self):
+        # A view loading the toppings one by one
+        def view(request):
+            for pk in Topping.objects.values_list('pk', flat=True):
+                Topping.objects.get(pk=pk)
+            return HttpResponse()
+        middleware = RequestTimingMiddleware(view)
+        with self.assertLogs('pizzaManagement.requests', 'WARNING') as logs:
+            middleware(RequestFactory().get('/'))
+        self.assertIn('exceed the budget of 2', logs.output[0])
+        self.assertIn('statement repeated 3 times', logs.output[0])
+
+    # Test that the middleware removes itself when disabled
+    @override_settings(REQUEST_TIMING_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get(reverse('owner_dashboard'))
+        self.assertNotIn('Server-Timing', response)
+
+
+# ---------------------------------- STREAM DISCONNECT TESTING ---------------------------------- #
+class StreamDisconnectTest(SimpleTestCase):
+    # Test that the application is cancelled when the client disconnects
+    async def test_disconnect(self):
+        cancelled = asyncio.Event()
+
+        async def endless(scope, receive, send):
+            self.assertEqual((await receive())['type'], 'http.request')
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        messages = iter([{'type': 'http.request', 'body': b''}, {'type': 'http.disconnect'}])
+
+        async def receive():
+            await asyncio.sleep(0)
+            return next(messages)
+        app = StreamDisconnectMiddleware(endless, ['/menu/events/'])
+        await asyncio.wait_for(app({'type': 'http', 'method': 'GET', 'path': '/menu/events/'}, receive, None), 5)
+        self.assertTrue(cancelled.is_set())
+
+
+# ---------------------------------- STATIC ASSET TESTING ---------------------------------- #
+class StaticAssetTest(SimpleTestCase):
+    # Helper collecting the static files into a temporary STATIC_ROOT with the production storage
+    def collect(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storages = dict(settings.STORAGES, staticfiles={
+            'BACKEND': 'pizzaManagement.storage.CompressedManifestStaticFilesStorage'})
+        production = override_settings(DEBUG=False, STATIC_ROOT=directory.name, STORAGES=storages)
+        production.enable()
+        self.addCleanup(production.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        return directory.name
+
+    # Test that collectstatic stores hashed files with compressed variants, and the templates link them
+    def test_collectstatic(self):
+        root = self.collect()
+        hashed = staticfiles_storage.stored_name('css/home.css')
+        self.assertRegex(hashed, r'^css/home\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(root, hashed), 'rb') as file:
+            original = file.read()
+        with open(os.path.join(root, hashed + '.gz'), 'rb') as file:
+            self.assertEqual(gzip.decompress(file.read()), original)
+        # Images are not compressed again
+        self.assertFalse(os.path.exists(os.path.join(root, staticfiles_storage.stored_name(
+            'images/supreme_slices_logo.png')) + '.gz'))
+        self.assertIn(hashed, Template('{% load static %}{% static "css/home.css" %}').render(Context()))
+
+    # Test that every file the templates link with {% static %} is collected, so no page fails with DEBUG off
+    def test_templates_link_collected_files(self):
+        self.collect()
+        names = set()
+        for directory, _, files in os.walk(settings.BASE_DIR):
+            for file in files:
+                if file.endswith('.html') and os.path.basename(directory) == 'templates':
+                    with open(os.path.join(directory, file), encoding='utf-8') as template:
+                        names.update(re.findall(r"{% static '([^']+)' %}", template.read()))
+        self.assertIn('vendor/jquery/jquery.min.js', names)
+        for name in names:
+            # Raises ValueError for a name missing from the manifest
+            self.assertTrue(staticfiles_storage.stored_name(name))
+
+    # Test that third-party assets are linked from static/vendor once vendored, from their pinned URL before,
+    # and never with a placeholder integrity attribute
+    def test_vendor_static(self):
+        template = Template("{% load vendor %}{% vendor_static 'jquery/jquery.min.js' %} "
+                            "{% vendor_static 'bootstrap/css/bootstrap.min.css' %}")
+        with mock.patch.object(vendor, 'is_vendored', lambda name: name.startswith('jquery/')):
+            local, remote = template.render(Context()).split()
+        self.assertEqual(local, staticfiles_storage.url('vendor/jquery/jquery.min.js'))
+        self.assertEqual(remote, vendor.CDN_URLS['bootstrap/css/bootstrap.min.css'])
+        for directory, _, files in os.walk(settings.BASE_DIR):
+            for file in files:
+                if file.endswith('.html') and os.path.basename(directory) == 'templates':
+                    with open(os.path.join(directory, file), encoding='utf-8') as template:
+                        source = template.read()
+                    self.assertNotIn('integrity="sha384-..."', source)
+                    self.assertNotIn('cdn.jsdelivr.net', source)
+
+    # Test that the hashed files are served compressed and cached for a year, other files revalidated
+    def test_middleware(self):
+        self.collect()
+        middleware = StaticAssetMiddleware(lambda request: HttpResponse('view'))
+        factory = RequestFactory()
+        url = settings.STATIC_URL + staticfiles_storage.stored_name('css/home.css')
+        response = middleware(factory.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        # Clients not accepting gzip get the file itself
+        self.assertNotIn('Content-Encoding', middleware(factory.get(url)))
+        response = middleware(factory.get(settings.STATIC_URL + 'css/home.css'))
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        response = middleware(factory.get(settings.STATIC_URL + 'css/home.css',
+                                          HTTP_IF_MODIFIED_SINCE=response['Last-Modified']))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(middleware(factory.get(settings.STATIC_URL + '../manage.py')).status_code, 404)
+        # Other requests go on to the views
+        self.assertEqual(middleware(factory.get('/')).content, b'view')
+
+
+# ---------------------------------- DATABASE PROFILE TESTING ---------------------------------- #
+class DatabaseProfileTest(SimpleTestCase):
+    # Helper opening a connection to a new database file configured with a profile
+    def open_database(self, profile):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = sqlite_database(os.path.join(directory.name, 'db.sqlite3'), profile)
+        # Fill in the settings Django defaults, like it does for settings.DATABASES
+        wrapper = DatabaseWrapper(connections.configure_settings({'default': database})['default'], 'profile')
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    # Helper reading a pragma
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    # Test that the pragmas of the profile are applied to every new connection
+    def test_pragmas(self):
+        production = self.open_database('production')
+        self.assertEqual(self.pragma(production, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(production, 'cache_size'),
+                         DATABASE_PROFILES['production']['PRAGMAS']['cache_size'])
+        # Django's stock setup is left untouched
+        self.assertEqual(self.pragma(self.open_database('default'), 'journal_mode'), 'delete')
+        with self.assertRaises(ValueError):
+            sqlite_database('db.sqlite3', 'fastest')
+
+    # Test that connections persist under WSGI only
+    def test_connection_lifetime(self):
+        self.assertEqual(sqlite_database('db.sqlite3', 'production')['CONN_MAX_AGE'], 600)
+        asgi = sqlite_database('db.sqlite3', 'production', asgi=True)
+        self.assertEqual((asgi['CONN_MAX_AGE'], asgi['CONN_HEALTH_CHECKS']), (0, False))
+        self.assertEqual(asgi['PRAGMAS'], DATABASE_PROFILES['production']['PRAGMAS'])
+
+    # Test that locked writes are retried, up to LOCK_RETRIES times, and other errors are not
+    def test_retry_on_lock(self):
+        calls = []
+
+        @retry_on_lock
+        def write(error, failures):
+            calls.append(1)
+            if len(calls) <= failures:
+                raise error
+            return 'written'
+
+        locked = OperationalError('database is locked')
+        saved = connection.settings_dict['LOCK_RETRIES']
+        connection.settings_dict['LOCK_RETRIES'] = 2
+        try:
+            self.assertEqual(write(locked, 2), 'written')
+            self.assertEqual(len(calls), 3)
+            calls.clear()
+            with self.assertRaises(OperationalError):
+                write(locked, 3)
+            self.assertEqual(len(calls), 3)
+            calls.clear()
+            with self.assertRaises(OperationalError):
+                write(OperationalError('no such table: Owner_pizza'), 1)
+            self.assertEqual(len(calls), 1)
+        finally:
+            connection.settings_dict['LOCK_RETRIES'] = saved
+
+
+# ---------------------------------- REPLICA ROUTING TESTING ---------------------------------- #
+@override_settings(DATABASE_ROUTERS=[PrimaryReplicaRouter('test_primary', ['test_replica'])],
+                   DATABASE_REPLICAS=['test_replica'])
+class ReplicaRouterTest(SimpleTestCase):
+    # Two SQLite files: a primary and a replica, synchronized by copying the primary (replicate()).
+    # transaction.on_commit() still checks the state of the 'default' connection, nothing is written to it.
+    databases = {'default'}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cls.directory.cleanup)
+        for alias in ('test_primary', 'test_replica'):
+            database = sqlite_database(os.path.join(cls.directory.name, alias + '.sqlite3'), 'default')
+            connections.settings[alias] = connections.configure_settings({'default': database})['default']
+            cls.addClassCleanup(cls.remove_database, alias)
+        call_command('migrate', database='test_primary', verbosity=0)
+        cls.owner = User.objects.create_user(username='Owner', password='SupremeSlicesOwner')
+        cls.owner.groups.add(Group.objects.get(name=OWNER))
+        cls.replicate()
+
+    # Helper unregistering a test database
+    @staticmethod
+    def remove_database(alias):
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+    # Helper copying the primary into the replica, like a replication tool would
+    @classmethod
+    def replicate(cls):
+        connections['test_replica'].close()
+        with sqlite3.connect(connections['test_primary'].settings_dict['NAME']) as primary, \
+                sqlite3.connect(connections['test_replica'].settings_dict['NAME']) as replica:
+            primary.backup(replica)
+
+    def setUp(self):
+        # Fragments and the topping index of other tests share the same primary keys
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    # Test that menu reads go to the replica, and everything else to the primary
+    def test_routing(self):
+        router = PrimaryReplicaRouter('test_primary', ['test_replica'])
+        self.assertEqual(router.db_for_read(Topping), 'test_replica')
+        self.assertEqual(router.db_for_read(User), 'test_primary')
+        self.assertEqual(router.db_for_write(Topping), 'test_primary')
+        self.assertIs(router.allow_migrate('test_replica', 'Owner'), False)
+        self.assertIsNone(router.allow_migrate('test_primary', 'Owner'))
+        # Without replicas, everything uses the primary
+        self.assertEqual(PrimaryReplicaRouter('test_primary', []).db_for_read(Topping), 'test_primary')
+
+    # Test that the dashboard reads from the replica, which sees a change once it is replicated
+    def test_dashboard_reads_replica(self):
+        Topping.objects.create(name='Anchovies')
+        self.assertNotContains(self.client.get(reverse('owner_dashboard')), 'Anchovies')
+        self.replicate()
+        self.assertContains(self.client.get(reverse('owner_dashboard')), 'Anchovies')
+
+    # Test that a client reads its own writes after the redirect, before they are replicated
+    def test_read_your_writes(self):
+        response = self.client.post(reverse('add_topping'), {'name': 'Capers'}, follow=True)
+        self.assertRedirects(response, reverse('topping_list'))
+        self.assertContains(response, 'Capers')
+        self.assertIn(PIN_COOKIE, response.client.cookies)
+        # Another client only sees the topping once it reaches the replica
+        other = Client()
+        other.force_login(self.owner)
+        self.assertNotContains(other.get(reverse('topping_list')), 'Capers')
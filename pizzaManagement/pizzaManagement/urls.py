@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from Owner.views import menu_changes, menu_events, menu_snapshot
 from .views import CustomLoginView, CustomLogoutView
 
 
@@ -9,6 +10,12 @@ urlpatterns = [
     # path('', TemplateView.as_view(template_name='home.html'), name='home'),
     path('owner/', include('Owner.urls')),
     path('chef/', include('Chef.urls')),
+    # Live menu changes for the dashboards (Server-Sent Events)
+    path('menu/events/', menu_events, name='menu_events'),
+    # Read-only catalog for menu boards and kiosks, served from a precomputed file
+    path('menu/snapshot/', menu_snapshot, name='menu_snapshot'),
+    # Changes since a position of the change log, for terminals syncing the menu incrementally
+    path('menu/changes/', menu_changes, name='menu_changes'),
     path('', CustomLoginView.as_view(), name='home'),
     path('logout/', CustomLogoutView.as_view(), name='logout'),
 ]
@@ -3,6 +3,7 @@ from django.urls import reverse
 from django.contrib.auth.views import LogoutView
 from django.urls import reverse_lazy
 from django.shortcuts import redirect
+from Owner.roles import CHEF, OWNER, user_roles
 
 
 # Function: CustomLoginView
@@ -21,11 +22,12 @@ class CustomLoginView(LoginView):
         user = self.request.user
         # Check if the user is authenticated
         if user.is_authenticated:
+            roles = user_roles(user)
             # If user is a Chef, redirect to Chef dashboard
-            if user.username == 'Chef':
+            if CHEF in roles:
                 return reverse('chef_dashboard')
             # If user is an Owner, redirect to Owner dashboard
-            elif user.username == 'Owner':
+            elif OWNER in roles:
                 return reverse('owner_dashboard')
         # If user is not authenticated or not Chef/Owner, redirect to default success URL
         return super().get_success_url()
@@ -0,0 +1,80 @@
+// Live menu updates for the dashboards. Follows the menu event stream (Owner.live) and patches the page with
+// the fragments each event carries, instead of reloading it. The script tag sets:
+//   data-url:   URL of the event stream
+//   data-kind:  "pizzas" or "toppings", the fragments listed on the page (elements with data-menu-id)
+//   data-since: menu version the page was rendered at
+// When the page cannot be patched (too many changes, missed events) the #menu-changed banner is shown.
+(function () {
+    var script = document.currentScript;
+    var url = script.dataset.url;
+    var kind = script.dataset.kind;
+    if (!window.EventSource || !url) {
+        return;
+    }
+    var since = script.dataset.since;
+    var source = new EventSource(since ? url + '?since=' + encodeURIComponent(since) : url);
+
+    // Function: stale
+    // Description: Tells the user the page is out of date and should be reloaded.
+    function stale() {
+        var banner = document.getElementById('menu-changed');
+        if (banner) {
+            banner.classList.remove('d-none');
+        }
+    }
+
+    // Function: patchFragments
+    // Description: Replaces the fragments of the changed items listed on the page, removes the deleted ones.
+    //              Items not on the page (new ones, or on another page) appear on the next load.
+    function patchFragments(items) {
+        Object.keys(items).forEach(function (id) {
+            var element = document.querySelector('[data-menu-id="' + id + '"]');
+            if (!element) {
+                return;
+            }
+            if (items[id] === null) {
+                element.remove();
+            } else {
+                var template = document.createElement('template');
+                template.innerHTML = items[id].html.trim();
+                element.replaceWith(template.content);
+            }
+        });
+    }
+
+    // Function: patchToppingPickers
+    // Description: Renames or removes the changed toppings in the topping selects and checkboxes.
+    function patchToppingPickers(toppings) {
+        Object.keys(toppings).forEach(function (id) {
+            var options = document.querySelectorAll('option[value="' + id + '"]');
+            var checkbox = document.getElementById('topping-' + id);
+            options.forEach(function (option) {
+                if (toppings[id] === null) {
+                    option.remove();
+                } else {
+                    option.textContent = toppings[id].name;
+                }
+            });
+            if (checkbox) {
+                if (toppings[id] === null) {
+                    checkbox.closest('.form-check').remove();
+                } else {
+                    document.querySelector('label[for="topping-' + id + '"]').textContent = toppings[id].name;
+                }
+            }
+        });
+    }
+
+    source.addEventListener('change', function (event) {
+        var change = JSON.parse(event.data);
+        if (change[kind] === null) {
+            stale();
+        } else {
+            patchFragments(change[kind]);
+        }
+        if (kind === 'pizzas' && change.toppings) {
+            patchToppingPickers(change.toppings);
+        }
+    });
+    source.addEventListener('reload', stale);
+})();
@@ -0,0 +1,104 @@
+// Topping pickers (topping_picker.html). Typing in a picker searches the toppings through the topping search API
+// and lists the best matches; picking one adds it to the selection as a hidden input named after the picker,
+// so the form submits the selected topping ids. Only the selected toppings are rendered with the page.
+(function () {
+    // Delay between the last key press and the search request, in milliseconds
+    var DELAY = 150;
+    // Number of matches listed
+    var LIMIT = 10;
+
+    // Function: select
+    // Description: Adds a topping to the selection of a picker, unless it is already selected.
+    function select(picker, id, name) {
+        var selected = picker.querySelector('.topping-picker-selected');
+        if (selected.querySelector('[data-topping-id="' + id + '"]')) {
+            return;
+        }
+        var badge = document.createElement('span');
+        badge.className = 'badge text-bg-secondary me-1';
+        badge.dataset.toppingId = id;
+        badge.append(name + ' ');
+        var input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = picker.dataset.name;
+        input.value = id;
+        var remove = document.createElement('button');
+        remove.type = 'button';
+        remove.className = 'btn-close btn-close-white ms-1';
+        remove.setAttribute('aria-label', 'Remove ' + name);
+        badge.append(input, remove);
+        selected.append(badge);
+    }
+
+    // Function: showResults
+    // Description: Lists the matches of a search as buttons adding the topping to the selection.
+    function showResults(picker, toppings) {
+        var results = picker.querySelector('.topping-picker-results');
+        results.replaceChildren();
+        toppings.forEach(function (topping) {
+            var button = document.createElement('button');
+            button.type = 'button';
+            button.className = 'list-group-item list-group-item-action';
+            button.textContent = topping.name;
+            button.addEventListener('click', function () {
+                select(picker, topping.id, topping.name);
+                showResults(picker, []);
+                picker.querySelector('input[type="search"]').value = '';
+            });
+            results.append(button);
+        });
+    }
+
+    // Function: setUp
+    // Description: Wires the search box and the remove buttons of a picker.
+    function setUp(picker) {
+        var search = picker.querySelector('input[type="search"]');
+        var timer = null;
+        var latest = 0;
+        search.addEventListener('input', function () {
+            clearTimeout(timer);
+            var query = search.value.trim();
+            if (!query) {
+                showResults(picker, []);
+                return;
+            }
+            timer = setTimeout(function () {
+                var request = ++latest;
+                var url = picker.dataset.url + '?q=' + encodeURIComponent(query) + '&limit=' + LIMIT;
+                fetch(url, {credentials: 'same-origin'}).then(function (response) {
+                    return response.ok ? response.json() : {results: []};
+                }).then(function (data) {
+                    // Answers of older searches may arrive late
+                    if (request === latest) {
+                        showResults(picker, data.results);
+                    }
+                });
+            }, DELAY);
+        });
+        search.addEventListener('keydown', function (event) {
+            // Enter picks the best match instead of submitting the form
+            if (event.key === 'Enter') {
+                event.preventDefault();
+                var first = picker.querySelector('.topping-picker-results button');
+                if (first) {
+                    first.click();
+                }
+            }
+        });
+        picker.addEventListener('click', function (event) {
+            if (event.target.classList.contains('btn-close')) {
+                event.target.closest('[data-topping-id]').remove();
+            }
+        });
+        var form = picker.closest('form');
+        if (form) {
+            // Resetting the form (e.g. after a pizza was created) clears the selection
+            form.addEventListener('reset', function () {
+                picker.querySelector('.topping-picker-selected').replaceChildren();
+                showResults(picker, []);
+            });
+        }
+    }
+
+    document.querySelectorAll('.topping-picker').forEach(setUp);
+})();